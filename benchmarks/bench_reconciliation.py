@@ -0,0 +1,166 @@
+"""
+Benchmark: vectorized (NumPy) reconciliation vs. a pure-Python loop.
+
+Both produce the same `vat_rate_summary` and `reconciliation` blocks; the
+vectorized timing includes loading the item dicts into arrays.
+
+    python -m benchmarks.bench_reconciliation [--items 10 100 1000 10000] [--batch 1000] [--repeat 5]
+"""
+import copy
+import random
+import argparse
+import timeit
+from core.ms2_reconciliation import (
+    reconcile_invoice,
+    reconcile_invoices,
+    DEFAULT_TOLERANCE,
+    DEFAULT_RELATIVE_TOLERANCE,
+    MAX_REPORTED_LINES,
+    LINE_FIELDS,
+    TOTAL_FIELDS,
+)
+
+RATES = (0.0, 5.0, 8.0, 10.0)
+
+
+def synthetic_invoice(n_items: int, seed: int = 0, error_every: int = 97, missing_every: int = 5) -> dict:
+    """
+    Invoice in map_invoice shape with mixed VAT rates and a few wrong lines.
+
+    Every `missing_every`-th line has no VAT or after-VAT amount (TT78 XML
+    without TTKhac) and the line after it has only the after-VAT amount
+    missing, so the derivation rules are exercised.
+    """
+    rng = random.Random(seed)
+    items = []
+    totals = [0.0, 0.0, 0.0]
+    for i in range(n_items):
+        quantity = float(rng.randint(1, 50))
+        unit_price = float(rng.randint(1, 500) * 100)
+        rate = rng.choice(RATES)
+        before = quantity * unit_price
+        vat = float(round(before * rate / 100))
+        if error_every and i % error_every == error_every - 1:
+            before += 1000
+        after = before + vat
+        totals[0] += before
+        totals[1] += vat
+        totals[2] += after
+        if missing_every and i % missing_every == 0:
+            vat = after = 0.0
+        elif missing_every and i % missing_every == 1:
+            after = 0.0
+        items.append({
+            "product_code": f"P{i}", "product_name": f"Product {i}", "unit_name": "HOP",
+            "quantity": quantity, "unit_price": unit_price, "amount_before_vat": before,
+            "vat_rate": rate, "vat_amount": vat, "amount_after_vat": after,
+            "promotion_flag": False,
+        })
+    return {
+        "invoice_number": str(seed),
+        "total_amount_before_vat": totals[0],
+        "total_vat_amount": totals[1],
+        "total_amount_after_vat": totals[2] + (5000 if seed % 3 else 0),
+        "items": items,
+    }
+
+
+def _within(actual, expected):
+    return abs(actual - expected) <= DEFAULT_TOLERANCE + DEFAULT_RELATIVE_TOLERANCE * abs(expected)
+
+
+def python_reconcile(invoice: dict) -> dict:
+    """Item-by-item reconciliation, the baseline for the vectorized version."""
+    sums = {"amount_before_vat": 0.0, "vat_amount": 0.0, "amount_after_vat": 0.0}
+    present = {"amount_before_vat": False, "vat_amount": False, "amount_after_vat": False}
+    by_rate = {}
+    lines = []
+    line_mismatches = 0
+    for index, item in enumerate(invoice["items"]):
+        quantity, unit_price = item["quantity"], item["unit_price"]
+        before, rate = item["amount_before_vat"], item["vat_rate"]
+        vat, after = item["vat_amount"], item["amount_after_vat"]
+        # Missing VAT / after-VAT amounts are derived, and only present ones are checked
+        has_vat, has_after = vat != 0, after != 0
+        if not has_vat:
+            vat = before * rate / 100.0
+        if not has_after:
+            after = before + vat
+        sums["amount_before_vat"] += before
+        sums["vat_amount"] += vat
+        sums["amount_after_vat"] += after
+        present["amount_before_vat"] = present["amount_before_vat"] or before != 0
+        present["vat_amount"] = present["vat_amount"] or has_vat
+        present["amount_after_vat"] = present["amount_after_vat"] or has_after
+        by_rate[rate] = by_rate.get(rate, 0.0) + vat
+
+        checks = (
+            (quantity != 0 and unit_price != 0, before, quantity * unit_price),
+            (has_vat, vat, before * rate / 100.0),
+            (has_after, after, before + vat),
+        )
+        for field, (checked, actual, expected) in zip(LINE_FIELDS, checks):
+            if checked and not _within(actual, expected):
+                line_mismatches += 1
+                if len(lines) < MAX_REPORTED_LINES:
+                    lines.append({"line": index, "field": field, "expected": round(expected, 2), "actual": actual})
+
+    totals = {}
+    for item_field, total_field in TOTAL_FIELDS:
+        total = float(invoice[total_field])
+        totals[total_field] = {
+            "items": round(sums[item_field], 2),
+            "invoice": total,
+            "difference": round(total - sums[item_field], 2),
+            # Skipped when the total is missing or no line carries the column
+            "matches": total == 0 or not present[item_field] or _within(total, sums[item_field]),
+        }
+    invoice["vat_rate_summary"] = {f"{rate:g}%": round(amount, 2) for rate, amount in sorted(by_rate.items())}
+    invoice["reconciliation"] = {
+        "status": "ok" if not line_mismatches and all(t["matches"] for t in totals.values()) else "mismatch",
+        "totals": totals,
+        "line_mismatch_count": line_mismatches,
+        "line_mismatches": lines,
+    }
+    return invoice
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--batch", type=int, default=1000, help="Invoices per batch run (20 items each)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'case':>18} {'python (ms)':>12} {'numpy (ms)':>11} {'speedup':>8}")
+
+    def report(label, python_run, numpy_run, number):
+        python_times, numpy_times = [], []
+        # Interleave runs so machine noise hits both implementations equally
+        for _ in range(args.repeat):
+            python_times.append(timeit.timeit(python_run, number=number) / number)
+            numpy_times.append(timeit.timeit(numpy_run, number=number) / number)
+        print(f"{label:>18} {min(python_times) * 1e3:>12.3f} {min(numpy_times) * 1e3:>11.3f} "
+              f"{min(python_times) / min(numpy_times):>7.1f}x")
+
+    for n_items in args.items:
+        invoice = synthetic_invoice(n_items)
+        expected = python_reconcile(copy.deepcopy(invoice))
+        assert reconcile_invoices([copy.deepcopy(invoice)]) == [expected], "vectorized output differs from python loop"
+        assert reconcile_invoice(copy.deepcopy(invoice)) == expected, "reconcile_invoice differs from python loop"
+        number = max(1, 20000 // (n_items + 10))
+        # reconcile_invoices forces the vectorized path; reconcile_invoice loops below SMALL_INVOICE_LINES
+        report(f"1 x {n_items} items", lambda: python_reconcile(invoice), lambda: reconcile_invoices([invoice]), number)
+
+    batch = [synthetic_invoice(20, seed) for seed in range(args.batch)]
+    assert reconcile_invoices(copy.deepcopy(batch)) == [python_reconcile(copy.deepcopy(i)) for i in batch]
+    report(
+        f"{args.batch} x 20 items",
+        lambda: [python_reconcile(invoice) for invoice in batch],
+        lambda: reconcile_invoices(batch),
+        1,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Benchmark: compiled multi-schema XML mapper vs. the original hard-coded mapper.
+
+Both mappers run on the same xmltodict output so only the mapping step is
+measured (parsing is identical for both).
+
+    python -m benchmarks.bench_xml_mapping [--items 1 10 1000] [--repeat 20] [--max-ratio 1.1]
+
+Exits non-zero when the compiled mapper is slower than the legacy one by more
+than --max-ratio (median over the interleaved repeats, mapping step only).
+"""
+import os
+import argparse
+import statistics
+import timeit
+import xmltodict
+import yaml
+from core.ms2_xml_mapper import XmlInvoiceMapper
+from .standins import build_invoice_xml
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "..", "utils", "schemas", "xml_invoice_schemas.yaml")
+
+def legacy_map(data: dict) -> dict:
+    """The pre-schema mapping logic from map_invoice, kept as the baseline."""
+    hdon = data.get("HDon", {})
+    dl = hdon.get("DLHDon", {})
+    ndhd = dl.get("NDHDon", {})
+    ttchung = dl.get("TTChung", {})
+    nban = ndhd.get("NBan", {})
+    nmua = ndhd.get("NMua", {})
+    dshhdvu = ndhd.get("DSHHDVu", {}).get("HHDVu", [])
+    ttoan = ndhd.get("TToan", {})
+    if isinstance(dshhdvu, dict):
+        dshhdvu = [dshhdvu]
+    invoice = {
+        "invoice_type": ttchung.get("THDon", ""),
+        "vendor_tax_code": nban.get("MST", ""),
+        "vendor_name": nban.get("Ten", ""),
+        "vendor_address": nban.get("DChi", ""),
+        "buyer_tax_code": nmua.get("MST", ""),
+        "buyer_name": nmua.get("Ten", ""),
+        "buyer_address": nmua.get("DChi", ""),
+        "invoice_number": ttchung.get("SHDon", ""),
+        "template_code": ttchung.get("KHMSHDon", ""),
+        "invoice_series": ttchung.get("KHHDon", ""),
+        "issued_date": ttchung.get("NLap", ""),
+        "currency_code": ttchung.get("DVTTe", "VND"),
+        "total_amount_before_vat": float(ttoan.get("TgTCThue", 0)),
+        "total_vat_amount": float(ttoan.get("TgTThue", 0)),
+        "total_amount_after_vat": float(ttoan.get("TgTTTBSo", 0)),
+        "items": []
+    }
+    for hh in dshhdvu:
+        ttin_list = hh.get("TTKhac", {}).get("TTin", [])
+        if isinstance(ttin_list, dict):
+            ttin_list = [ttin_list]
+        vat_amount = 0
+        amount_after_vat = 0
+        promotion_flag = False
+        for t in ttin_list:
+            ttruong = t.get("TTruong", "")
+            dl_val = t.get("DLieu", {})
+            if ttruong == "Tiền thuế":
+                if isinstance(dl_val, (str, int, float)):
+                    vat_amount += float(dl_val)
+            elif ttruong == "TTMR" and isinstance(dl_val, dict):
+                amount_after_vat += float(dl_val.get("TTST", 0))
+                if str(dl_val.get("KM", "0")).strip() in ("1", "True", "true"):
+                    promotion_flag = True
+        invoice["items"].append({
+            "product_code": hh.get("MHHDVu", ""),
+            "product_name": hh.get("THHDVu", ""),
+            "unit_name": hh.get("DVTinh", ""),
+            "quantity": float(hh.get("SLuong", 0)),
+            "unit_price": float(hh.get("DGia", 0)),
+            "amount_before_vat": float(hh.get("ThTien", 0)),
+            "vat_rate": float(hh.get("TSuat", "0").replace("%", "")),
+            "vat_amount": vat_amount,
+            "amount_after_vat": amount_after_vat,
+            "promotion_flag": promotion_flag
+        })
+    return invoice
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--max-ratio", type=float, default=1.1,
+                        help="fail when compiled/legacy exceeds this (slack for timer noise)")
+    args = parser.parse_args()
+
+    with open(SCHEMA_FILE, encoding="utf-8") as f:
+        mapper = XmlInvoiceMapper(yaml.safe_load(f)["schemas"])
+
+    slow = []
+    print(f"{'items':>6} {'legacy (us)':>12} {'compiled (us)':>14} {'ratio':>7} {'e2e ratio':>10}")
+    for n_items in args.items:
+        xml = build_invoice_xml(n_items)
+        data = xmltodict.parse(xml)
+        assert mapper.map(data) == legacy_map(data), "compiled mapper output differs from legacy"
+
+        number = max(1, 20000 // (n_items + 10))
+        number_e2e = max(1, number // 20)
+        # Interleave runs so machine noise hits both mappers equally
+        legacy, compiled, legacy_e2e, compiled_e2e = [], [], [], []
+        for _ in range(args.repeat):
+            legacy.append(timeit.timeit(lambda: legacy_map(data), number=number) / number)
+            compiled.append(timeit.timeit(lambda: mapper.map(data), number=number) / number)
+            legacy_e2e.append(timeit.timeit(lambda: legacy_map(xmltodict.parse(xml)), number=number_e2e))
+            compiled_e2e.append(timeit.timeit(lambda: mapper.map(xmltodict.parse(xml)), number=number_e2e))
+        # Median of the paired ratios so a single noisy burst does not decide the result
+        ratio = statistics.median(c / l for c, l in zip(compiled, legacy))
+        print(
+            f"{n_items:>6} {min(legacy) * 1e6:>12.1f} {min(compiled) * 1e6:>14.1f} "
+            f"{ratio:>7.2f} {min(compiled_e2e) / min(legacy_e2e):>10.2f}"
+        )
+        if ratio > args.max_ratio:
+            slow.append(f"{n_items} items: {ratio:.2f}")
+
+    if slow:
+        raise SystemExit(f"compiled mapper slower than legacy (max ratio {args.max_ratio}): {', '.join(slow)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""
+Replay recorded /extract requests and queue messages to measure capacity.
+
+Traffic files are JSONL in the format written by utils.traffic.TrafficRecorder
+(set TRAFFIC_RECORD_PATH on a live instance to record). `synth` generates a
+file with a chosen XML/PDF mix when no recording is available.
+
+    python -m ms2_extractor.benchmarks.loadgen synth traffic.jsonl --count 500 --pdf-ratio 0.2
+    python -m ms2_extractor.benchmarks.loadgen replay traffic.jsonl --offline --mode open --rate 50 --duration 30
+    python -m ms2_extractor.benchmarks.loadgen replay traffic.jsonl --target http://localhost:5003 \\
+        --mode closed --concurrency 16 --requests 1000
+
+--offline runs the service in-process against local stand-ins for Gemini,
+RabbitMQ and MS4 (benchmarks/standins.py) with configurable latencies.
+
+Open-loop latency is measured from each request's scheduled send time, so a
+saturated service shows up as growing latency instead of a lower send rate.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from ms2_extractor.utils.spool import LocalSpool
+from ms2_extractor.utils.traffic import load_records, KIND_HTTP, KIND_QUEUE
+from .standins import (
+    Latency,
+    FakeModel,
+    FakeRabbitMQConnection,
+    fake_ms4_post,
+    build_invoice_xml,
+    write_sample_pdf,
+)
+
+PERCENTILES = (50, 95, 99)
+
+
+# ---------------- Targets ----------------
+
+def _message_body(record):
+    body = record.get("body")
+    if isinstance(body, (str, bytes)):
+        body = json.loads(body)
+    return body or {}
+
+
+class HttpTarget:
+    """Sends HTTP records to a running instance; queue records are published to the broker."""
+    def __init__(self, base_url: str, timeout: float):
+        import requests
+        self._session_local = threading.local()
+        self._requests = requests
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._broker_local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def send(self, record) -> str:
+        if record["kind"] == KIND_HTTP:
+            session = getattr(self._session_local, "session", None)
+            if session is None:
+                session = self._session_local.session = self._requests.Session()
+            response = session.post(
+                self.base_url + record.get("path", "/extract"), json=record.get("body"), timeout=self.timeout
+            )
+            return str(response.status_code)
+
+        from ms2_extractor.utils.rabbitmq import RabbitMQConnection
+        from ms2_extractor.utils.config import RABBITMQ_CONSUME_QUEUE
+
+        rmq = getattr(self._broker_local, "rmq", None)
+        if rmq is None:
+            rmq = self._broker_local.rmq = RabbitMQConnection()
+            rmq.connect()
+        body = record.get("body")
+        rmq.publish("", record.get("queue", RABBITMQ_CONSUME_QUEUE),
+                    body if isinstance(body, str) else json.dumps(body, ensure_ascii=False))
+        return "published"
+
+
+class OfflineTarget:
+    """Runs the Flask app and extractor in-process with local stand-ins for all dependencies."""
+    def __init__(self, records, args):
+        self.records = records
+        self.args = args
+        self._stack = contextlib.ExitStack()
+        self._attach_dir = None
+
+    def __enter__(self):
+        from ms2_extractor.core import ms2_apiHandler as api
+        from ms2_extractor.core import ms2_invoice_extractor as extractor
+        from ms2_extractor.core import ms2_consumer as consumer
+
+        self.api = api
+        self.extractor = extractor
+        self.consumer = consumer
+        args = self.args
+        jitter = args.jitter
+
+        self._attach_dir = tempfile.mkdtemp(prefix="ms2_loadgen_")
+        self._write_attachments()
+
+        FakeRabbitMQConnection.latency = Latency(args.broker_latency, jitter)
+        model = FakeModel(Latency(args.gemini_latency, jitter))
+        patches = [
+            mock.patch.object(extractor, "ATTACH_DIR", self._attach_dir),
+            mock.patch.object(extractor, "get_model", lambda *a, **k: model),
+            mock.patch.object(extractor, "RabbitMQConnection", FakeRabbitMQConnection),
+            mock.patch.object(extractor, "EXTRACTED_SINK", None),
+            # Publishes spooled during the run must not land in (or replay) the real SPOOL_DIR
+            mock.patch.object(extractor, "PUBLISH_SPOOL",
+                              LocalSpool(os.path.join(self._attach_dir, "spool", "publish.jsonl"))),
+            mock.patch.object(api.requests, "post", fake_ms4_post(Latency(args.ms4_latency, jitter))),
+            mock.patch.object(api, "RECORDER", None),
+            mock.patch.object(consumer, "RECORDER", None),
+        ]
+        for p in patches:
+            self._stack.enter_context(p)
+        if not args.verbose:
+            # The extractor prints every invoice; keep the report readable
+            devnull = self._stack.enter_context(open(os.devnull, "w"))
+            self._stack.enter_context(contextlib.redirect_stdout(devnull))
+        return self
+
+    def __exit__(self, *exc):
+        self._stack.close()
+        shutil.rmtree(self._attach_dir, ignore_errors=True)
+        return False
+
+    def _write_attachments(self):
+        xml = build_invoice_xml(self.args.xml_items)
+        written = set()
+        for record in self.records:
+            body = _message_body(record)
+            email_id = body.get("email_id")
+            if not email_id or email_id in written or body.get("attachment"):
+                continue
+            written.add(email_id)
+            if record.get("lane") == "pdf":
+                write_sample_pdf(os.path.join(self._attach_dir, f"{email_id}.pdf"), f"Invoice {email_id}")
+            else:
+                with open(os.path.join(self._attach_dir, f"{email_id}.xml"), "w", encoding="utf-8") as f:
+                    f.write(xml)
+
+    def send(self, record) -> str:
+        if record["kind"] == KIND_HTTP:
+            client = self.api.app.test_client()
+            response = client.post(record.get("path", "/extract"), json=record.get("body"))
+            return str(response.status_code)
+
+        result = self.consumer.process_message(_message_body(record))
+        return "ok" if result else "failed"
+
+
+# ---------------- Load loops ----------------
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.outcomes = defaultdict(Counter)
+
+    def add(self, lane: str, latency: float, outcome: str):
+        with self._lock:
+            self.samples[lane].append(latency)
+            self.outcomes[lane][outcome] += 1
+
+
+def _timed_send(target, record, results: Results, started: float):
+    try:
+        outcome = target.send(record)
+    except Exception as e:
+        outcome = f"error:{type(e).__name__}"
+    results.add(record.get("lane") or "unknown", time.perf_counter() - started, outcome)
+
+
+def run_open_loop(target, records, rate: float, total: int, concurrency: int, results: Results):
+    """Send `total` requests at a fixed `rate` regardless of how fast responses come back."""
+    interval = 1.0 / rate
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        t0 = time.perf_counter()
+        for i in range(total):
+            scheduled = t0 + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(_timed_send, target, records[i % len(records)], results, scheduled)
+
+
+def run_closed_loop(target, records, total: int, concurrency: int, results: Results, rate: float = None):
+    """`concurrency` workers each send the next request as soon as the previous one finishes."""
+    counter = iter(range(total))
+    lock = threading.Lock()
+    pace = concurrency / rate if rate else 0.0
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            _timed_send(target, records[i % len(records)], results, started)
+            if pace:
+                time.sleep(max(0.0, pace - (time.perf_counter() - started)))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+# ---------------- Reporting ----------------
+
+def percentile(sorted_values, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5 - 1e-9)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(results: Results, elapsed: float) -> dict:
+    lanes = dict(results.samples)
+    lanes["all"] = [v for values in results.samples.values() for v in values]
+    outcomes = dict(results.outcomes)
+    outcomes["all"] = sum(results.outcomes.values(), Counter())
+
+    summary = {}
+    for lane, values in lanes.items():
+        values = sorted(values)
+        summary[lane] = {
+            "requests": len(values),
+            "throughput_rps": len(values) / elapsed if elapsed else 0.0,
+            **{f"p{p}_ms": percentile(values, p) * 1000 for p in PERCENTILES},
+            "max_ms": (values[-1] * 1000) if values else 0.0,
+            "outcomes": dict(outcomes[lane]),
+        }
+    return summary
+
+
+def print_report(summary: dict, elapsed: float, out=sys.stdout):
+    print(f"\nDuration: {elapsed:.2f}s", file=out)
+    header = f"{'lane':<8} {'reqs':>7} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}  outcomes"
+    print(header, file=out)
+    print("-" * len(header), file=out)
+    for lane in sorted(summary, key=lambda name: (name == "all", name)):
+        row = summary[lane]
+        outcomes = ", ".join(f"{k}={v}" for k, v in sorted(row["outcomes"].items()))
+        print(
+            f"{lane:<8} {row['requests']:>7} {row['throughput_rps']:>8.1f} {row['p50_ms']:>9.1f} "
+            f"{row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}  {outcomes}",
+            file=out,
+        )
+
+
+# ---------------- Commands ----------------
+
+def cmd_synth(args):
+    """Generate a traffic file with the requested XML/PDF and HTTP/queue mix."""
+    rng = random.Random(args.seed)
+    with open(args.output, "w", encoding="utf-8") as f:
+        for i in range(args.count):
+            lane = "pdf" if rng.random() < args.pdf_ratio else "xml"
+            body = {"email_id": f"synth-{i:06d}", "isInvoice": True}
+            if rng.random() < args.queue_ratio:
+                record = {"ts": i, "kind": KIND_QUEUE, "queue": "queue.for_extraction", "lane": lane, "body": body}
+            else:
+                record = {"ts": i, "kind": KIND_HTTP, "path": "/extract", "lane": lane, "body": body}
+            f.write(json.dumps(record) + "\n")
+    print(f"Wrote {args.count} records to {args.output}")
+
+
+def cmd_replay(args):
+    records = load_records(args.traffic)
+    if not records:
+        raise SystemExit(f"No replayable records in {args.traffic}")
+    if args.shuffle:
+        random.Random(args.seed).shuffle(records)
+
+    total = args.requests
+    if total is None:
+        total = int(args.rate * args.duration) if args.mode == "open" and args.duration else len(records)
+    if args.mode == "open" and not args.rate:
+        raise SystemExit("--rate is required in open-loop mode")
+
+    target = OfflineTarget(records, args) if args.offline else HttpTarget(args.target, args.timeout)
+    results = Results()
+    with target:
+        started = time.perf_counter()
+        if args.mode == "open":
+            run_open_loop(target, records, args.rate, total, args.concurrency, results)
+        else:
+            run_closed_loop(target, records, total, args.concurrency, results, args.rate)
+        elapsed = time.perf_counter() - started
+
+    summary = summarize(results, elapsed)
+    if args.json:
+        print(json.dumps({"elapsed_s": elapsed, "lanes": summary}, indent=2))
+    else:
+        print_report(summary, elapsed)
+    return summary
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="MS2 traffic replay and load generator")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    synth = sub.add_parser("synth", help="Generate a synthetic traffic file")
+    synth.add_argument("output")
+    synth.add_argument("--count", type=int, default=1000)
+    synth.add_argument("--pdf-ratio", type=float, default=0.2)
+    synth.add_argument("--queue-ratio", type=float, default=0.0)
+    synth.add_argument("--seed", type=int, default=0)
+    synth.set_defaults(func=cmd_synth)
+
+    replay = sub.add_parser("replay", help="Replay a traffic file and report latency percentiles")
+    replay.add_argument("traffic", help="JSONL traffic file")
+    where = replay.add_mutually_exclusive_group(required=True)
+    where.add_argument("--target", help="Base URL of a running MS2 instance")
+    where.add_argument("--offline", action="store_true", help="Run in-process against local stand-ins")
+    replay.add_argument("--mode", choices=["open", "closed"], default="open")
+    replay.add_argument("--rate", type=float, help="Requests/s (open loop: arrival rate, closed loop: cap)")
+    replay.add_argument("--duration", type=float, help="Open loop: seconds to run (rate x duration requests)")
+    replay.add_argument("--requests", type=int, help="Total requests (records are cycled)")
+    replay.add_argument("--concurrency", type=int, default=64, help="Closed loop workers / open loop max in flight")
+    replay.add_argument("--timeout", type=float, default=30.0)
+    replay.add_argument("--shuffle", action="store_true")
+    replay.add_argument("--seed", type=int, default=0)
+    replay.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    offline = replay.add_argument_group("offline stand-ins")
+    offline.add_argument("--gemini-latency", type=float, default=2.0)
+    offline.add_argument("--ms4-latency", type=float, default=0.02)
+    offline.add_argument("--broker-latency", type=float, default=0.005)
+    offline.add_argument("--jitter", type=float, default=0.2, help="Relative stddev of stand-in latencies")
+    offline.add_argument("--xml-items", type=int, default=10, help="Line items per synthetic XML attachment")
+    offline.add_argument("--verbose", action="store_true", help="Keep extractor output")
+    replay.set_defaults(func=cmd_replay)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    main()
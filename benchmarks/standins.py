@@ -0,0 +1,141 @@
+"""
+Local stand-ins for Gemini, RabbitMQ and MS4 so load tests run fully offline.
+
+Each stand-in sleeps for a configurable latency (with optional jitter) to
+model the external dependency, then returns a canned success response.
+"""
+import json
+import random
+import threading
+import time
+
+CANNED_PDF_INVOICE = {
+    "invoice_type": "Hóa đơn giá trị gia tăng",
+    "vendor_tax_code": "2901270911",
+    "vendor_name": "CONG TY A",
+    "buyer_tax_code": "0104918404",
+    "buyer_name": "CONG TY B",
+    "invoice_number": "1",
+    "currency_code": "VND",
+    "total_amount_before_vat": 2000,
+    "total_vat_amount": 200,
+    "total_amount_after_vat": 2200,
+    "products": [{
+        "product_name": "Product", "quantity": 2, "unit_price": 1000,
+        "amount_before_vat": 2000, "vat_rate": 10, "vat_amount": 200,
+        "amount_after_vat": 2200, "promotion_flag": False,
+    }],
+}
+
+
+def _sleep(latency: float, jitter: float):
+    if latency > 0:
+        time.sleep(max(0.0, random.gauss(latency, latency * jitter)) if jitter else latency)
+
+
+class Latency:
+    """Mean latency in seconds plus relative jitter (stddev / mean)."""
+    def __init__(self, mean: float = 0.0, jitter: float = 0.0):
+        self.mean = mean
+        self.jitter = jitter
+
+    def wait(self):
+        _sleep(self.mean, self.jitter)
+
+
+class FakeModel:
+    """Stand-in for genai.GenerativeModel."""
+    def __init__(self, latency: Latency, response: dict = None):
+        self.latency = latency
+        self.response = response or CANNED_PDF_INVOICE
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        self.latency.wait()
+        return _FakeResponse(json.dumps(self.response, ensure_ascii=False))
+
+
+class _FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeRabbitMQConnection:
+    """Stand-in for utils.rabbitmq.RabbitMQConnection that counts published messages."""
+    latency = Latency()
+    published = 0
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.connection = None
+        self.channel = None
+
+    def connect(self):
+        self.latency.wait()
+
+    def publish(self, exchange: str, routing_key: str, body: str):
+        self.latency.wait()
+        with self._lock:
+            FakeRabbitMQConnection.published += 1
+
+    def close(self):
+        pass
+
+
+class FakeMS4Response:
+    def __init__(self, status_code: int = 201, text: str = ""):
+        self.status_code = status_code
+        self.text = text
+
+
+def fake_ms4_post(latency: Latency):
+    """Return a requests.post replacement that answers like MS4 /invoice."""
+    def post(url, json=None, timeout=None, **kwargs):
+        latency.wait()
+        return FakeMS4Response(201)
+    return post
+
+
+# ---------------- Attachments ----------------
+
+ITEM_XML = """<HHDVu><MHHDVu>P{i}</MHHDVu><THHDVu>Product {i}</THHDVu><DVTinh>HOP</DVTinh>
+<SLuong>2</SLuong><DGia>1000</DGia><ThTien>2000</ThTien><TSuat>10%</TSuat>
+<TTKhac><TTin><TTruong>Tiền thuế</TTruong><DLieu>200</DLieu></TTin>
+<TTin><TTruong>TTMR</TTruong><DLieu><TTST>2200</TTST><KM>0</KM></DLieu></TTin></TTKhac></HHDVu>"""
+
+
+def build_invoice_xml(n_items: int) -> str:
+    items = "".join(ITEM_XML.format(i=i) for i in range(n_items))
+    return (
+        "<HDon><DLHDon><TTChung><THDon>HD GTGT</THDon><KHMSHDon>1</KHMSHDon><KHHDon>C25T</KHHDon>"
+        "<SHDon>1</SHDon><NLap>2025-01-01</NLap></TTChung><NDHDon>"
+        "<NBan><Ten>A</Ten><MST>1</MST><DChi>X</DChi></NBan><NMua><Ten>B</Ten><MST>2</MST><DChi>Y</DChi></NMua>"
+        f"<DSHHDVu>{items}</DSHHDVu>"
+        f"<TToan><TgTCThue>{2000 * n_items}</TgTCThue><TgTThue>{200 * n_items}</TgTThue>"
+        f"<TgTTTBSo>{2200 * n_items}</TgTTTBSo></TToan></NDHDon></DLHDon></HDon>"
+    )
+
+
+def write_sample_pdf(path: str, text: str):
+    """Write a minimal one-page PDF whose first page contains `text`."""
+    safe = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    stream = f"BT /F1 10 Tf 40 800 Td ({safe}) Tj ET".encode("latin-1", "replace")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+        b"/Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>",
+        b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(bytes(out))
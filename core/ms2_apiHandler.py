@@ -1,45 +1,122 @@
+import hmac
 import logging
 from flask import Flask, request, jsonify
 import requests
 from requests.exceptions import ConnectionError, RequestException
-from utils.config import MS4_PERSISTENCE_BASE_URL
-from ms2_extractor.core.ms2_invoice_extractor import extract_invoice_data
+from utils.config import (
+    MS4_PERSISTENCE_BASE_URL,
+    EXTRACT_XML_MAX_INFLIGHT,
+    EXTRACT_XML_MAX_QUEUE,
+    EXTRACT_PDF_MAX_INFLIGHT,
+    EXTRACT_PDF_MAX_QUEUE,
+    EXTRACT_QUEUE_TIMEOUT,
+    ADMIN_TOKEN,
+    TRAFFIC_RECORD_PATH,
+    MAX_ATTACHMENT_BYTES,
+)
+from ms2_extractor.core.ms2_invoice_extractor import (
+    extract_invoice_data,
+    extract_invoice_from_bytes,
+    detect_attachment_type,
+    detect_content_type,
+    check_email_id,
+    decode_inline_attachment,
+    encode_inline_attachment,
+    PROFILER,
+    BREAKERS,
+    CRITICAL_DEPENDENCIES,
+    PUBLISH_SPOOL,
+)
+from ms2_extractor.utils.admission import AdmissionController, AdmissionRejected
+from ms2_extractor.utils.circuit_breaker import CircuitOpenError, health_report
+from ms2_extractor.utils.traffic import TrafficRecorder, KIND_HTTP
 
 # ---------------- Logging ----------------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Giới hạn body: attachment base64 (~4/3 kích thước gốc) cộng phần JSON/multipart
+app.config["MAX_CONTENT_LENGTH"] = MAX_ATTACHMENT_BYTES * 4 // 3 + 64 * 1024
+
+# ---------------- Admission Control ----------------
+# Mỗi đường trích xuất có giới hạn riêng để PDF chậm không chiếm hết slot của XML
+ADMISSION = {
+    "xml": AdmissionController(
+        "xml",
+        max_inflight=EXTRACT_XML_MAX_INFLIGHT,
+        max_queue=EXTRACT_XML_MAX_QUEUE,
+        queue_timeout=EXTRACT_QUEUE_TIMEOUT,
+    ),
+    "pdf": AdmissionController(
+        "pdf",
+        max_inflight=EXTRACT_PDF_MAX_INFLIGHT,
+        max_queue=EXTRACT_PDF_MAX_QUEUE,
+        queue_timeout=EXTRACT_QUEUE_TIMEOUT,
+    ),
+}
+
+# Ghi lại traffic thật để replay bằng load generator
+RECORDER = TrafficRecorder(TRAFFIC_RECORD_PATH) if TRAFFIC_RECORD_PATH else None
 
 # ---------------- Helper Functions ----------------
 
 def call_ms4_persistence(invoice_data):
-    """Gọi API MS4 để lưu metadata (blocking)"""
+    """Gọi API MS4 để lưu metadata (blocking); trả lỗi ngay khi circuit MS4 đang mở"""
+    breaker = BREAKERS["ms4"]
+    try:
+        breaker.before_call()
+    except CircuitOpenError as e:
+        return {
+            "service": "MS4",
+            "status": "error",
+            "message": str(e),
+            "retry_after": e.retry_after
+        }
+
     try:
         url = f"{MS4_PERSISTENCE_BASE_URL}/invoice"
         response = requests.post(url, json=invoice_data, timeout=10)
-
-        if response.status_code == 201:
-            return {"service": "MS4", "status": "success", "message": "SQL persistence successful"}
-        else:
-            return {
-                "service": "MS4",
-                "status": "error",
-                "message": f"MS4 responded with {response.status_code}: {response.text}"
-            }
     except ConnectionError:
+        breaker.record_failure()
         return {
             "service": "MS4",
             "status": "error",
             "message": "Failed to persist data due to connection error to MS4"
         }
     except RequestException as e:
+        breaker.record_failure()
         return {
             "service": "MS4",
             "status": "error",
             "message": f"Request to MS4 failed: {str(e)}"
         }
 
+    # 4xx là lỗi của request, không phải MS4 đang lỗi
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+    if response.status_code == 201:
+        return {"service": "MS4", "status": "success", "message": "SQL persistence successful"}
+    return {
+        "service": "MS4",
+        "status": "error",
+        "message": f"MS4 responded with {response.status_code}: {response.text}"
+    }
+
+
+def _dependency_unavailable(message, name, retry_after):
+    """503 + Retry-After khi một dependency đang lỗi (circuit mở) để MS1 retry sau"""
+    response = jsonify({
+        "status": "error",
+        "message": message,
+        "dependency": name
+    })
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 503
+
 # ---------------- API Endpoint ----------------
 
 @app.route("/extract", methods=["POST"])
@@ -56,6 +133,10 @@ def extract_invoice():
             "status": "error",
             "message": "Missing required field: email_id"
         }), 400
+    try:
+        check_email_id(email_id)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
 
     # 2. Bỏ qua nếu không phải hóa đơn (logic này có thể thay đổi)
     if not is_invoice:
@@ -64,14 +145,125 @@ def extract_invoice():
             "message": "Email is not an invoice"
         }), 200
 
-    # 3. Gọi hàm trích xuất dữ liệu thực tế
+    # 3. Attachment inline (base64) được xử lý trực tiếp trong bộ nhớ
+    attachment = data.get("attachment")
+    if attachment:
+        try:
+            content, filename, content_type = decode_inline_attachment(attachment)
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 400
+        lane_name = detect_content_type(content, filename, content_type)
+        if lane_name is None:
+            return _unsupported_attachment(filename, content_type)
+        extract = lambda: extract_invoice_from_bytes(
+            email_id, content, filename, content_type, persist=bool(data.get("persist"))
+        )
+    else:
+        lane_name = "pdf" if detect_attachment_type(email_id) == "pdf" else "xml"
+        extract = lambda: extract_invoice_data(email_id)
+
+    if RECORDER:
+        RECORDER.record(KIND_HTTP, data, path="/extract", lane=lane_name)
+    return _admit_and_process(email_id, lane_name, extract)
+
+
+@app.route("/extract/upload", methods=["POST"])
+def extract_invoice_upload():
+    """
+    Nhận attachment dạng multipart (field "attachment") thay vì đọc từ shared storage.
+
+    Werkzeug buffer toàn bộ body (giới hạn bởi MAX_CONTENT_LENGTH, quá thì 413) trước
+    khi handler chạy; cần đọc theo chunk và dừng sớm thì dùng service asyncio.
+    """
+    email_id = request.form.get("email_id")
+    is_invoice = request.form.get("isInvoice", "true").lower() in ("1", "true", "yes")
+    persist = request.form.get("persist", "false").lower() in ("1", "true", "yes")
+    upload = request.files.get("attachment")
+
+    if not email_id or upload is None:
+        return jsonify({
+            "status": "error",
+            "message": "Missing required field: email_id or attachment"
+        }), 400
     try:
-        invoice_data = extract_invoice_data(email_id)
+        check_email_id(email_id)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    if not is_invoice:
+        return jsonify({
+            "status": "skipped",
+            "message": "Email is not an invoice"
+        }), 200
+
+    # File đã nằm trong bộ nhớ/temp file; MAX_CONTENT_LENGTH tính cho base64 nên vẫn cần giới hạn theo bytes
+    content = upload.read()
+    if len(content) > MAX_ATTACHMENT_BYTES:
+        return jsonify({
+            "status": "error",
+            "message": f"Attachment exceeds {MAX_ATTACHMENT_BYTES} bytes"
+        }), 413
+
+    lane_name = detect_content_type(content, upload.filename, upload.mimetype)
+    if lane_name is None:
+        return _unsupported_attachment(upload.filename, upload.mimetype)
+    if RECORDER:
+        # Ghi thành request /extract với attachment inline tương đương để loadgen replay được
+        RECORDER.record(KIND_HTTP, {
+            "email_id": email_id,
+            "isInvoice": True,
+            "persist": persist,
+            "attachment": encode_inline_attachment(content, upload.filename, upload.mimetype),
+        }, path="/extract", lane=lane_name)
+    return _admit_and_process(
+        email_id,
+        lane_name,
+        lambda: extract_invoice_from_bytes(email_id, content, upload.filename, upload.mimetype, persist=persist)
+    )
+
+
+def _unsupported_attachment(filename, content_type):
+    return jsonify({
+        "status": "error",
+        "message": f"Unsupported attachment type: {filename} ({content_type}), expected XML or PDF"
+    }), 415
+
+
+def _admit_and_process(email_id, lane_name, extract):
+    """Admission control: từ chối ngay nếu lane đã quá tải thay vì để MS1 timeout"""
+    lane = ADMISSION[lane_name]
+    try:
+        with lane.admit():
+            return _process_extraction(email_id, extract)
+    except AdmissionRejected as e:
+        logger.warning(f"Rejected {email_id}: {e} (retry after {e.retry_after}s)")
+        response = jsonify({
+            "status": "error",
+            "message": e.reason,
+            "lane": e.lane
+        })
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, e.status_code
+
+
+def _process_extraction(email_id, extract):
+    """Trích xuất và persist một hóa đơn, trả về (response, status)"""
+    # Gọi hàm trích xuất dữ liệu thực tế
+    try:
+        # MS4 đang lỗi thì không trích xuất vô ích
+        BREAKERS["ms4"].check()
+        invoice_data = extract()
         if not invoice_data:
             return jsonify({
                 "status": "error",
                 "message": f"Failed to extract invoice data for email_id: {email_id}"
             }), 500
+    except CircuitOpenError as e:
+        logger.warning(f"Fast-failing {email_id}: {e}")
+        return _dependency_unavailable(str(e), e.name, e.retry_after)
     except Exception as e:
         logger.error(f"Extraction failed for {email_id} with error: {e}")
         return jsonify({
@@ -79,10 +271,12 @@ def extract_invoice():
             "message": f"An exception occurred during extraction: {e}"
         }), 500
 
-    # 4. Gọi MS4 để persist dữ liệu
+    # Gọi MS4 để persist dữ liệu
     ms4_result = call_ms4_persistence(invoice_data)
 
-    # 5. Xử lý phản hồi dựa trên kết quả từ MS4
+    # Xử lý phản hồi dựa trên kết quả từ MS4
+    if ms4_result.get("retry_after"):
+        return _dependency_unavailable(ms4_result["message"], "ms4", ms4_result["retry_after"])
     if ms4_result.get("status") == "error":
         return jsonify({
             "status": "error",
@@ -99,5 +293,65 @@ def extract_invoice():
     }), 201
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Queue wait, in-flight và số request bị từ chối theo từng lane"""
+    return jsonify({name: controller.snapshot() for name, controller in ADMISSION.items()}), 200
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Trạng thái circuit breaker; 503 khi MS4 đang lỗi để load balancer chuyển traffic"""
+    report, status_code = health_report(BREAKERS, critical=CRITICAL_DEPENDENCIES)
+    report["spooled_messages"] = PUBLISH_SPOOL.pending()
+    return jsonify(report), status_code
+
+
+# ---------------- Admin Endpoints ----------------
+
+def _admin_authorized():
+    """Chỉ cho phép khi ADMIN_TOKEN được cấu hình và header khớp (mặc định từ chối)"""
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN)
+
+
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def profiling_settings():
+    """Xem hoặc đổi tỉ lệ lấy mẫu profiling (body: {"sample_rate": 0.05})"""
+    if not _admin_authorized():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        try:
+            PROFILER.set_sample_rate(data.get("sample_rate"))
+        except (TypeError, ValueError) as e:
+            return jsonify({"status": "error", "message": f"Invalid sample_rate: {e}"}), 400
+
+    return jsonify({
+        "sample_rate": PROFILER.sample_rate,
+        "output_dir": PROFILER.output_dir,
+        "max_files": PROFILER.max_files
+    }), 200
+
+
+@app.route("/admin/profiling/top", methods=["GET"])
+def profiling_top():
+    """Top hàm tốn thời gian nhất trong N phút gần đây (?minutes=5&limit=20&sort=tottime)"""
+    if not _admin_authorized():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    try:
+        report = PROFILER.top_functions(
+            minutes=float(request.args.get("minutes", 5)),
+            limit=int(request.args.get("limit", 20)),
+            sort=request.args.get("sort", "tottime")
+        )
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify(report), 200
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5003, debug=True)
\ No newline at end of file
@@ -0,0 +1,635 @@
+"""
+Service asyncio: nhận /extract qua HTTP và consume RABBITMQ_CONSUME_QUEUE trong cùng một event loop.
+
+Mỗi hóa đơn đang chờ Gemini/MS4/broker chỉ giữ một coroutine thay vì một thread,
+nên một process xử lý được hàng trăm hóa đơn in-flight. Phần CPU-bound
+(xmltodict/map_invoice, pypdf) chạy trong executor để không chặn event loop.
+XML và PDF chạy ở hai lane riêng (executor, giới hạn và tùy chọn queue riêng)
+để một loạt PDF chờ model không làm chậm XML.
+
+Chạy: python -m ms2_extractor.core.ms2_async_service
+"""
+import os
+import json
+import asyncio
+import logging
+import time
+import functools
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import aiohttp
+import aio_pika
+from aiohttp import web
+from utils.config import (
+    RABBITMQ_HOST,
+    RABBITMQ_PORT,
+    RABBITMQ_USERNAME,
+    RABBITMQ_PASSWORD,
+    RABBITMQ_VIRTUAL_HOST,
+    RABBITMQ_CONSUME_QUEUE,
+    RABBITMQ_PDF_CONSUME_QUEUE,
+    MS4_PERSISTENCE_BASE_URL,
+    MAX_ATTACHMENT_BYTES,
+    ASYNC_SERVICE_HOST,
+    ASYNC_SERVICE_PORT,
+    ASYNC_XML_MAX_INFLIGHT,
+    ASYNC_PDF_MAX_INFLIGHT,
+    ASYNC_QUEUE_PREFETCH,
+    ASYNC_EXECUTOR,
+    ASYNC_XML_EXECUTOR_WORKERS,
+    ASYNC_PDF_EXECUTOR_WORKERS,
+    PDF_CHUNK_CONCURRENCY,
+    TRAFFIC_RECORD_PATH,
+)
+from ms2_extractor.core import ms2_invoice_extractor as extractor
+from ms2_extractor.core.ms2_consumer import parse_message, message_lane
+from ms2_extractor.utils.admission import AsyncAdmissionController, AdmissionRejected
+from ms2_extractor.utils.circuit_breaker import CircuitOpenError, health_report
+from ms2_extractor.utils.traffic import TrafficRecorder, KIND_HTTP, KIND_QUEUE
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Cùng exchange/routing key với publish_invoice_data
+PUBLISH_EXCHANGE = extractor.PUBLISH_EXCHANGE
+PUBLISH_ROUTING_KEY = extractor.PUBLISH_ROUTING_KEY
+MS4_TIMEOUT = 10
+
+# Ghi lại traffic thật để replay bằng load generator
+RECORDER = TrafficRecorder(TRAFFIC_RECORD_PATH) if TRAFFIC_RECORD_PATH else None
+
+
+# Giới hạn in-flight và số worker executor của mỗi lane
+LANE_MAX_INFLIGHT = {"xml": ASYNC_XML_MAX_INFLIGHT, "pdf": ASYNC_PDF_MAX_INFLIGHT}
+LANE_EXECUTOR_WORKERS = {"xml": ASYNC_XML_EXECUTOR_WORKERS, "pdf": ASYNC_PDF_EXECUTOR_WORKERS}
+
+
+def create_executor(kind: str = ASYNC_EXECUTOR, workers: int = 0):
+    """Executor cho phần CPU-bound; "process" tránh GIL khi parse nhiều XML/PDF cùng lúc"""
+    workers = workers or os.cpu_count() or 1
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ms2-cpu")
+
+
+def create_lanes(limits: dict = None) -> dict:
+    """Một AsyncAdmissionController cho mỗi lane; HTTP vượt giới hạn nhận 429 ngay"""
+    limits = limits or LANE_MAX_INFLIGHT
+    return {name: AsyncAdmissionController(name, max_inflight=limit) for name, limit in limits.items()}
+
+
+class AsyncExtractionService:
+    """
+    Pipeline trích xuất bất đồng bộ dùng chung cho HTTP và queue.
+
+    Mỗi hóa đơn được phân loại theo loại attachment vào lane "xml" hoặc "pdf";
+    mỗi lane có executor và giới hạn in-flight riêng nên PDF chờ model không
+    chiếm slot/worker của XML.
+
+    Args:
+        executor: Executor dùng chung cho mọi lane (mặc định mỗi lane một executor
+            theo ASYNC_EXECUTOR và LANE_EXECUTOR_WORKERS)
+        lanes: {"xml": AsyncAdmissionController, "pdf": ...} (mặc định create_lanes())
+        prefetch: Số message chưa ack tối đa broker được giao cho mỗi queue
+        consume_queue: Tắt để chỉ chạy HTTP (vẫn kết nối broker để publish)
+        pdf_queue: Queue riêng của lane PDF; message PDF đến RABBITMQ_CONSUME_QUEUE
+            được chuyển sang đây để không giữ prefetch của queue chính
+    """
+    def __init__(self, executor=None, lanes: dict = None, prefetch: int = ASYNC_QUEUE_PREFETCH,
+                 consume_queue: bool = True, pdf_queue: str = RABBITMQ_PDF_CONSUME_QUEUE):
+        self.lanes = lanes or create_lanes()
+        self.executors = dict.fromkeys(self.lanes, executor) if executor is not None else {}
+        self._owned_executors = []
+        self.prefetch = prefetch
+        self.consume_queue = consume_queue
+        self.pdf_queue = pdf_queue
+        self.stats = Counter()
+        self.session = None
+        self.connection = None
+        self.channel = None
+        self.exchange = None
+
+    # ---------------- Lifecycle ----------------
+
+    async def start(self):
+        for name in self.lanes:
+            if name not in self.executors:
+                self.executors[name] = create_executor(workers=LANE_EXECUTOR_WORKERS.get(name, 0))
+                self._owned_executors.append(self.executors[name])
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=MS4_TIMEOUT))
+        self.connection = await aio_pika.connect_robust(
+            host=RABBITMQ_HOST,
+            port=RABBITMQ_PORT,
+            login=RABBITMQ_USERNAME,
+            password=RABBITMQ_PASSWORD,
+            virtualhost=RABBITMQ_VIRTUAL_HOST,
+        )
+        self.channel = await self.connection.channel()
+        await self.channel.set_qos(prefetch_count=self.prefetch)
+        # Topology do Queue Orchestrator quản lý: chỉ lấy exchange/queue có sẵn
+        self.exchange = await self.channel.get_exchange(PUBLISH_EXCHANGE, ensure=False)
+        if self.consume_queue:
+            queue = await self.channel.get_queue(RABBITMQ_CONSUME_QUEUE, ensure=True)
+            await queue.consume(self.on_message)
+            logger.info(f"Consuming from queue '{RABBITMQ_CONSUME_QUEUE}' (prefetch={self.prefetch})")
+            if self.pdf_queue:
+                # Channel riêng để prefetch của lane PDF không dùng chung với queue chính
+                pdf_channel = await self.connection.channel()
+                await pdf_channel.set_qos(prefetch_count=self.prefetch)
+                pdf_queue = await pdf_channel.get_queue(self.pdf_queue, ensure=True)
+                await pdf_queue.consume(self.on_pdf_message)
+                logger.info(f"Consuming PDF lane from queue '{self.pdf_queue}' (prefetch={self.prefetch})")
+
+    async def stop(self):
+        if self.connection is not None:
+            await self.connection.close()
+        if self.session is not None:
+            await self.session.close()
+        for executor in self._owned_executors:
+            executor.shutdown(wait=True)
+
+    # ---------------- Pipeline ----------------
+
+    async def extract(self, email_id: str, content: bytes = None, filename: str = None,
+                      content_type: str = None, persist: bool = False, lane: str = None):
+        """
+        Trích xuất một hóa đơn (từ ATTACH_DIR hoặc từ bytes), publish và ghi vào store cột.
+
+        Phần CPU-bound (parse XML/PDF, sửa JSON của model, reconciliation) chạy trong
+        executor của lane (mặc định phân loại theo attachment).
+
+        Returns:
+            Dữ liệu trích xuất hoặc None nếu thất bại
+        """
+        loop = asyncio.get_running_loop()
+        if content is None:
+            prepare = functools.partial(extractor.prepare_invoice, email_id)
+        else:
+            prepare = functools.partial(
+                extractor.prepare_invoice_from_bytes, email_id, content, filename, content_type, persist
+            )
+        lane = lane or classify(email_id, content, filename, content_type)
+        source, extracted_data = await loop.run_in_executor(self.executors[lane], prepare)
+
+        if source == "pdf" and extracted_data:
+            extracted_data = await self.generate(extracted_data, lane)
+
+        if not extracted_data:
+            logger.error(f"Extraction failed for {email_id}")
+            self.stats["failed"] += 1
+            return None
+
+        await self.publish(extracted_data)
+        extractor._append_to_sink(email_id, extracted_data, source)
+        self.stats["completed"] += 1
+        return extracted_data
+
+    async def generate(self, plan, lane: str = "pdf"):
+        """
+        Gọi model bằng API async; trả về dict hóa đơn hoặc None như đường sync.
+
+        Output của model được parse (và reconcile) trong executor của `lane`.
+
+        Raises:
+            CircuitOpenError: Khi circuit của Gemini đang mở
+        """
+        try:
+            model = extractor.get_model()
+            if model is None:
+                raise ValueError("Model is not loaded")
+            if plan.chunked:
+                return await self._generate_chunked(model, plan, self.executors[lane])
+            with extractor.BREAKERS["gemini"].call():
+                response = await model.generate_content_async(plan.prompt, generation_config=extractor.GENERATION_CONFIG)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.error(f"Model call failed: {e}")
+            return None
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executors[lane], extractor._parse_model_response, response.text
+        )
+
+    async def _generate_chunked(self, model, plan, executor):
+        """Header và các chunk được gọi đồng thời, tối đa PDF_CHUNK_CONCURRENCY request cho một hóa đơn"""
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(PDF_CHUNK_CONCURRENCY)
+
+        async def call(prompt, generation_config):
+            async with limit:
+                with extractor.BREAKERS["gemini"].call():
+                    response = await model.generate_content_async(prompt, generation_config=generation_config)
+            return response.text
+
+        async def extract_part(prompt, generation_config, parse, label):
+            # Header và chunk lỗi đều được thử lại riêng như đường sync
+            for attempt in range(1, extractor.CHUNK_ATTEMPTS + 1):
+                try:
+                    respond = await call(prompt, generation_config)
+                    return await loop.run_in_executor(executor, parse, respond)
+                except CircuitOpenError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"{label} extraction failed (attempt {attempt}/{extractor.CHUNK_ATTEMPTS}): {e}")
+            return None
+
+        header, *chunk_items = await asyncio.gather(
+            extract_part(plan.header_prompt, extractor.GENERATION_CONFIG, extractor.parse_invoice_output, "Header"),
+            *(
+                extract_part(prompt, extractor.ITEMS_GENERATION_CONFIG, extractor.load_items_output, "Chunk")
+                for _, _, prompt in plan.chunks
+            ),
+        )
+        return await loop.run_in_executor(executor, extractor._merge_chunk_results, plan, header, chunk_items)
+
+    async def publish(self, invoice_data):
+        """
+        Publish kết quả tới queue.for_persistence.
+
+        Khi broker chưa kết nối, circuit RabbitMQ đang mở hoặc publish lỗi, message
+        được spool vào extractor.PUBLISH_SPOOL (dùng chung với publish_invoice_data)
+        và được gửi lại theo batch sau lần publish thành công kế tiếp, hoặc bởi
+        thread retry nền của extractor khi không có traffic.
+        """
+        message_body = json.dumps(invoice_data, ensure_ascii=False)
+        if self.exchange is None:
+            logger.error("Cannot publish invoice data: broker is not connected, spooling message")
+            await _blocking(extractor._spool_message, message_body)
+            return
+
+        breaker = extractor.BREAKERS["rabbitmq"]
+        try:
+            breaker.before_call()
+        except CircuitOpenError as e:
+            logger.warning(f"{e}, spooling message")
+            await _blocking(extractor._spool_message, message_body)
+            return
+
+        try:
+            await self._publish_body(message_body, PUBLISH_ROUTING_KEY)
+        except Exception as e:
+            breaker.record_failure()
+            logger.error(f"Failed to publish message to RabbitMQ: {e}, spooling message")
+            await _blocking(extractor._spool_message, message_body)
+            return
+        breaker.record_success()
+        await self._drain_publish_spool()
+
+    async def _publish_body(self, body: str, routing_key: str):
+        await self.exchange.publish(
+            aio_pika.Message(
+                body.encode("utf-8"),
+                content_type="application/json",
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=routing_key,
+        )
+
+    async def _drain_publish_spool(self):
+        """Gửi lại tối đa SPOOL_DRAIN_BATCH message đã spool; dừng ở lỗi đầu tiên, phần còn lại trả về spool"""
+        records = await _blocking(extractor.PUBLISH_SPOOL.take)
+        batch = records[:extractor.SPOOL_DRAIN_BATCH]
+        for index, record in enumerate(batch):
+            try:
+                await self._publish_body(record["body"], record["routing_key"])
+            except Exception as e:
+                extractor.BREAKERS["rabbitmq"].record_failure()
+                logger.error(f"Re-publishing spooled messages failed: {e}")
+                await _blocking(extractor.PUBLISH_SPOOL.done, records[index:])
+                return
+        await _blocking(extractor.PUBLISH_SPOOL.done, records[len(batch):])
+        if batch:
+            logger.info(f"Re-published {len(batch)} spooled messages ({len(records) - len(batch)} left)")
+        if len(records) > len(batch):
+            extractor._start_spool_retry()
+
+    async def call_ms4_persistence(self, invoice_data):
+        """Gọi API MS4 để lưu metadata (async), cùng format kết quả và circuit breaker với bản blocking"""
+        breaker = extractor.BREAKERS["ms4"]
+        try:
+            breaker.before_call()
+        except CircuitOpenError as e:
+            return {
+                "service": "MS4",
+                "status": "error",
+                "message": str(e),
+                "retry_after": e.retry_after
+            }
+
+        url = f"{MS4_PERSISTENCE_BASE_URL}/invoice"
+        try:
+            async with self.session.post(url, json=invoice_data) as response:
+                # 4xx là lỗi của request, không phải MS4 đang lỗi
+                if response.status >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if response.status == 201:
+                    return {"service": "MS4", "status": "success", "message": "SQL persistence successful"}
+                return {
+                    "service": "MS4",
+                    "status": "error",
+                    "message": f"MS4 responded with {response.status}: {await response.text()}"
+                }
+        except aiohttp.ClientConnectionError:
+            breaker.record_failure()
+            return {
+                "service": "MS4",
+                "status": "error",
+                "message": "Failed to persist data due to connection error to MS4"
+            }
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.record_failure()
+            return {
+                "service": "MS4",
+                "status": "error",
+                "message": f"Request to MS4 failed: {str(e) or type(e).__name__}"
+            }
+        except asyncio.CancelledError:
+            # Request bị hủy không nói gì về MS4, chỉ trả lại slot probe
+            breaker.release()
+            raise
+
+    # ---------------- Queue ----------------
+
+    async def on_message(self, message):
+        """
+        Callback cho RABBITMQ_CONSUME_QUEUE, cùng quy tắc ack/nack với ms2_consumer.on_message.
+
+        Ack khi thành công hoặc bỏ qua; message lỗi format hoặc không trích xuất được
+        bị reject không requeue; exception khác được nack kèm requeue. Message chờ
+        slot của lane thay vì bị từ chối (prefetch đã giới hạn số message đang giữ).
+        Khi circuit của một dependency đang mở, message được giữ tới lúc circuit thử
+        lại rồi mới requeue.
+        """
+        await self._on_delivery(message, RABBITMQ_CONSUME_QUEUE, forward=bool(self.pdf_queue))
+
+    async def on_pdf_message(self, message):
+        """Callback cho pdf_queue"""
+        await self._on_delivery(message, self.pdf_queue, forward=False)
+
+    async def _on_delivery(self, message, queue: str, forward: bool):
+        arrived = time.monotonic()
+        try:
+            data = parse_message(message.body)
+        except ValueError as e:
+            logger.error(f"Rejecting malformed message {message.delivery_tag}: {e}")
+            await message.reject(requeue=False)
+            return
+
+        # Phân loại chỉ theo filename/content_type hoặc file trong ATTACH_DIR
+        lane = message_lane(data)
+        if forward and lane == "pdf":
+            await self.forward_to_pdf_queue(message)
+            return
+
+        if RECORDER:
+            await _blocking(RECORDER.record, KIND_QUEUE, data, queue=queue, lane=lane)
+
+        if "isInvoice" in data and not data["isInvoice"]:
+            logger.info(f"Skipping {data['email_id']}: email is not an invoice")
+            await message.ack()
+            return
+
+        try:
+            async with self.lanes[lane].admit(block=True, arrived=arrived):
+                result = await self.extract(data["email_id"], lane=lane, **_attachment_kwargs(data))
+        except ValueError as e:
+            logger.error(f"Rejecting message for {data['email_id']}: {e}")
+            await message.reject(requeue=False)
+            return
+        except CircuitOpenError as e:
+            logger.warning(f"{e}, holding message {message.delivery_tag} before requeueing")
+            await asyncio.sleep(e.retry_after)
+            await message.nack(requeue=True)
+            return
+        except Exception as e:
+            logger.error(f"Error processing message: {e}. Nacking message {message.delivery_tag}")
+            await message.nack(requeue=True)
+            return
+
+        if result:
+            await message.ack()
+        else:
+            logger.error(f"Extraction failed for {data['email_id']}, rejecting message")
+            await message.reject(requeue=False)
+
+    async def forward_to_pdf_queue(self, message):
+        """Chuyển message PDF sang pdf_queue (qua default exchange) rồi ack ở queue chính"""
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(
+                message.body,
+                content_type=message.content_type,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=self.pdf_queue,
+        )
+        await message.ack()
+
+    # ---------------- HTTP ----------------
+
+    async def handle_extract(self, request: web.Request):
+        """POST /extract, cùng request/response với Flask handler"""
+        try:
+            data = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            data = None
+        if not isinstance(data, dict):
+            data = {}
+
+        email_id = data.get("email_id")
+        if not email_id:
+            return _error("Missing required field: email_id", 400)
+        try:
+            extractor.check_email_id(email_id)
+        except ValueError as e:
+            return _error(str(e), 400)
+        if not data.get("isInvoice"):
+            return web.json_response({"status": "skipped", "message": "Email is not an invoice"}, status=200)
+
+        try:
+            kwargs = _attachment_kwargs(data)
+        except ValueError as e:
+            return _error(str(e), 400)
+        if kwargs and extractor.detect_content_type(kwargs["content"], kwargs["filename"], kwargs["content_type"]) is None:
+            return _unsupported_attachment(kwargs["filename"], kwargs["content_type"])
+
+        lane = classify(email_id, **kwargs)
+        if RECORDER:
+            await _blocking(RECORDER.record, KIND_HTTP, data, path="/extract", lane=lane)
+        return await self._process_request(email_id, lane, kwargs)
+
+    async def handle_upload(self, request: web.Request):
+        """POST /extract/upload (multipart, field "attachment"), đọc theo chunk và dừng khi quá giới hạn"""
+        fields = {}
+        content = filename = content_type = None
+        try:
+            reader = await request.multipart()
+        except (AssertionError, ValueError):
+            return _error("Expected multipart/form-data body", 400)
+
+        async for part in reader:
+            if part.name == "attachment":
+                filename = part.filename
+                content_type = part.headers.get(aiohttp.hdrs.CONTENT_TYPE)
+                buffer = bytearray()
+                while chunk := await part.read_chunk():
+                    buffer += chunk
+                    if len(buffer) > MAX_ATTACHMENT_BYTES:
+                        return _error(f"Attachment exceeds {MAX_ATTACHMENT_BYTES} bytes", 413)
+                content = bytes(buffer)
+            elif part.name:
+                fields[part.name] = await part.text()
+
+        email_id = fields.get("email_id")
+        if not email_id or content is None:
+            return _error("Missing required field: email_id or attachment", 400)
+        try:
+            extractor.check_email_id(email_id)
+        except ValueError as e:
+            return _error(str(e), 400)
+        if fields.get("isInvoice", "true").lower() not in ("1", "true", "yes"):
+            return web.json_response({"status": "skipped", "message": "Email is not an invoice"}, status=200)
+        if extractor.detect_content_type(content, filename, content_type) is None:
+            return _unsupported_attachment(filename, content_type)
+
+        lane = classify(email_id, content, filename, content_type)
+        persist = fields.get("persist", "false").lower() in ("1", "true", "yes")
+        if RECORDER:
+            # Ghi thành request /extract với attachment inline tương đương để loadgen replay được
+            await _blocking(RECORDER.record, KIND_HTTP, {
+                "email_id": email_id,
+                "isInvoice": True,
+                "persist": persist,
+                "attachment": extractor.encode_inline_attachment(content, filename, content_type),
+            }, path="/extract", lane=lane)
+        return await self._process_request(email_id, lane, {
+            "content": content,
+            "filename": filename,
+            "content_type": content_type,
+            "persist": persist,
+        })
+
+    async def handle_metrics(self, request: web.Request):
+        """Queue wait, in-flight và số request bị từ chối theo từng lane"""
+        return web.json_response({
+            "lanes": {name: lane.snapshot() for name, lane in self.lanes.items()},
+            "executors": {name: type(executor).__name__ for name, executor in self.executors.items()},
+            **{key: self.stats[key] for key in ("completed", "failed", "rejected")},
+        })
+
+    async def handle_health(self, request: web.Request):
+        """Trạng thái circuit breaker; 503 khi MS4 đang lỗi để load balancer chuyển traffic"""
+        report, status = health_report(extractor.BREAKERS, critical=extractor.CRITICAL_DEPENDENCIES)
+        report["spooled_messages"] = await _blocking(extractor.PUBLISH_SPOOL.pending)
+        return web.json_response(report, status=status)
+
+    async def _process_request(self, email_id: str, lane: str, kwargs: dict):
+        # Lane quá tải thì từ chối ngay thay vì để MS1 timeout
+        try:
+            async with self.lanes[lane].admit():
+                try:
+                    # MS4 đang lỗi thì không trích xuất vô ích
+                    extractor.BREAKERS["ms4"].check()
+                    invoice_data = await self.extract(email_id, lane=lane, **kwargs)
+                except CircuitOpenError as e:
+                    logger.warning(f"Fast-failing {email_id}: {e}")
+                    return _dependency_unavailable(str(e), e.name, e.retry_after)
+                except Exception as e:
+                    logger.error(f"Extraction failed for {email_id} with error: {e}")
+                    return _error(f"An exception occurred during extraction: {e}", 500)
+                if not invoice_data:
+                    return _error(f"Failed to extract invoice data for email_id: {email_id}", 500)
+
+                ms4_result = await self.call_ms4_persistence(invoice_data)
+        except AdmissionRejected as e:
+            self.stats["rejected"] += 1
+            logger.warning(f"Rejected {email_id}: {e} (retry after {e.retry_after}s)")
+            response = web.json_response({"status": "error", "message": e.reason, "lane": e.lane}, status=e.status_code)
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response
+
+        if ms4_result.get("retry_after"):
+            return _dependency_unavailable(ms4_result["message"], "ms4", ms4_result["retry_after"])
+        if ms4_result.get("status") == "error":
+            return _error(ms4_result.get("message", "Failed to persist data via MS4"), 500)
+        return web.json_response({
+            "status": "success",
+            "message": "Extraction and SQL persistence successful",
+            "details": {"ms4": ms4_result.get("message")}
+        }, status=201)
+
+
+async def _blocking(func, *args, **kwargs):
+    """
+    Chạy I/O file (spool, traffic recorder) trong thread executor mặc định của loop.
+
+    Không dùng executor của lane: đó có thể là process pool, nơi lock và file
+    handle của spool/recorder không dùng chung được.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def _attachment_kwargs(data: dict) -> dict:
+    """Giải mã attachment inline (nếu có) thành tham số cho AsyncExtractionService.extract"""
+    if not data.get("attachment"):
+        return {}
+    content, filename, content_type = extractor.decode_inline_attachment(data["attachment"])
+    return {"content": content, "filename": filename, "content_type": content_type,
+            "persist": bool(data.get("persist"))}
+
+
+def classify(email_id: str, content: bytes = None, filename: str = None, content_type: str = None, **_) -> str:
+    """Lane của một hóa đơn: "pdf" hoặc "xml" (mặc định, kể cả khi chưa nhận ra loại file)"""
+    if content is not None:
+        return extractor.detect_content_type(content, filename, content_type) or "xml"
+    return "pdf" if extractor.detect_attachment_type(email_id) == "pdf" else "xml"
+
+
+def _error(message: str, status: int):
+    return web.json_response({"status": "error", "message": message}, status=status)
+
+
+def _dependency_unavailable(message: str, name: str, retry_after: int):
+    """503 + Retry-After khi một dependency đang lỗi (circuit mở) để MS1 retry sau"""
+    response = web.json_response({"status": "error", "message": message, "dependency": name}, status=503)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def _unsupported_attachment(filename, content_type):
+    return _error(f"Unsupported attachment type: {filename} ({content_type}), expected XML or PDF", 415)
+
+
+SERVICE_KEY = web.AppKey("service", AsyncExtractionService)
+
+
+def create_app(service: AsyncExtractionService = None) -> web.Application:
+    """Tạo aiohttp app; broker và executor được mở/đóng theo vòng đời app"""
+    service = service or AsyncExtractionService()
+    # Giới hạn body: attachment base64 (~4/3 kích thước gốc) cộng phần JSON
+    app = web.Application(client_max_size=MAX_ATTACHMENT_BYTES * 4 // 3 + 64 * 1024)
+    app[SERVICE_KEY] = service
+    app.router.add_post("/extract", service.handle_extract)
+    app.router.add_post("/extract/upload", service.handle_upload)
+    app.router.add_get("/metrics", service.handle_metrics)
+    app.router.add_get("/health", service.handle_health)
+
+    async def on_startup(app):
+        await service.start()
+
+    async def on_cleanup(app):
+        await service.stop()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main():
+    web.run_app(create_app(), host=ASYNC_SERVICE_HOST, port=ASYNC_SERVICE_PORT)
+
+
+if __name__ == "__main__":
+    main()
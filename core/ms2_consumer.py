@@ -0,0 +1,297 @@
+import json
+import time
+import base64
+import binascii
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import pika
+from utils.config import (
+    RABBITMQ_CONSUME_QUEUE,
+    RABBITMQ_PDF_CONSUME_QUEUE,
+    CONSUMER_XML_WORKERS,
+    CONSUMER_PDF_WORKERS,
+    CONSUMER_PREFETCH,
+    TRAFFIC_RECORD_PATH,
+)
+from ms2_extractor.utils.rabbitmq import RabbitMQConnection
+from ms2_extractor.utils.admission import AdmissionController
+from ms2_extractor.utils.circuit_breaker import CircuitOpenError
+from ms2_extractor.utils.traffic import TrafficRecorder, KIND_QUEUE
+from ms2_extractor.core.ms2_invoice_extractor import (
+    extract_invoice_data,
+    extract_invoice_from_bytes,
+    check_email_id,
+    decode_inline_attachment,
+    detect_attachment_type,
+    detect_content_type,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Ghi lại message thật để replay bằng load generator
+RECORDER = TrafficRecorder(TRAFFIC_RECORD_PATH) if TRAFFIC_RECORD_PATH else None
+
+# Số worker của mỗi lane: XML map trong vài ms, PDF chờ model vài giây
+LANE_WORKERS = {"xml": CONSUMER_XML_WORKERS, "pdf": CONSUMER_PDF_WORKERS}
+# Chu kỳ log queue wait/in-flight theo lane (giây)
+METRICS_LOG_INTERVAL = 60
+
+
+def parse_message(body) -> dict:
+    """
+    Parse một message từ RABBITMQ_CONSUME_QUEUE.
+
+    Format:
+        {"email_id": "...", "isInvoice": true}                      -> đọc attachment từ ATTACH_DIR
+        {"email_id": "...", "isInvoice": true, "persist": false,
+         "attachment": {"filename": "x.pdf", "content_type": "application/pdf", "content_b64": "..."}}
+
+    Raises:
+        ValueError: Nếu message không phải JSON object, thiếu email_id hoặc email_id không hợp lệ
+    """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    try:
+        message = json.loads(body)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Message is not valid JSON: {e}")
+    if not isinstance(message, dict) or not message.get("email_id"):
+        raise ValueError("Message is missing required field: email_id")
+    check_email_id(message["email_id"])
+    return message
+
+
+def _inline_head(attachment: dict) -> bytes:
+    """Giải mã vài chục byte đầu của content_b64 (đủ cho magic bytes, "JVBER" là "%PDF") thay vì cả attachment."""
+    encoded = attachment.get("content_b64")
+    if not isinstance(encoded, str):
+        return b""
+    prefix = "".join(encoded[:128].split())
+    try:
+        return base64.b64decode(prefix[:len(prefix) // 4 * 4], validate=True)
+    except (binascii.Error, ValueError):
+        return b""
+
+
+def message_lane(message: dict) -> str:
+    """Phân loại message theo loại attachment ("xml"/"pdf") mà không parse nội dung."""
+    attachment = message.get("attachment")
+    if isinstance(attachment, dict):
+        hint = detect_content_type(_inline_head(attachment), attachment.get("filename"), attachment.get("content_type"))
+        if hint:
+            return hint
+    return "pdf" if detect_attachment_type(message["email_id"]) == "pdf" else "xml"
+
+
+def process_message(message: dict):
+    """Trích xuất hóa đơn từ message đã parse; trả về dữ liệu trích xuất hoặc None."""
+    email_id = message["email_id"]
+    attachment = message.get("attachment")
+    if attachment:
+        content, filename, content_type = decode_inline_attachment(attachment)
+        return extract_invoice_from_bytes(
+            email_id, content, filename, content_type, persist=bool(message.get("persist"))
+        )
+    return extract_invoice_data(email_id)
+
+
+def extraction_succeeded(message: dict) -> bool:
+    """
+    Trích xuất message đã parse; True thì ack, False thì nack không requeue
+    (message lỗi hoặc không trích xuất được, retry cũng không thành công).
+    Exception khác được để caller nack kèm requeue.
+    """
+    try:
+        result = process_message(message)
+    except ValueError as e:
+        logger.error(f"Rejecting message for {message['email_id']}: {e}")
+        return False
+    if not result:
+        logger.error(f"Extraction failed for {message['email_id']}, rejecting message")
+    return bool(result)
+
+
+def _parse_or_reject(ch, method, body):
+    try:
+        return parse_message(body)
+    except ValueError as e:
+        logger.error(f"Rejecting malformed message {method.delivery_tag}: {e}")
+        ch.basic_nack(method.delivery_tag, requeue=False)
+        return None
+
+
+def _skip_if_not_invoice(ch, method, message: dict) -> bool:
+    if "isInvoice" in message and not message["isInvoice"]:
+        logger.info(f"Skipping {message['email_id']}: email is not an invoice")
+        ch.basic_ack(method.delivery_tag)
+        return True
+    return False
+
+
+def on_message(ch, method, properties, body):
+    """
+    Callback cho RabbitMQConnection.consume, xử lý tuần tự trên thread của connection.
+
+    Ack khi thành công hoặc bỏ qua; message lỗi format hoặc không trích xuất được
+    bị nack không requeue (retry cũng không thành công). Khi một dependency đang lỗi
+    (circuit mở) thì tạm dừng tới lúc circuit thử lại rồi requeue. Exception khác
+    được để RabbitMQConnection nack kèm requeue.
+    """
+    message = _parse_or_reject(ch, method, body)
+    if message is None:
+        return
+
+    if RECORDER:
+        RECORDER.record(KIND_QUEUE, message, queue=RABBITMQ_CONSUME_QUEUE, lane=message_lane(message))
+
+    if _skip_if_not_invoice(ch, method, message):
+        return
+
+    try:
+        succeeded = extraction_succeeded(message)
+    except CircuitOpenError as e:
+        logger.warning(f"{e}, pausing before requeueing message {method.delivery_tag}")
+        # connection.sleep vẫn xử lý heartbeat trong lúc chờ
+        ch.connection.sleep(e.retry_after)
+        ch.basic_nack(method.delivery_tag, requeue=True)
+        return
+
+    if succeeded:
+        ch.basic_ack(method.delivery_tag)
+    else:
+        ch.basic_nack(method.delivery_tag, requeue=False)
+
+
+def _settle(ch, delivery_tag, outcome: str):
+    """Ack/nack trên thread của connection (pika không thread-safe)."""
+    if not ch.is_open:
+        logger.warning(f"Channel closed before settling message {delivery_tag}; broker will redeliver it")
+    elif outcome == "ack":
+        ch.basic_ack(delivery_tag)
+    else:
+        ch.basic_nack(delivery_tag, requeue=outcome == "requeue")
+
+
+class LaneConsumer:
+    """
+    Consumer chia message theo lane ("xml"/"pdf"), mỗi lane một thread pool và giới hạn riêng.
+
+    Message được phân loại trên thread của connection (chỉ xem filename/content_type
+    hoặc file trong ATTACH_DIR, không parse nội dung) rồi chạy trong executor của
+    lane, nên một loạt PDF chờ model không làm XML phía sau phải chờ. Ack/nack
+    theo cùng quy tắc với on_message.
+
+    Số message chưa ack được giới hạn bởi `prefetch` (basic_qos), nên backlog chờ
+    trong executor của các lane không vượt quá prefetch của mỗi queue.
+
+    Args:
+        workers: Số worker mỗi lane (mặc định LANE_WORKERS)
+        pdf_queue: Queue riêng của lane PDF (mặc định RABBITMQ_PDF_CONSUME_QUEUE);
+            message PDF đến RABBITMQ_CONSUME_QUEUE được chuyển sang queue này để
+            không giữ prefetch của queue chính. Message chỉ được ack sau khi
+            broker xác nhận đã nhận bản chuyển tiếp (publisher confirms)
+        prefetch: Số message chưa ack tối đa mỗi queue (mặc định CONSUMER_PREFETCH,
+            0 = 2 x tổng số worker)
+    """
+    def __init__(self, workers: dict = None, pdf_queue: str = RABBITMQ_PDF_CONSUME_QUEUE,
+                 prefetch: int = CONSUMER_PREFETCH):
+        workers = workers or LANE_WORKERS
+        self.pdf_queue = pdf_queue
+        self.prefetch = prefetch or 2 * sum(workers.values())
+        # Queue wait = từ lúc nhận message tới lúc worker của lane bắt đầu xử lý
+        self.lanes = {name: AdmissionController(name, max_inflight=count) for name, count in workers.items()}
+        self.executors = {
+            name: ThreadPoolExecutor(max_workers=count, thread_name_prefix=f"ms2-{name}")
+            for name, count in workers.items()
+        }
+
+    def on_message(self, ch, method, properties, body):
+        """Callback cho RABBITMQ_CONSUME_QUEUE"""
+        self._dispatch(ch, method, body, RABBITMQ_CONSUME_QUEUE, forward=bool(self.pdf_queue))
+
+    def on_pdf_message(self, ch, method, properties, body):
+        """Callback cho pdf_queue"""
+        self._dispatch(ch, method, body, self.pdf_queue, forward=False)
+
+    def _dispatch(self, ch, method, body, queue: str, forward: bool):
+        arrived = time.monotonic()
+        message = _parse_or_reject(ch, method, body)
+        if message is None:
+            return
+
+        lane = message_lane(message)
+        if forward and lane == "pdf":
+            try:
+                # Channel ở chế độ confirm: basic_publish chờ broker xác nhận trước khi ack
+                ch.basic_publish(
+                    exchange="",
+                    routing_key=self.pdf_queue,
+                    body=body,
+                    properties=pika.BasicProperties(delivery_mode=2),
+                    mandatory=True,
+                )
+            except (pika.exceptions.NackError, pika.exceptions.UnroutableError) as e:
+                logger.error(f"Forwarding message {method.delivery_tag} to '{self.pdf_queue}' failed: {e}, requeueing")
+                ch.basic_nack(method.delivery_tag, requeue=True)
+                return
+            ch.basic_ack(method.delivery_tag)
+            return
+
+        if RECORDER:
+            RECORDER.record(KIND_QUEUE, message, queue=queue, lane=lane)
+
+        if _skip_if_not_invoice(ch, method, message):
+            return
+        self.executors[lane].submit(self._run, ch, method.delivery_tag, message, lane, arrived)
+
+    def _run(self, ch, delivery_tag, message: dict, lane: str, arrived: float):
+        try:
+            with self.lanes[lane].admit(block=True, arrived=arrived):
+                outcome = "ack" if extraction_succeeded(message) else "reject"
+        except CircuitOpenError as e:
+            # Dừng worker của lane tới lúc circuit thử lại, tránh requeue rồi nhận lại liên tục
+            logger.warning(f"{e}, pausing lane '{lane}' before requeueing message {delivery_tag}")
+            time.sleep(e.retry_after)
+            outcome = "requeue"
+        except Exception as e:
+            logger.error(f"Error processing message: {e}. Nacking message {delivery_tag}")
+            outcome = "requeue"
+        ch.connection.add_callback_threadsafe(functools.partial(_settle, ch, delivery_tag, outcome))
+
+    def snapshot(self) -> dict:
+        return {name: lane.snapshot() for name, lane in self.lanes.items()}
+
+    def log_metrics(self, connection):
+        """Log metrics theo lane mỗi METRICS_LOG_INTERVAL giây (chạy trên thread của connection)"""
+        logger.info(f"Lane metrics: {json.dumps(self.snapshot())}")
+        connection.call_later(METRICS_LOG_INTERVAL, functools.partial(self.log_metrics, connection))
+
+    def shutdown(self, wait: bool = True):
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
+
+
+def main():
+    rmq = RabbitMQConnection()
+    consumer = LaneConsumer()
+    try:
+        rmq.connect()
+        # Giới hạn message broker đẩy tới; phần còn lại nằm trong queue thay vì trong executor
+        rmq.set_prefetch(consumer.prefetch)
+        if consumer.pdf_queue:
+            rmq.enable_confirms()
+            rmq.add_consumer(consumer.pdf_queue, consumer.on_pdf_message)
+        rmq.connection.call_later(METRICS_LOG_INTERVAL, functools.partial(consumer.log_metrics, rmq.connection))
+        rmq.consume(RABBITMQ_CONSUME_QUEUE, consumer.on_message)
+    except KeyboardInterrupt:
+        logger.info("Consumer stopped.")
+    finally:
+        # Message chưa ack được broker giao lại khi connection đóng
+        consumer.shutdown(wait=False)
+        rmq.close()
+
+
+if __name__ == "__main__":
+    main()
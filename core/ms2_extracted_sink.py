@@ -0,0 +1,367 @@
+"""
+Append-only columnar store of extracted invoices in EXTRACTED_DIR.
+
+Invoices are buffered in memory and flushed by a background thread into
+segment files: `headers-<seq>.npy` (one row per invoice) and `items-<seq>.npy`
+(one row per line item, `invoice_row` indexes into the same segment's
+headers). Both are NumPy structured arrays with fixed-width fields, so they
+can be opened with `np.load(path, mmap_mode="r")` and scanned without parsing.
+String widths in HEADER_DTYPE/ITEM_DTYPE are minimums: a segment widens a
+field to its longest value, so nothing is truncated. Segments are never
+modified after they are written; several processes may write to the same
+directory, each claiming sequence numbers with O_EXCL.
+
+    python -m ms2_extractor.core.ms2_extracted_sink summary
+    python -m ms2_extractor.core.ms2_extracted_sink republish
+    python -m ms2_extractor.core.ms2_extracted_sink reconcile
+"""
+import os
+import re
+import time
+import atexit
+import logging
+import argparse
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HEADER_DTYPE = np.dtype([
+    ("email_id", "U64"),
+    ("source", "U8"),
+    ("extracted_at", "f8"),
+    ("invoice_type", "U128"),
+    ("vendor_tax_code", "U20"),
+    ("vendor_name", "U256"),
+    ("vendor_address", "U256"),
+    ("buyer_tax_code", "U20"),
+    ("buyer_name", "U256"),
+    ("buyer_address", "U256"),
+    ("invoice_number", "U32"),
+    ("template_code", "U16"),
+    ("invoice_series", "U32"),
+    ("issued_date", "U32"),
+    ("currency_code", "U8"),
+    ("total_amount_before_vat", "f8"),
+    ("total_vat_amount", "f8"),
+    ("total_amount_after_vat", "f8"),
+    ("item_count", "i4"),
+])
+
+ITEM_DTYPE = np.dtype([
+    ("invoice_row", "i8"),
+    ("product_code", "U64"),
+    ("product_name", "U256"),
+    ("unit_name", "U32"),
+    ("quantity", "f8"),
+    ("unit_price", "f8"),
+    ("amount_before_vat", "f8"),
+    ("vat_rate", "f8"),
+    ("vat_amount", "f8"),
+    ("amount_after_vat", "f8"),
+    ("promotion_flag", "?"),
+])
+
+# Fields added by the sink, not part of the map_invoice output
+_HEADER_META = ("email_id", "source", "extracted_at", "item_count")
+_ITEM_META = ("invoice_row",)
+
+SEGMENT_PATTERN = re.compile(r"^headers-(\d{8})\.npy$")
+
+
+def _cell(value, kind: str):
+    """Coerce a dict value to a structured-array cell (missing/invalid -> zero value)."""
+    if kind == "U":
+        return "" if value is None else str(value)
+    if kind == "b":
+        return bool(value)
+    try:
+        return float(value) if kind == "f" else int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _segment_dtype(dtype: np.dtype, rows: list) -> np.dtype:
+    """Widen the string fields of `dtype` so every value in `rows` fits."""
+    fields = []
+    for index, name in enumerate(dtype.names):
+        field = dtype[name]
+        if field.kind == "U" and rows:
+            width = max(len(row[index]) for row in rows)
+            if width > field.itemsize // 4:
+                field = np.dtype(f"U{width}")
+        fields.append((name, field))
+    return np.dtype(fields)
+
+
+def _rows(records, dtype: np.dtype):
+    fields = [(name, dtype[name].kind) for name in dtype.names]
+    return [tuple(_cell(record.get(name), kind) for name, kind in fields) for record in records]
+
+
+def _segment_path(directory: str, kind: str, seq: int) -> str:
+    return os.path.join(directory, f"{kind}-{seq:08d}.npy")
+
+
+def list_segments(directory: str) -> list:
+    """Return the sequence numbers of complete segments, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    seqs = []
+    for name in names:
+        match = SEGMENT_PATTERN.match(name)
+        if match and os.path.exists(_segment_path(directory, "items", int(match.group(1)))):
+            seqs.append(int(match.group(1)))
+    return sorted(seqs)
+
+
+def load_segment(directory: str, seq: int, mmap: bool = True):
+    """Load one segment as (headers, items) structured arrays, memory-mapped by default."""
+    mode = "r" if mmap else None
+    headers = np.load(_segment_path(directory, "headers", seq), mmap_mode=mode)
+    items = np.load(_segment_path(directory, "items", seq), mmap_mode=mode)
+    return headers, items
+
+
+def iter_invoices(directory: str):
+    """
+    Rebuild invoice dicts from all segments.
+
+    Only the stored map_invoice fields are returned; the derived
+    vat_rate_summary/reconciliation are recomputed by the caller if needed.
+    """
+    header_fields = [n for n in HEADER_DTYPE.names if n not in _HEADER_META]
+    item_fields = [n for n in ITEM_DTYPE.names if n not in _ITEM_META]
+
+    for seq in list_segments(directory):
+        headers, items = load_segment(directory, seq)
+        # Items are written grouped by invoice, so each invoice is a contiguous slice
+        bounds = np.searchsorted(items["invoice_row"], np.arange(len(headers) + 1))
+        for row in range(len(headers)):
+            header = headers[row]
+            invoice = {name: header[name].item() for name in header_fields}
+            invoice["items"] = [
+                {name: item[name].item() for name in item_fields}
+                for item in items[bounds[row]:bounds[row + 1]]
+            ]
+            yield header["email_id"].item(), invoice
+
+
+class ExtractedSink:
+    """
+    Buffers extracted invoices and writes them to segment files in batches.
+
+    A segment is written when `batch_size` invoices are pending or every
+    `flush_interval` seconds, whichever comes first. The flusher thread starts
+    on the first append. While writes keep failing at most `max_pending`
+    invoices are held; older ones are dropped (and counted in `dropped`).
+    """
+    def __init__(self, directory: str, batch_size: int = 256, flush_interval: float = 5.0,
+                 max_pending: int = 10000):
+        self.directory = directory
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_pending = max(self.batch_size, max_pending)
+        self.dropped = 0
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._next_seq = None
+
+    def append(self, email_id: str, invoice: dict, source: str = ""):
+        """Queue one extracted invoice for the next segment."""
+        if not isinstance(invoice, dict):
+            return
+        with self._lock:
+            if self._stopped:
+                return
+            self._pending.append((email_id, source, time.time(), invoice))
+            self._trim_locked()
+            pending = len(self._pending)
+            if self._thread is None:
+                self._start_locked()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def _trim_locked(self):
+        excess = len(self._pending) - self.max_pending
+        if excess > 0:
+            # Store chỉ là bản sao (kết quả đã được publish): bỏ bản cũ nhất thay vì giữ vô hạn trong RAM
+            del self._pending[:excess]
+            self.dropped += excess
+            logger.error(f"Extracted store backlog over {self.max_pending} invoices, dropped the {excess} oldest "
+                         f"({self.dropped} dropped in total)")
+
+    def _start_locked(self):
+        self._thread = threading.Thread(target=self._run, name="extracted-sink", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush extracted invoices to {self.directory}: {e}")
+
+    def flush(self) -> int:
+        """
+        Write all pending invoices as one segment. Returns the number written.
+
+        If the write fails the batch goes back to the front of the pending
+        list (trimmed to `max_pending`) and the error is raised; the next
+        flush retries it.
+        """
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+
+        try:
+            seq, item_count = self._write_segment(batch)
+        except BaseException:
+            with self._lock:
+                self._pending[:0] = batch
+                self._trim_locked()
+            raise
+        logger.info(f"Wrote {len(batch)} invoices ({item_count} items) to segment {seq:08d}")
+        return len(batch)
+
+    def _write_segment(self, batch: list):
+        header_records = []
+        item_records = []
+        for row, (email_id, source, extracted_at, invoice) in enumerate(batch):
+            items = invoice.get("items") or []
+            header_records.append(dict(
+                invoice, email_id=email_id, source=source, extracted_at=extracted_at, item_count=len(items)
+            ))
+            item_records.extend(dict(item, invoice_row=row) for item in items if isinstance(item, dict))
+
+        header_rows = _rows(header_records, HEADER_DTYPE)
+        item_rows = _rows(item_records, ITEM_DTYPE)
+        headers = np.array(header_rows, dtype=_segment_dtype(HEADER_DTYPE, header_rows))
+        item_array = np.array(item_rows, dtype=_segment_dtype(ITEM_DTYPE, item_rows))
+
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            # Items first: a segment is only listed once its headers file exists
+            seq, items_file = self._claim_seq()
+            headers_path = _segment_path(self.directory, "headers", seq)
+            tmp_path = f"{headers_path}.tmp"
+            try:
+                with items_file:
+                    np.save(items_file, item_array)
+                # The claimed seq is ours alone, so the tmp name cannot collide
+                with open(tmp_path, "wb") as f:
+                    np.save(f, headers)
+                os.replace(tmp_path, headers_path)
+            except BaseException:
+                for path in (tmp_path, _segment_path(self.directory, "items", seq)):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                raise
+        return seq, len(item_array)
+
+    def _claim_seq(self):
+        """
+        Claim the next free sequence number by creating its items file with O_EXCL.
+
+        Other processes writing to the same directory claim theirs the same way,
+        so no writer can replace another's segment.
+        """
+        if self._next_seq is None:
+            existing = list_segments(self.directory)
+            self._next_seq = existing[-1] + 1 if existing else 0
+        while True:
+            seq = self._next_seq
+            self._next_seq += 1
+            path = _segment_path(self.directory, "items", seq)
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                continue
+            return seq, os.fdopen(fd, "wb")
+
+    def close(self):
+        """Stop the flusher thread and write whatever is still pending."""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+
+# ---------------- CLI ----------------
+
+def _summary(directory: str):
+    invoices = items = 0
+    total = 0.0
+    segments = list_segments(directory)
+    for seq in segments:
+        headers, item_array = load_segment(directory, seq)
+        invoices += len(headers)
+        items += len(item_array)
+        total += float(headers["total_amount_after_vat"].sum())
+    print(f"segments={len(segments)} invoices={invoices} items={items} total_amount_after_vat={total:.2f}")
+
+
+def _republish(directory: str):
+    from ms2_extractor.core.ms2_invoice_extractor import publish_invoice_data, _reconcile
+
+    count = 0
+    for email_id, invoice in iter_invoices(directory):
+        publish_invoice_data(_reconcile(invoice))
+        count += 1
+    print(f"Republished {count} invoices from {directory}")
+
+
+def _reconcile_store(directory: str):
+    from utils.config import RECONCILE_TOLERANCE, RECONCILE_RELATIVE_TOLERANCE
+    from ms2_extractor.core.ms2_reconciliation import reconcile_segment
+
+    invoices = mismatched = lines = 0
+    for seq in list_segments(directory):
+        headers, items = load_segment(directory, seq)
+        result = reconcile_segment(headers, items, RECONCILE_TOLERANCE, RECONCILE_RELATIVE_TOLERANCE)
+        line_counts = np.bincount(items["invoice_row"][result["line_mismatch"].any(axis=1)], minlength=len(headers))
+        bad = (line_counts > 0) | result["total_mismatch"].any(axis=1)
+        for row in np.flatnonzero(bad):
+            print(f"{headers['email_id'][row]} invoice={headers['invoice_number'][row]} "
+                  f"line_mismatches={line_counts[row]} totals={result['total_mismatch'][row].tolist()}")
+        invoices += len(headers)
+        mismatched += int(bad.sum())
+        lines += int(result["line_mismatch"].sum())
+    print(f"invoices={invoices} mismatched={mismatched} line_mismatches={lines}")
+
+
+def main():
+    from utils.config import EXTRACTED_DIR
+
+    parser = argparse.ArgumentParser(description="Inspect or replay the extracted-invoice store")
+    parser.add_argument("command", choices=["summary", "republish", "reconcile"])
+    parser.add_argument("--dir", default=EXTRACTED_DIR, help="Segment directory (default: EXTRACTED_DIR)")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        _summary(args.dir)
+    elif args.command == "reconcile":
+        _reconcile_store(args.dir)
+    else:
+        _republish(args.dir)
+
+
+if __name__ == "__main__":
+    main()
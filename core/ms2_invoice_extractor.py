@@ -1,16 +1,127 @@
 import os
+import io
+import re
 import json
+import time
+import threading
+import base64
+import binascii
 import xmltodict
-from utils.config import ATTACH_DIR, load_extraction_prompt, get_model
+from concurrent.futures import ThreadPoolExecutor
+from utils.config import (
+    ATTACH_DIR,
+    MAX_ATTACHMENT_BYTES,
+    EXTRACTED_DIR,
+    EXTRACTED_SINK_ENABLED,
+    EXTRACTED_BATCH_SIZE,
+    EXTRACTED_FLUSH_INTERVAL,
+    EXTRACTED_MAX_PENDING,
+    PROFILE_DIR,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_MAX_FILES,
+    RECONCILE_TOLERANCE,
+    RECONCILE_RELATIVE_TOLERANCE,
+    PDF_CHUNK_ROWS,
+    PDF_CHUNK_MIN_ROWS,
+    PDF_CHUNK_CONCURRENCY,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_OPEN_SECONDS,
+    CIRCUIT_HALF_OPEN_PROBES,
+    SPOOL_DIR,
+    SPOOL_DRAIN_BATCH,
+    SPOOL_RETRY_SECONDS,
+    load_extraction_prompt,
+    load_chunk_prompts,
+    load_xml_schemas,
+    get_model,
+)
 from pypdf import PdfReader
 from ms2_extractor.utils.rabbitmq import RabbitMQConnection
+from ms2_extractor.utils.profiling import SamplingProfiler
+from ms2_extractor.utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from ms2_extractor.utils.spool import LocalSpool
+from ms2_extractor.core.ms2_xml_mapper import XmlInvoiceMapper
+from ms2_extractor.core.ms2_extracted_sink import ExtractedSink
+from ms2_extractor.core.ms2_llm_output import (
+    GENERATION_CONFIG,
+    ITEMS_GENERATION_CONFIG,
+    InvalidModelOutput,
+    parse_invoice_output,
+    load_items_output,
+)
+from ms2_extractor.core.ms2_pdf_chunking import ChunkPlan, plan_extraction, merge_chunks
+from ms2_extractor.core.ms2_reconciliation import reconcile_invoice
+
+# Profiler dùng chung cho cả HTTP handler và consumer
+PROFILER = SamplingProfiler(PROFILE_DIR, sample_rate=PROFILE_SAMPLE_RATE, max_files=PROFILE_MAX_FILES)
+
+# Schema XML của các nhà cung cấp, biên dịch một lần khi khởi động
+XML_MAPPER = XmlInvoiceMapper(load_xml_schemas())
+
+# Số lần gọi model cho header hoặc một chunk bảng hàng hóa trước khi bỏ cuộc
+CHUNK_ATTEMPTS = 2
+
+# Pool dùng chung cho mọi hóa đơn chia chunk: số request model đồng thời của cả process
+# không vượt PDF_CHUNK_CONCURRENCY, kể cả khi nhiều PDF dài được xử lý cùng lúc
+CHUNK_POOL = ThreadPoolExecutor(max_workers=PDF_CHUNK_CONCURRENCY, thread_name_prefix="pdf-chunk")
+
+# Circuit breaker của các dependency, dùng chung cho HTTP handler, consumer và service asyncio
+BREAKERS = {
+    name: CircuitBreaker(
+        name,
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        open_seconds=CIRCUIT_OPEN_SECONDS,
+        half_open_probes=CIRCUIT_HALF_OPEN_PROBES,
+    )
+    for name in ("gemini", "ms4", "rabbitmq")
+}
+# Không có cách thay thế khi MS4 lỗi (/extract cần persist); Gemini/RabbitMQ lỗi chỉ làm
+# service "degraded": XML không cần model, message publish được spool lại
+CRITICAL_DEPENDENCIES = ("ms4",)
+
+# Message chưa publish được khi RabbitMQ lỗi; gửi lại theo batch sau lần publish thành
+# công kế tiếp và bởi thread retry nền (kể cả khi không có traffic)
+PUBLISH_SPOOL = LocalSpool(os.path.join(SPOOL_DIR, "publish.jsonl"))
+PUBLISH_EXCHANGE = "invoice_exchange"
+PUBLISH_ROUTING_KEY = "queue.for_persistence"
+
+# Lưu kết quả trích xuất dạng cột vào EXTRACTED_DIR (ghi theo batch ở background)
+EXTRACTED_SINK = ExtractedSink(
+    EXTRACTED_DIR, batch_size=EXTRACTED_BATCH_SIZE, flush_interval=EXTRACTED_FLUSH_INTERVAL,
+    max_pending=EXTRACTED_MAX_PENDING,
+) if EXTRACTED_SINK_ENABLED else None
+
+# email_id được dùng làm tên file trong ATTACH_DIR nên chỉ nhận ký tự an toàn
+EMAIL_ID_PATTERN = re.compile(r"[A-Za-z0-9_.-]+")
+
+
+def check_email_id(email_id):
+    """
+    Kiểm tra email_id từ request/message trước khi dùng làm tên file.
+
+    Raises:
+        ValueError: Nếu email_id rỗng, chứa ký tự ngoài EMAIL_ID_PATTERN hoặc ".."
+    """
+    if not isinstance(email_id, str) or not EMAIL_ID_PATTERN.fullmatch(email_id) or ".." in email_id:
+        raise ValueError(f"[ms3_invoiceExtraction]: Invalid email_id: {email_id!r}")
+
+
+def _attachment_path(email_id: str, source: str) -> str:
+    """Đường dẫn attachment trong ATTACH_DIR; ValueError nếu email_id thoát ra ngoài thư mục"""
+    check_email_id(email_id)
+    file_path = os.path.join(ATTACH_DIR, f"{email_id}.{source}")
+    root = os.path.realpath(ATTACH_DIR)
+    if os.path.commonpath([root, os.path.realpath(file_path)]) != root:
+        raise ValueError(f"[ms3_invoiceExtraction]: Invalid email_id: {email_id!r}")
+    return file_path
+
 
 # Ưu tiên trích xuất XML:
 def _load_xml_content(email_id: str):
     """Tải nội dung file XML đính kèm từ ATTACH_DIR."""
     # Lấy file XML từ ATTACH_DIR theo email_id
+    file_path = _attachment_path(email_id, "xml")
     try:
-        file_path = os.path.join(ATTACH_DIR, f"{email_id}.xml")
         with open(file_path, "rb") as f:
             file_content = f.read().strip()
             if not file_content:
@@ -25,18 +136,81 @@ def _load_xml_content(email_id: str):
         file_path = os.path.join(ATTACH_DIR, f"{email_id}.pdf")
         if not file_path:
             print("[ms3_invoiceExtraction]: None attachment found")
-        
-#----------------------------------------Logic trích xuất PDF --------------------------------------------------------    
-def _pdf_extraction_logic(file_path: str):
-    print(f"[ms3_pdfOCR]: Running PDF/OCR logic for {file_path}")
 
+
+def detect_attachment_type(email_id: str):
+    """Phân loại nhanh attachment ("xml", "pdf" hoặc None) mà không đọc nội dung file."""
+    if os.path.exists(_attachment_path(email_id, "xml")):
+        return "xml"
+    if os.path.exists(_attachment_path(email_id, "pdf")):
+        return "pdf"
+    return None
+
+
+def detect_content_type(content: bytes, filename: str = None, content_type: str = None):
+    """Phân loại attachment từ bytes ("xml", "pdf" hoặc None), ưu tiên magic bytes."""
+    head = content[:64].lstrip(b"\xef\xbb\xbf \t\r\n")
+    if head.startswith(b"%PDF"):
+        return "pdf"
+    if head.startswith(b"<"):
+        return "xml"
+    hint = f"{filename or ''} {content_type or ''}".lower()
+    if "pdf" in hint:
+        return "pdf"
+    if "xml" in hint:
+        return "xml"
+    return None
+
+
+def decode_inline_attachment(attachment: dict):
+    """
+    Giải mã attachment inline trong JSON body / queue message.
+
+    Format: {"filename": "x.pdf", "content_type": "application/pdf", "content_b64": "<base64>"}
+
+    Returns:
+        (content bytes, filename, content_type)
+
+    Raises:
+        ValueError: Nếu thiếu nội dung, base64 lỗi hoặc vượt MAX_ATTACHMENT_BYTES
+    """
+    if not isinstance(attachment, dict) or not attachment.get("content_b64"):
+        raise ValueError("attachment.content_b64 is required")
+    encoded = attachment["content_b64"]
+    # Kiểm tra kích thước trước khi decode để không cấp phát buffer quá lớn
+    if len(encoded) * 3 // 4 > MAX_ATTACHMENT_BYTES:
+        raise ValueError(f"Attachment exceeds {MAX_ATTACHMENT_BYTES} bytes")
+    try:
+        content = base64.b64decode("".join(encoded.split()), validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"Invalid base64 attachment: {e}")
+    return content, attachment.get("filename"), attachment.get("content_type")
+
+
+def encode_inline_attachment(content: bytes, filename: str = None, content_type: str = None) -> dict:
+    """Ngược lại của decode_inline_attachment (vd. ghi upload multipart thành body /extract tương đương)"""
+    return {
+        "filename": filename,
+        "content_type": content_type,
+        "content_b64": base64.b64encode(content).decode("ascii"),
+    }
+
+#----------------------------------------Logic trích xuất PDF --------------------------------------------------------
+def _plan_pdf_extraction(file_path):
+    """
+    Đọc toàn bộ text của PDF và lập kế hoạch gọi model (một request hoặc header + các chunk).
+
+    file_path có thể là đường dẫn, stream hoặc bytes.
+    """
     raw_data = None
     instruction = None
 
+    if isinstance(file_path, (bytes, bytearray)):
+        file_path = io.BytesIO(file_path)
     try:
         parsed_invoice = PdfReader(file_path)
-        page = parsed_invoice.pages[0]
-        raw_data = page.extract_text()
+        # Bảng hàng hóa dài tràn sang các trang sau
+        raw_data = "\n".join(page.extract_text() or "" for page in parsed_invoice.pages).strip()
     except Exception as e: 
         raise ValueError(f"[ms3_pdfParse]: Error during parsing PDF: {e}")
 
@@ -50,24 +224,116 @@ def _pdf_extraction_logic(file_path: str):
         print("[ms3_invoiceExtraction]: Missing raw_data or instruction, aborting.")
         return None
 
-    prompt = f"{instruction}\n  Here's the invoice:\n{raw_data}"
-    print("[ms3_invoiceExtraction]: Sending prompt to model...")
+    return plan_extraction(raw_data, instruction, load_chunk_prompts(), PDF_CHUNK_ROWS, PDF_CHUNK_MIN_ROWS)
+
+
+def _parse_model_response(respond: str):
+    """Parse output của model thành dict cùng dạng map_invoice; None nếu không sửa được"""
+    try:
+        extracted_invoice = parse_invoice_output(respond)
+    except InvalidModelOutput as e:
+        print(f"[ms3_invoiceExtraction]: Unusable model output: {e}")
+        return None
+    return _reconcile(extracted_invoice)
+
+
+def _reconcile(invoice: dict) -> dict:
+    """Gắn vat_rate_summary và kết quả đối chiếu dòng hàng với tổng tiền"""
+    reconcile_invoice(invoice, tolerance=RECONCILE_TOLERANCE, relative_tolerance=RECONCILE_RELATIVE_TOLERANCE)
+    if invoice["reconciliation"]["status"] != "ok":
+        print(f"[ms3_reconciliation]: Invoice {invoice.get('invoice_number')} does not reconcile: "
+              f"{invoice['reconciliation']['line_mismatch_count']} line mismatches, totals "
+              f"{[name for name, check in invoice['reconciliation']['totals'].items() if not check['matches']]}")
+    return invoice
+
+
+def _generate(model, prompt: str, generation_config: dict) -> str:
+    """Gọi model qua circuit breaker của Gemini; CircuitOpenError khi Gemini đang lỗi"""
+    with BREAKERS["gemini"].call():
+        return model.generate_content(prompt, generation_config=generation_config).text
+
+
+def _extract_part(model, prompt: str, generation_config: dict, parse, label: str):
+    """Gọi model và parse một phần hóa đơn; phần lỗi được thử lại riêng thay vì gọi lại cả hóa đơn"""
+    for attempt in range(1, CHUNK_ATTEMPTS + 1):
+        try:
+            return parse(_generate(model, prompt, generation_config))
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            print(f"[ms3_pdfChunk]: {label} extraction failed (attempt {attempt}/{CHUNK_ATTEMPTS}): {e}")
+    return None
+
+
+def _extract_header(model, prompt: str):
+    """Header của hóa đơn chia chunk (dict như parse_invoice_output) hoặc None"""
+    return _extract_part(model, prompt, GENERATION_CONFIG, parse_invoice_output, "Header")
+
+
+def _extract_chunk(model, prompt: str):
+    """Items thô của một chunk (list như load_items_output, ép kiểu khi ghép với header) hoặc None"""
+    return _extract_part(model, prompt, ITEMS_GENERATION_CONFIG, load_items_output, "Chunk")
+
+
+def _merge_chunk_results(plan: ChunkPlan, header: dict, chunk_items: list):
+    """Ghép header + các chunk đã parse; None nếu header hoặc một chunk không dùng được"""
+    if header is None:
+        print("[ms3_pdfChunk]: Header failed, aborting.")
+        return None
+    failed = sum(items is None for items in chunk_items)
+    if failed:
+        print(f"[ms3_pdfChunk]: {failed}/{len(plan.chunks)} chunks failed, aborting.")
+        return None
+    return _reconcile(merge_chunks(plan, header, chunk_items))
+
+
+def _run_chunked_plan(model, plan: ChunkPlan):
+    """Gọi header và các chunk song song trên CHUNK_POOL; thời gian chờ tỉ lệ với kích thước chunk thay vì số dòng hàng"""
+    header_future = CHUNK_POOL.submit(_extract_header, model, plan.header_prompt)
+    chunk_futures = [CHUNK_POOL.submit(_extract_chunk, model, prompt) for _, _, prompt in plan.chunks]
+    try:
+        header = header_future.result()
+        chunk_items = [future.result() for future in chunk_futures]
+    except BaseException:
+        # Không để các chunk chưa chạy chiếm pool khi hóa đơn đã thất bại
+        for future in chunk_futures:
+            future.cancel()
+        raise
+    return _merge_chunk_results(plan, header, chunk_items)
+
+
+def _pdf_extraction_logic(file_path):
+    """Trích xuất PDF qua model; file_path có thể là đường dẫn hoặc stream (BytesIO)"""
+    print(f"[ms3_pdfOCR]: Running PDF/OCR logic for {file_path if isinstance(file_path, str) else 'in-memory PDF'}")
+
+    plan = _plan_pdf_extraction(file_path)
+    if not plan:
+        return None
 
     try:
         model = get_model()
         if model is None:
             raise ValueError("Model is not loaded")
-        respond = model.generate_content(prompt, generation_config={"temperature": 0.0}).text.strip()
+        if plan.chunked:
+            print(f"[ms3_invoiceExtraction]: {plan.row_count} item rows, sending header + {len(plan.chunks)} chunks to model...")
+            extracted_invoice = _run_chunked_plan(model, plan)
+        else:
+            print("[ms3_invoiceExtraction]: Sending prompt to model...")
+            # Output JSON theo RESPONSE_SCHEMA thay vì text tự do
+            respond = _generate(model, plan.prompt, GENERATION_CONFIG)
+            extracted_invoice = _parse_model_response(respond)
         print("[ms3_invoiceExtraction]: Extraction completed.")
-        clean_text = respond.strip('`')
-        if clean_text.startswith('json'):
-            clean_text = clean_text[4:].strip()  
-        print(clean_text)
-        return clean_text
+    except CircuitOpenError:
+        # Để caller trả 503/requeue thay vì coi là trích xuất thất bại
+        raise
     except Exception as e:
         print(f"Error during redefining: {e}")
         return None
 
+    if extracted_invoice:
+        print(json.dumps(extracted_invoice, indent=2, ensure_ascii=False))
+    return extracted_invoice
+
 #------------------------------------------------------------------------------------------------------------------------------
 
 def map_invoice(file_content: str) -> dict:
@@ -77,79 +343,10 @@ def map_invoice(file_content: str) -> dict:
     
     print("[xmltoDict]: ==== Parsing XML ====")
     data = xmltodict.parse(file_content)
-    # print("[xmltoDict]: Top-level keys:", list(data.keys()))
-    
-    hdon = data.get("HDon", {})
-    dl = hdon.get("DLHDon", {})
-    ndhd = dl.get("NDHDon", {})
-    
-    ttchung = dl.get("TTChung", {})
-    nban = ndhd.get("NBan", {})
-    nmua = ndhd.get("NMua", {})
-    dshhdvu = ndhd.get("DSHHDVu", {}).get("HHDVu", [])
-    ttoan = ndhd.get("TToan", {})
-
-    if isinstance(dshhdvu, dict):
-        dshhdvu = [dshhdvu]
-
-    # Khởi tạo cấu trúc hóa đơn trích xuất
-    extractedInvoice = {
-        "invoice_type": ttchung.get("THDon", ""),
-        "vendor_tax_code": nban.get("MST", ""),
-        "vendor_name": nban.get("Ten", ""),
-        "vendor_address": nban.get("DChi", ""),
-        "buyer_tax_code": nmua.get("MST", ""),
-        "buyer_name": nmua.get("Ten", ""),
-        "buyer_address": nmua.get("DChi", ""),
-        "invoice_number": ttchung.get("SHDon", ""),
-        "template_code": ttchung.get("KHMSHDon", ""),
-        "invoice_series": ttchung.get("KHHDon", ""),
-        "issued_date": ttchung.get("NLap", ""),
-        "currency_code": ttchung.get("DVTTe", "VND"),
-        "total_amount_before_vat": float(ttoan.get("TgTCThue", 0)),
-        "total_vat_amount": float(ttoan.get("TgTThue", 0)),
-        "total_amount_after_vat": float(ttoan.get("TgTTTBSo", 0)),
-        "items": []
-    }
 
-    # Lặp qua các mặt hàng
-    for hh in dshhdvu:
-        ttin_list = hh.get("TTKhac", {}).get("TTin", [])
-        if isinstance(ttin_list, dict):
-            ttin_list = [ttin_list]
-        
-        vat_amount = 0
-        amount_after_vat = 0
-        promotion_flag = False
-        
-        for t in ttin_list:
-            ttruong = t.get("TTruong", "")
-            dl_val = t.get("DLieu", {})
-            
-            if ttruong == "Tiền thuế":
-                if isinstance(dl_val, (str, int, float)):
-                    vat_amount += float(dl_val)
-            elif ttruong == "TTMR" and isinstance(dl_val, dict):
-                amount_after_vat += float(dl_val.get("TTST", 0))
-                # Gắn cờ khuyến mãi nếu có trường KM = 1
-                km_value = dl_val.get("KM", "0")
-                if str(km_value).strip() in ("1", "True", "true"):
-                    promotion_flag = True
-
-        extractedItem = {
-            "product_code": hh.get("MHHDVu", ""),
-            "product_name": hh.get("THHDVu", ""),
-            "unit_name": hh.get("DVTinh", ""),
-            "quantity": float(hh.get("SLuong", 0)),
-            "unit_price": float(hh.get("DGia", 0)),
-            "amount_before_vat": float(hh.get("ThTien", 0)),
-            "vat_rate": float(hh.get("TSuat", "0").replace("%", "")),
-            "vat_amount": vat_amount,
-            "amount_after_vat": amount_after_vat,
-            "promotion_flag": promotion_flag
-        }
-        
-        extractedInvoice["items"].append(extractedItem)
+    # Nhận diện schema nhà cung cấp và map bằng accessor đã biên dịch sẵn;
+    # layout lạ raise UnknownLayoutError (ValueError) để message bị reject thay vì publish hóa đơn rỗng
+    extractedInvoice = _reconcile(XML_MAPPER.map(data))
 
     print("[xmltoDict]: ==== Extracted Invoice ====")
     print(json.dumps(extractedInvoice, indent=2, ensure_ascii=False))
@@ -157,59 +354,252 @@ def map_invoice(file_content: str) -> dict:
 
 
 def publish_invoice_data(invoice_data: dict):
-    """Serializes and publishes invoice data to RabbitMQ."""
+    """
+    Serializes and publishes invoice data to RabbitMQ.
+
+    While the RabbitMQ circuit is open, or when publishing fails, the message is
+    spooled to PUBLISH_SPOOL. Spooled messages are re-published in batches of
+    SPOOL_DRAIN_BATCH after the next successful publish and by a background
+    retry every SPOOL_RETRY_SECONDS.
+    """
     if not invoice_data:
         print("[ms2_publisher]: No invoice data to publish.")
         return
 
+    message_body = json.dumps(invoice_data, ensure_ascii=False)
+    breaker = BREAKERS["rabbitmq"]
+    try:
+        breaker.before_call()
+    except CircuitOpenError as e:
+        print(f"[ms2_publisher]: {e}, spooling message.")
+        _spool_message(message_body)
+        return
+
     rmq = None
     try:
         print("[ms2_publisher]: Initializing RabbitMQ connection...")
         rmq = RabbitMQConnection()
         rmq.connect()
 
-        message_body = json.dumps(invoice_data, ensure_ascii=False)
-        
         print("[ms2_publisher]: Publishing message to exchange 'invoice_exchange' with routing key 'queue.for_persistence'...")
         rmq.publish(
-            exchange='invoice_exchange',
-            routing_key='queue.for_persistence',
+            exchange=PUBLISH_EXCHANGE,
+            routing_key=PUBLISH_ROUTING_KEY,
             body=message_body
         )
+        breaker.record_success()
         print("[ms2_publisher]: Message published successfully.")
+        _drain_publish_spool(rmq)
 
     except Exception as e:
-        print(f"[ms2_publisher]: Failed to publish message to RabbitMQ: {e}")
-        # Optionally, re-raise the exception if the caller needs to handle it
-        # raise
+        breaker.record_failure()
+        print(f"[ms2_publisher]: Failed to publish message to RabbitMQ: {e}, spooling message.")
+        _spool_message(message_body)
     finally:
         if rmq:
             rmq.close()
 
 
+def _spool_message(message_body: str):
+    PUBLISH_SPOOL.append({"exchange": PUBLISH_EXCHANGE, "routing_key": PUBLISH_ROUTING_KEY, "body": message_body})
+    _start_spool_retry()
+
+
+def _drain_publish_spool(rmq) -> int:
+    """
+    Gửi lại tối đa SPOOL_DRAIN_BATCH message đã spool qua connection đang mở; dừng ở lỗi đầu tiên.
+    Phần còn lại được trả về spool cho lần drain sau. Trả về số message đã gửi.
+    """
+    records = PUBLISH_SPOOL.take()
+    batch = records[:SPOOL_DRAIN_BATCH]
+    for index, record in enumerate(batch):
+        try:
+            rmq.publish(exchange=record["exchange"], routing_key=record["routing_key"], body=record["body"])
+        except Exception as e:
+            BREAKERS["rabbitmq"].record_failure()
+            print(f"[ms2_publisher]: Re-publishing spooled messages failed: {e}")
+            PUBLISH_SPOOL.done(records[index:])
+            return index
+    PUBLISH_SPOOL.done(records[len(batch):])
+    if batch:
+        print(f"[ms2_publisher]: Re-published {len(batch)} spooled messages ({len(records) - len(batch)} left).")
+    if len(records) > len(batch):
+        _start_spool_retry()
+    return len(batch)
+
+
+def retry_publish_spool() -> int:
+    """Gửi lại một batch spool khi không có publish mới kích hoạt drain; trả về số message đã gửi"""
+    if not PUBLISH_SPOOL.pending():
+        return 0
+    breaker = BREAKERS["rabbitmq"]
+    try:
+        breaker.before_call()
+    except CircuitOpenError:
+        return 0
+
+    rmq = RabbitMQConnection()
+    try:
+        try:
+            rmq.connect()
+        except Exception as e:
+            breaker.record_failure()
+            print(f"[ms2_publisher]: Spool retry could not connect to RabbitMQ: {e}")
+            return 0
+        breaker.record_success()
+        return _drain_publish_spool(rmq)
+    finally:
+        rmq.close()
+
+
+_spool_retry_lock = threading.Lock()
+_spool_retry_thread = None
+
+
+def _start_spool_retry():
+    """Khởi động thread retry spool (một lần mỗi process) khi có message được spool"""
+    global _spool_retry_thread
+    if SPOOL_RETRY_SECONDS <= 0:
+        return
+    with _spool_retry_lock:
+        if _spool_retry_thread is None:
+            _spool_retry_thread = threading.Thread(target=_run_spool_retry, name="publish-spool-retry", daemon=True)
+            _spool_retry_thread.start()
+
+
+def _run_spool_retry():
+    while True:
+        time.sleep(SPOOL_RETRY_SECONDS)
+        try:
+            retry_publish_spool()
+        except Exception as e:
+            print(f"[ms2_publisher]: Spool retry failed: {e}")
+
+
+@PROFILER.profiled("extract_invoice_data")
 def extract_invoice_data(email_id: str):
     """Hàm điều phối trích xuất chung (XML, PDF, etc.)"""
-    if not isinstance(email_id, str) or not email_id:
-        raise ValueError(f"[ms3_invoiceExtraction]: Invalid email_id: {email_id}")
+    check_email_id(email_id)
     
     extracted_data = None
+    source = None
     # 1. Thử trích xuất XML trước
     xml_content = _load_xml_content(email_id)
     if xml_content:
         extracted_data = map_invoice(xml_content)
+        source = "xml"
     # 2. Tìm PDF nếu không có XML
     else:
         print(f"[ms3_invoiceExtraction]: No valid XML content found for {email_id}, trying PDF...")
-        pdf_path = os.path.join(ATTACH_DIR, f"{email_id}.pdf")
+        pdf_path = _attachment_path(email_id, "pdf")
         if os.path.exists(pdf_path):
             extracted_data = _pdf_extraction_logic(pdf_path)
+            source = "pdf"
         else:
             print(f"[ms3_invoiceExtraction]: No valid PDF attachment found for {email_id}")
 
+    return _finalize_extraction(email_id, extracted_data, source)
+
+
+def _finalize_extraction(email_id: str, extracted_data, source: str):
+    """Publish kết quả và ghi vào store cột; dùng chung cho mọi đường ingest"""
     if extracted_data:
         # Publish the extracted data to RabbitMQ
         publish_invoice_data(extracted_data)
+        _append_to_sink(email_id, extracted_data, source)
     else:
         print(f"[ms3_invoiceExtraction]: Extraction failed for {email_id}")
 
     return extracted_data
+
+
+def _append_to_sink(email_id: str, extracted_data, source: str):
+    """Ghi bản sao cột vào EXTRACTED_DIR để audit/re-publish không cần trích xuất lại"""
+    if EXTRACTED_SINK is not None:
+        EXTRACTED_SINK.append(email_id, extracted_data, source=source)
+
+
+def _persist_attachment(email_id: str, content: bytes, source: str):
+    """Ghi attachment vào ATTACH_DIR (ghi tạm rồi rename để reader không thấy file dở)"""
+    file_path = _attachment_path(email_id, source)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, file_path)
+    print(f"[ms3_invoiceExtraction]: Attachment persisted to {file_path}")
+
+
+@PROFILER.profiled("extract_invoice_from_bytes")
+def extract_invoice_from_bytes(email_id: str, content: bytes, filename: str = None,
+                               content_type: str = None, persist: bool = False):
+    """
+    Trích xuất trực tiếp từ bytes của attachment, không đọc lại từ shared storage.
+
+    Args:
+        email_id: ID email chứa hóa đơn
+        content: Nội dung file XML/PDF
+        filename: Tên file gốc (dùng khi không nhận diện được từ nội dung)
+        content_type: MIME type gốc
+        persist: Ghi thêm bản sao vào ATTACH_DIR
+    """
+    source = _validate_attachment(email_id, content, filename, content_type)
+
+    if source == "xml":
+        extracted_data = map_invoice(content.strip().decode("utf-8-sig"))
+    else:
+        extracted_data = _pdf_extraction_logic(io.BytesIO(content))
+
+    # Chỉ giữ bản sao của attachment trích xuất được
+    if persist and extracted_data:
+        _persist_attachment(email_id, content, source)
+    return _finalize_extraction(email_id, extracted_data, source)
+
+
+def _validate_attachment(email_id: str, content: bytes, filename: str = None, content_type: str = None) -> str:
+    """Kiểm tra attachment dạng bytes và trả về loại ("xml"/"pdf")"""
+    check_email_id(email_id)
+    if not content:
+        raise ValueError(f"[ms3_invoiceExtraction]: Empty attachment for {email_id}")
+    if len(content) > MAX_ATTACHMENT_BYTES:
+        raise ValueError(f"[ms3_invoiceExtraction]: Attachment exceeds {MAX_ATTACHMENT_BYTES} bytes")
+
+    source = detect_content_type(content, filename, content_type)
+    if source is None:
+        raise ValueError(f"[ms3_invoiceExtraction]: Unsupported attachment type for {email_id} ({filename}, {content_type})")
+    return source
+
+#----------------------------------------Bước CPU-bound cho service asyncio -------------------------------------------
+# Các hàm dưới đây chỉ làm phần parse (xmltodict/pypdf) và không gọi model/broker,
+# để service asyncio chạy chúng trong executor còn I/O thì await trên event loop.
+# Kết quả: ("xml", invoice dict) | ("pdf", ChunkPlan) | (None, None)
+
+def prepare_invoice(email_id: str):
+    """Đọc attachment từ ATTACH_DIR và chạy phần CPU-bound của pipeline"""
+    check_email_id(email_id)
+
+    xml_content = _load_xml_content(email_id)
+    if xml_content:
+        return "xml", map_invoice(xml_content)
+
+    pdf_path = _attachment_path(email_id, "pdf")
+    if os.path.exists(pdf_path):
+        return "pdf", _plan_pdf_extraction(pdf_path)
+
+    print(f"[ms3_invoiceExtraction]: No valid attachment found for {email_id}")
+    return None, None
+
+
+def prepare_invoice_from_bytes(email_id: str, content: bytes, filename: str = None,
+                               content_type: str = None, persist: bool = False):
+    """Như prepare_invoice nhưng nhận bytes của attachment"""
+    source = _validate_attachment(email_id, content, filename, content_type)
+
+    if source == "xml":
+        prepared = map_invoice(content.strip().decode("utf-8-sig"))
+    else:
+        prepared = _plan_pdf_extraction(content)
+
+    # Chỉ giữ bản sao của attachment parse được
+    if persist and prepared:
+        _persist_attachment(email_id, content, source)
+    return source, prepared
@@ -0,0 +1,319 @@
+import json
+import logging
+from ms2_extractor.core.ms2_xml_mapper import CONVERTERS, HEADER_FIELDS, ITEM_FIELDS, _to_percent, _to_flag
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidModelOutput(ValueError):
+    """Raised when the model output cannot be repaired into an invoice."""
+
+
+# ---------------- Invoice schema ----------------
+# Cùng key và kiểu với output của map_invoice (HEADER_FIELDS/ITEM_FIELDS của ms2_xml_mapper)
+
+# Default khác với default của kiểu dữ liệu
+FIELD_DEFAULTS = {"currency_code": "VND"}
+
+# Tên key model hay dùng thay cho key chuẩn
+FIELD_ALIASES = {"products": "items"}
+
+_SCHEMA_TYPES = {"str": "string", "float": "number", "percent": "number", "flag": "boolean"}
+
+
+def _object_schema(fields: dict) -> dict:
+    return {
+        "type": "object",
+        "properties": {name: {"type": _SCHEMA_TYPES[kind], "nullable": True} for name, kind in fields.items()},
+    }
+
+
+# Schema truyền vào generation_config; không có field bắt buộc để model bỏ qua
+# field không có trong hóa đơn thay vì sinh null cho từng field
+RESPONSE_SCHEMA = _object_schema(HEADER_FIELDS)
+RESPONSE_SCHEMA["properties"]["items"] = {"type": "array", "items": _object_schema(ITEM_FIELDS)}
+
+GENERATION_CONFIG = {
+    "temperature": 0.0,
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA,
+}
+
+# Chế độ chia nhỏ bảng hàng hóa: mỗi request chỉ trả về items, kèm số thứ tự
+# dòng (STT) để ghép và loại trùng giữa các chunk
+_CHUNK_ITEM_SCHEMA = _object_schema(ITEM_FIELDS)
+_CHUNK_ITEM_SCHEMA["properties"]["line_number"] = {"type": "integer", "nullable": True}
+ITEMS_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"items": {"type": "array", "items": _CHUNK_ITEM_SCHEMA}},
+}
+
+ITEMS_GENERATION_CONFIG = {
+    "temperature": 0.0,
+    "response_mime_type": "application/json",
+    "response_schema": ITEMS_RESPONSE_SCHEMA,
+}
+
+
+# ---------------- JSON repair ----------------
+
+_LITERALS = (("None", "null"), ("True", "true"), ("False", "false"), ("NaN", "null"))
+
+
+def _drop_trailing_comma(out: list):
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ",":
+        del out[i]
+
+
+def repair_json(text: str) -> str:
+    """
+    Cắt lấy object JSON đầu tiên trong text và sửa các lỗi hay gặp của model.
+
+    Sửa được: prose/code fence bao quanh, dấu phẩy thừa trước } hoặc ],
+    literal Python (None/True/False), xuống dòng trong string và output bị cắt
+    giữa chừng (bỏ phần tử cuối chưa hoàn chỉnh rồi đóng ngoặc).
+
+    Raises:
+        InvalidModelOutput: Nếu text không chứa object JSON
+    """
+    start = text.find("{")
+    if start < 0:
+        raise InvalidModelOutput("Model output contains no JSON object")
+
+    out = []
+    stack = []
+    # Vị trí cắt an toàn gần nhất (độ dài out, ngoặc đang mở) khi output bị cắt
+    safe = (0, [])
+    in_string = escape = False
+    i, n = start, len(text)
+    while i < n:
+        ch = text[i]
+        i += 1
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            elif ch == "\n":
+                ch = "\\n"
+            out.append(ch)
+            continue
+
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+            safe = (len(out), stack[:])
+            continue
+        elif ch in "}]":
+            _drop_trailing_comma(out)
+            out.append(stack.pop() if stack else ch)
+            if not stack:
+                return "".join(out)
+            safe = (len(out), stack[:])
+            continue
+        elif ch == ",":
+            safe = (len(out), stack[:])
+        elif ch.isalpha():
+            for literal, replacement in _LITERALS:
+                if text.startswith(literal, i - 1):
+                    out.append(replacement)
+                    i += len(literal) - 1
+                    break
+            else:
+                out.append(ch)
+            continue
+        out.append(ch)
+
+    # Output bị cắt: bỏ phần tử dở dang sau vị trí an toàn cuối cùng rồi đóng ngoặc
+    length, open_stack = safe
+    truncated = out[:length]
+    _drop_trailing_comma(truncated)
+    logger.warning("Model output was truncated, dropping the incomplete tail")
+    return "".join(truncated) + "".join(reversed(open_stack))
+
+
+# ---------------- Validation ----------------
+
+# Tiền VND không có phần lẻ nên "1.234" và "305.096" là số có dấu phân cách hàng nghìn
+MONEY_FIELDS = frozenset({
+    "total_amount_before_vat", "total_vat_amount", "total_amount_after_vat",
+    "unit_price", "amount_before_vat", "vat_amount", "amount_after_vat",
+})
+
+
+def _to_number(value, grouped: bool = False):
+    """
+    Số từ model: 3813696, "3,813,696", "3.813.696", "1.234,5", "305096 VND".
+
+    Một nhóm 3 chữ số sau "," luôn là hàng nghìn ("1,234" -> 1234); sau "." chỉ khi
+    grouped=True (số tiền VND), còn lại "." là dấu thập phân ("1.234" -> 1.234).
+    """
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = "".join(ch for ch in str(value) if ch.isdigit() or ch in ".,-")
+    if "." in text and "," in text:
+        # Dấu xuất hiện sau cùng là dấu thập phân
+        decimal = "." if text.rfind(".") > text.rfind(",") else ","
+        thousands = "," if decimal == "." else "."
+        text = text.replace(thousands, "").replace(decimal, ".")
+    else:
+        sep = "." if "." in text else ","
+        parts = text.split(sep)
+        if len(parts) > 2 or (len(parts) == 2 and len(parts[1]) == 3 and (sep == "," or grouped)):
+            text = text.replace(sep, "")
+        else:
+            text = text.replace(",", ".")
+    return float(text)
+
+
+_COERCE = {
+    "str": lambda value: str(value).strip(),
+    "float": _to_number,
+    "percent": lambda value: _to_number(value) if isinstance(value, (int, float)) else _to_percent(str(value)),
+    "flag": lambda value: value if isinstance(value, bool) else _to_flag(value),
+}
+
+
+def _is_vnd(currency) -> bool:
+    return str(currency or FIELD_DEFAULTS["currency_code"]).strip().upper() == "VND"
+
+
+def _coerce_fields(raw: dict, fields: dict, errors: list, currency=None) -> dict:
+    grouped = _is_vnd(currency)
+    result = {}
+    for name, kind in fields.items():
+        default = FIELD_DEFAULTS.get(name, CONVERTERS[kind][1])
+        value = raw.get(name)
+        if value is None or value == "":
+            result[name] = default
+            continue
+        try:
+            if grouped and name in MONEY_FIELDS:
+                result[name] = _to_number(value, grouped=True)
+            else:
+                result[name] = _COERCE[kind](value)
+        except (TypeError, ValueError):
+            errors.append(f"{name}={value!r}")
+            result[name] = default
+    return result
+
+
+def validate_invoice(raw) -> dict:
+    """
+    Chuẩn hóa object từ model về đúng key/kiểu của map_invoice.
+
+    Field thiếu nhận giá trị mặc định, field sai kiểu được ép kiểu (hoặc về mặc
+    định nếu không ép được), key thừa bị bỏ.
+
+    Raises:
+        InvalidModelOutput: Nếu không phải object hoặc không có dữ liệu hóa đơn nào
+    """
+    if not isinstance(raw, dict):
+        raise InvalidModelOutput(f"Expected a JSON object, got {type(raw).__name__}")
+    raw = {FIELD_ALIASES.get(key, key): value for key, value in raw.items()}
+
+    errors = []
+    currency = raw.get("currency_code")
+    invoice = _coerce_fields(raw, HEADER_FIELDS, errors, currency)
+
+    items = raw.get("items") or []
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list):
+        raise InvalidModelOutput(f"items must be a list, got {type(items).__name__}")
+    invoice["items"] = [_coerce_fields(item, ITEM_FIELDS, errors, currency) for item in items if isinstance(item, dict)]
+
+    if errors:
+        logger.warning(f"Invalid values replaced with defaults: {', '.join(errors)}")
+    if not invoice["items"] and not invoice["invoice_number"] and not invoice["total_amount_after_vat"]:
+        raise InvalidModelOutput("Model output contains no invoice data")
+    return invoice
+
+
+def _load_json(text: str):
+    if not text or not text.strip():
+        raise InvalidModelOutput("Model output is empty")
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        try:
+            return json.loads(repair_json(text))
+        except json.JSONDecodeError as e:
+            raise InvalidModelOutput(f"Model output is not repairable JSON: {e}")
+
+
+def parse_invoice_output(text: str) -> dict:
+    """
+    Parse output của model thành dict hóa đơn cùng dạng với map_invoice.
+
+    Thử json.loads trước (output theo schema thường hợp lệ), chỉ sửa khi lỗi.
+
+    Raises:
+        InvalidModelOutput: Nếu output không sửa được hoặc không có dữ liệu hóa đơn
+    """
+    return validate_invoice(_load_json(text))
+
+
+def _to_line_number(value):
+    try:
+        return int(_to_number(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def load_items_output(text: str) -> list:
+    """
+    Parse output của một chunk bảng hàng hóa (ITEMS_RESPONSE_SCHEMA) nhưng chưa ép kiểu.
+
+    Chunk được gọi song song với header nên chưa biết currency; số tiền được ép
+    kiểu khi ghép chunk (coerce_items với currency_code của header).
+
+    Returns:
+        [(line_number hoặc None, item dict thô của model), ...]
+
+    Raises:
+        InvalidModelOutput: Nếu output không sửa được hoặc không có items
+    """
+    raw = _load_json(text)
+    if isinstance(raw, dict):
+        raw = {FIELD_ALIASES.get(key, key): value for key, value in raw.items()}
+        raw = raw.get("items")
+    if not isinstance(raw, list):
+        raise InvalidModelOutput("Model output contains no items array")
+
+    items = [(_to_line_number(item.get("line_number")), item) for item in raw if isinstance(item, dict)]
+    if not items:
+        raise InvalidModelOutput("Model output contains no items")
+    return items
+
+
+def coerce_items(items: list, currency=None) -> list:
+    """Ép kiểu item dict thô về dạng map_invoice; số tiền được hiểu theo `currency` (mặc định VND)."""
+    errors = []
+    coerced = [_coerce_fields(item, ITEM_FIELDS, errors, currency) for item in items]
+    if errors:
+        logger.warning(f"Invalid values replaced with defaults: {', '.join(errors)}")
+    return coerced
+
+
+def parse_items_output(text: str, currency=None) -> list:
+    """
+    Parse và ép kiểu output của một chunk bảng hàng hóa.
+
+    Returns:
+        [(line_number hoặc None, item dict cùng dạng map_invoice), ...]
+
+    Raises:
+        InvalidModelOutput: Nếu output không sửa được hoặc không có items
+    """
+    items = load_items_output(text)
+    return list(zip((line_number for line_number, _ in items), coerce_items([item for _, item in items], currency)))
@@ -0,0 +1,149 @@
+"""
+Chia bảng hàng hóa dài của PDF thành các chunk theo dòng để trích xuất song song.
+
+Văn bản PDF được tách thành phần đầu (thông tin người bán/người mua, tiêu đề
+cột), các dòng hàng (nhận diện theo cột STT tăng dần 1, 2, 3, ...) và phần
+cuối (tổng tiền). Header được trích xuất một lần từ phần đầu + phần cuối; mỗi
+chunk chỉ chứa tiêu đề cột và PDF_CHUNK_ROWS dòng hàng. Kết quả được ghép theo
+STT, bỏ dòng trùng hoặc nằm ngoài chunk.
+"""
+import re
+import logging
+from ms2_extractor.core.ms2_llm_output import coerce_items
+
+logger = logging.getLogger(__name__)
+
+# Dòng bắt đầu bằng số thứ tự (STT) của bảng hàng hóa: "12 ", "12.", "12)", "12|"
+ROW_START = re.compile(r"^\s*(\d{1,5})(?=[\s.)|]|$)")
+# Dòng đầu tiên của phần tổng tiền sau bảng hàng hóa
+FOOTER_START = re.compile(
+    r"(cộng tiền hàng|tổng cộng|tổng tiền|tổng số tiền|thuế suất gtgt|sub ?total|total amount)",
+    re.IGNORECASE,
+)
+# Số dòng cuối của phần đầu (tiêu đề cột) được lặp lại trong mỗi chunk
+HEADING_CONTEXT_LINES = 3
+
+
+class ChunkPlan:
+    """
+    Các prompt cần gửi cho một PDF.
+
+    Không chia: chỉ có `prompt`. Chia chunk: `header_prompt` cho thông tin chung
+    và `chunks` = [(STT đầu, STT cuối, prompt), ...] cho các dòng hàng.
+    """
+    def __init__(self, prompt: str = None, header_prompt: str = None, chunks=None, row_count: int = 0):
+        self.prompt = prompt
+        self.header_prompt = header_prompt
+        self.chunks = list(chunks or [])
+        self.row_count = row_count
+
+    @property
+    def chunked(self) -> bool:
+        return bool(self.chunks)
+
+
+def _longest_row_run(lines: list) -> list:
+    """Vị trí các dòng của chuỗi STT 1, 2, 3, ... dài nhất (bỏ qua địa chỉ "1 Nguyễn Trãi" ở phần đầu)."""
+    best, current = [], []
+    for index, line in enumerate(lines):
+        match = ROW_START.match(line)
+        if not match:
+            continue
+        number = int(match.group(1))
+        if number == len(current) + 1:
+            current.append(index)
+        elif number == 1:
+            if len(current) > len(best):
+                best = current
+            current = [index]
+    return current if len(current) > len(best) else best
+
+
+def split_item_rows(text: str):
+    """
+    Tách văn bản hóa đơn thành (dòng phần đầu, các dòng hàng, dòng phần cuối).
+
+    Một dòng hàng có thể kéo dài nhiều dòng văn bản (tên hàng bị xuống dòng);
+    chunk luôn được cắt ở đầu một dòng hàng.
+    """
+    lines = text.splitlines()
+    starts = _longest_row_run(lines)
+    if not starts:
+        return lines, [], []
+
+    end = len(lines)
+    for index in range(starts[-1] + 1, len(lines)):
+        if FOOTER_START.search(lines[index]):
+            end = index
+            break
+    rows = ["\n".join(lines[start:stop]) for start, stop in zip(starts, starts[1:] + [end])]
+    return lines[:starts[0]], rows, lines[end:]
+
+
+def plan_extraction(text: str, instruction: str, prompts: dict, rows_per_chunk: int, min_rows: int) -> ChunkPlan:
+    """
+    Lập kế hoạch trích xuất: một request nếu bảng hàng ngắn, ngược lại header + các chunk.
+
+    Args:
+        text: Văn bản của toàn bộ PDF
+        instruction: extractor_instruction
+        prompts: {"header_only": ..., "items_only": ...} (load_chunk_prompts)
+        rows_per_chunk: Số dòng hàng mỗi chunk
+        min_rows: Chỉ chia khi bảng hàng có nhiều hơn min_rows dòng
+    """
+    header, rows, footer = split_item_rows(text)
+    if len(rows) <= min_rows:
+        return ChunkPlan(prompt=f"{instruction}\n  Here's the invoice:\n{text}", row_count=len(rows))
+
+    header_text = "\n".join(header + [f"... ({len(rows)} item rows omitted) ..."] + footer)
+    context = "\n".join(header[-HEADING_CONTEXT_LINES:])
+    chunks = []
+    for start in range(0, len(rows), rows_per_chunk):
+        block = rows[start:start + rows_per_chunk]
+        first, last = start + 1, start + len(block)
+        chunks.append((
+            first,
+            last,
+            f"{instruction}\n{prompts['items_only'].format(first=first, last=last)}\n"
+            f"  Column headings:\n{context}\n  Rows:\n" + "\n".join(block),
+        ))
+    return ChunkPlan(
+        header_prompt=f"{instruction}\n{prompts['header_only']}\n  Here's the invoice:\n{header_text}",
+        chunks=chunks,
+        row_count=len(rows),
+    )
+
+
+def merge_chunks(plan: ChunkPlan, header: dict, chunk_items: list) -> dict:
+    """
+    Ghép header và items của các chunk thành một hóa đơn.
+
+    Args:
+        plan: ChunkPlan đã dùng để gọi model
+        header: Kết quả parse_invoice_output của header_prompt
+        chunk_items: Kết quả load_items_output của từng chunk (cùng thứ tự plan.chunks)
+
+    Item có STT trùng hoặc nằm ngoài khoảng của chunk (model lặp lại dòng tiêu
+    đề/dòng của chunk khác) bị bỏ; item không có STT giữ nguyên vị trí trong chunk.
+    Số tiền của item được ép kiểu theo currency_code của header.
+    """
+    merged = []
+    seen = set()
+    dropped = 0
+    for chunk_index, ((first, last, _), items) in enumerate(zip(plan.chunks, chunk_items)):
+        for position, (line_number, item) in enumerate(items):
+            if line_number is not None:
+                if not first <= line_number <= last or line_number in seen:
+                    dropped += 1
+                    continue
+                seen.add(line_number)
+            merged.append(((chunk_index, line_number if line_number is not None else first + position), item))
+    merged.sort(key=lambda entry: entry[0])
+
+    invoice = dict(header)
+    invoice["items"] = coerce_items([item for _, item in merged], header.get("currency_code"))
+    if dropped:
+        logger.warning(f"Dropped {dropped} duplicate or out-of-range items while merging chunks")
+    if len(invoice["items"]) != plan.row_count:
+        logger.warning(f"Merged {len(invoice['items'])} items from {plan.row_count} detected rows")
+    return invoice
@@ -0,0 +1,332 @@
+"""
+Vectorized reconciliation of invoice line items against the invoice totals.
+
+Item columns are loaded into one float matrix (one row per line item, an
+`owner` array maps rows to invoices), so line checks, per-invoice sums and the
+per-VAT-rate summary are a handful of NumPy operations regardless of how many
+lines or invoices are reconciled at once.
+
+Line checks (skipped when the inputs are missing, i.e. zero):
+    amount_before_vat ~ quantity * unit_price
+    vat_amount        ~ amount_before_vat * vat_rate / 100
+    amount_after_vat  ~ amount_before_vat + vat_amount
+
+Many invoices (e.g. TT78 XML without the TTKhac block) only carry
+amount_before_vat and vat_rate per line. A missing vat_amount is derived as
+amount_before_vat * vat_rate / 100 and a missing amount_after_vat as
+amount_before_vat + vat_amount; the per-rate summary and item sums use the
+derived values.
+
+Total checks (skipped when the invoice total is missing, or when the item
+column is missing on every line of the invoice):
+    sum(items.amount_before_vat) ~ total_amount_before_vat
+    sum(items.vat_amount)        ~ total_vat_amount
+    sum(items.amount_after_vat)  ~ total_amount_after_vat
+
+A value matches when |actual - expected| <= tolerance + relative_tolerance * |expected|.
+
+`reconcile_invoice` checks invoices below SMALL_INVOICE_LINES lines with a
+plain Python loop instead: the NumPy setup costs more than the arithmetic for
+a typical invoice. Both paths produce the same result.
+"""
+import math
+import operator
+import itertools
+import numpy as np
+
+ITEM_COLUMNS = ("quantity", "unit_price", "amount_before_vat", "vat_rate", "vat_amount", "amount_after_vat")
+QUANTITY, UNIT_PRICE, BEFORE_VAT, VAT_RATE, VAT_AMOUNT, AFTER_VAT = range(len(ITEM_COLUMNS))
+
+# Field checked on each line, in the column order of the line check matrices
+LINE_FIELDS = ("amount_before_vat", "vat_amount", "amount_after_vat")
+# (item column summed, invoice total it must match)
+TOTAL_FIELDS = (
+    ("amount_before_vat", "total_amount_before_vat"),
+    ("vat_amount", "total_vat_amount"),
+    ("amount_after_vat", "total_amount_after_vat"),
+)
+
+DEFAULT_TOLERANCE = 1.0
+DEFAULT_RELATIVE_TOLERANCE = 1e-3
+# Discrepant lines listed per invoice; the full count is always reported
+MAX_REPORTED_LINES = 20
+# Dưới ngưỡng này reconcile_invoice dùng vòng lặp Python (chi phí khởi tạo NumPy lớn hơn phép tính)
+SMALL_INVOICE_LINES = 100
+
+_get_columns = operator.itemgetter(*ITEM_COLUMNS)
+
+
+def _to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def item_matrix(items: list) -> np.ndarray:
+    """Load item dicts into an (n, len(ITEM_COLUMNS)) float64 matrix."""
+    try:
+        flat = itertools.chain.from_iterable(map(_get_columns, items))
+        values = np.fromiter(flat, dtype=np.float64, count=len(items) * len(ITEM_COLUMNS))
+    except (KeyError, TypeError, ValueError):
+        # Item thiếu field hoặc giá trị không phải số: chậm hơn nhưng không lỗi
+        values = np.array(
+            [[_to_float(item.get(column)) for column in ITEM_COLUMNS] for item in items],
+            dtype=np.float64,
+        )
+    return values.reshape(len(items), len(ITEM_COLUMNS))
+
+
+def _within(actual, expected, tolerance: float, relative_tolerance: float):
+    return np.abs(actual - expected) <= tolerance + relative_tolerance * np.abs(expected)
+
+
+def reconcile_arrays(values: np.ndarray, owner: np.ndarray, totals: np.ndarray,
+                     tolerance: float = DEFAULT_TOLERANCE,
+                     relative_tolerance: float = DEFAULT_RELATIVE_TOLERANCE) -> dict:
+    """
+    Reconcile a batch of invoices given as arrays.
+
+    Args:
+        values: (n, len(ITEM_COLUMNS)) item matrix, rows grouped or not by invoice
+        owner: (n,) invoice index of each item row
+        totals: (m, len(TOTAL_FIELDS)) invoice totals
+        tolerance, relative_tolerance: Match threshold (see module docstring)
+
+    Returns:
+        dict of arrays:
+            line_expected, line_actual: (n, 3) in LINE_FIELDS order
+            line_mismatch: (n, 3) bool
+            item_sums, total_mismatch: (m, 3) in TOTAL_FIELDS order
+            rate_owner, rate_value, rate_before_vat, rate_vat_amount, rate_after_vat:
+                one entry per (invoice, VAT rate) pair, sorted by invoice then rate
+    """
+    count = len(totals)
+    quantity = values[:, QUANTITY]
+    unit_price = values[:, UNIT_PRICE]
+    before = values[:, BEFORE_VAT]
+    rate = values[:, VAT_RATE]
+    vat = values[:, VAT_AMOUNT]
+    after = values[:, AFTER_VAT]
+
+    has_vat = vat != 0
+    has_after = after != 0
+    # Dòng thiếu tiền thuế/thành tiền sau thuế: suy ra từ thuế suất thay vì coi là 0
+    vat = np.where(has_vat, vat, before * rate / 100.0)
+    after = np.where(has_after, after, before + vat)
+
+    line_expected = np.column_stack((quantity * unit_price, before * rate / 100.0, before + vat))
+    line_actual = np.column_stack((before, vat, after))
+    line_checked = np.column_stack(((quantity != 0) & (unit_price != 0), has_vat, has_after))
+    line_mismatch = line_checked & ~_within(line_actual, line_expected, tolerance, relative_tolerance)
+
+    item_sums = np.column_stack([
+        np.bincount(owner, weights=column, minlength=count) for column in (before, vat, after)
+    ])
+    # Tổng chỉ được so khi ít nhất một dòng của hóa đơn có cột tương ứng
+    column_present = np.column_stack([
+        np.bincount(owner, weights=present, minlength=count) > 0
+        for present in (before != 0, has_vat, has_after)
+    ]).reshape(count, len(TOTAL_FIELDS))
+    total_mismatch = (totals != 0) & column_present & ~_within(totals, item_sums, tolerance, relative_tolerance)
+
+    # Nhóm theo cặp (hóa đơn, thuế suất): chỉ có vài thuế suất nên khóa
+    # owner * số_thuế_suất + chỉ_số_thuế_suất đủ nhỏ để dùng bincount thay vì sort
+    rates, rate_index = np.unique(rate, return_inverse=True)
+    key = owner * len(rates) + rate_index.ravel()
+    slots = count * len(rates)
+    present = np.flatnonzero(np.bincount(key, minlength=slots))
+
+    def per_rate(column):
+        return np.bincount(key, weights=column, minlength=slots)[present]
+
+    return {
+        "line_expected": line_expected,
+        "line_actual": line_actual,
+        "line_mismatch": line_mismatch,
+        "item_sums": item_sums,
+        "total_mismatch": total_mismatch,
+        "rate_owner": present // max(len(rates), 1),
+        "rate_value": rates[present % max(len(rates), 1)],
+        "rate_before_vat": per_rate(before),
+        "rate_vat_amount": per_rate(vat),
+        "rate_after_vat": per_rate(after),
+    }
+
+
+def _rate_label(rate: float) -> str:
+    return f"{rate:g}%"
+
+
+def reconcile_invoices(invoices: list, tolerance: float = DEFAULT_TOLERANCE,
+                       relative_tolerance: float = DEFAULT_RELATIVE_TOLERANCE) -> list:
+    """
+    Reconcile several invoice dicts (map_invoice shape) in one vectorized pass.
+
+    Adds `vat_rate_summary` ({"10%": vat_amount, ...}) and `reconciliation` to
+    each invoice in place and returns the list.
+    """
+    if not invoices:
+        return invoices
+    item_lists = [invoice.get("items") or [] for invoice in invoices]
+    counts = np.fromiter(map(len, item_lists), dtype=np.intp, count=len(item_lists))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    values = item_matrix(list(itertools.chain.from_iterable(item_lists)))
+    owner = np.repeat(np.arange(len(invoices)), counts)
+    totals = np.array(
+        [[_to_float(invoice.get(field)) for _, field in TOTAL_FIELDS] for invoice in invoices],
+        dtype=np.float64,
+    ).reshape(len(invoices), len(TOTAL_FIELDS))
+
+    result = reconcile_arrays(values, owner, totals, tolerance, relative_tolerance)
+
+    # Chỉ các dòng lệch mới được chuyển về Python; phần còn lại đổi sang list một lần
+    bad_rows, bad_fields = np.nonzero(result["line_mismatch"])
+    bad_owner = owner[bad_rows]
+    bad_counts = np.bincount(bad_owner, minlength=len(invoices)).tolist()
+    bad_bounds = np.searchsorted(bad_owner, np.arange(len(invoices) + 1)).tolist()
+    rate_bounds = np.searchsorted(result["rate_owner"], np.arange(len(invoices) + 1)).tolist()
+
+    labels = {rate: _rate_label(rate) for rate in np.unique(result["rate_value"]).tolist()}
+    rate_labels = [labels[rate] for rate in result["rate_value"].tolist()]
+    rate_amounts = np.round(result["rate_vat_amount"], 2).tolist()
+
+    item_sums = np.round(result["item_sums"], 2).tolist()
+    differences = np.round(totals - result["item_sums"], 2).tolist()
+    total_matches = (~result["total_mismatch"]).tolist()
+    invoice_totals = totals.tolist()
+
+    bad_lines = (bad_rows - offsets[bad_owner]).tolist()
+    bad_expected = np.round(result["line_expected"][bad_rows, bad_fields], 2).tolist()
+    bad_actual = result["line_actual"][bad_rows, bad_fields].tolist()
+    bad_fields = bad_fields.tolist()
+
+    for index, invoice in enumerate(invoices):
+        start, end = rate_bounds[index], rate_bounds[index + 1]
+        invoice["vat_rate_summary"] = dict(zip(rate_labels[start:end], rate_amounts[start:end]))
+
+        start = bad_bounds[index]
+        lines = [
+            {
+                "line": bad_lines[position],
+                "field": LINE_FIELDS[bad_fields[position]],
+                "expected": bad_expected[position],
+                "actual": bad_actual[position],
+            }
+            for position in range(start, min(bad_bounds[index + 1], start + MAX_REPORTED_LINES))
+        ]
+
+        total_checks = {
+            total_field: {
+                "items": item_sums[index][column],
+                "invoice": invoice_totals[index][column],
+                "difference": differences[index][column],
+                "matches": total_matches[index][column],
+            }
+            for column, (_, total_field) in enumerate(TOTAL_FIELDS)
+        }
+
+        line_mismatches = bad_counts[index]
+        invoice["reconciliation"] = {
+            "status": "ok" if not line_mismatches and all(total_matches[index]) else "mismatch",
+            "totals": total_checks,
+            "line_mismatch_count": line_mismatches,
+            "line_mismatches": lines,
+        }
+    return invoices
+
+
+def _round2(value: float) -> float:
+    # Cùng cách làm tròn với np.round(..., 2) để hai nhánh cho kết quả giống nhau
+    return round(value * 100.0) / 100.0 if math.isfinite(value) else value
+
+
+def _matches(actual: float, expected: float, tolerance: float, relative_tolerance: float) -> bool:
+    return abs(actual - expected) <= tolerance + relative_tolerance * abs(expected)
+
+
+def _reconcile_small(invoice: dict, tolerance: float, relative_tolerance: float) -> dict:
+    """Pure-Python equivalent of `reconcile_invoices([invoice])` for small invoices."""
+    sums = [0.0, 0.0, 0.0]
+    present = [False, False, False]
+    rate_vat = {}
+    line_mismatches = 0
+    lines = []
+
+    def mismatch(line, field, expected, actual):
+        nonlocal line_mismatches
+        line_mismatches += 1
+        if len(lines) < MAX_REPORTED_LINES:
+            lines.append({"line": line, "field": field, "expected": _round2(expected), "actual": actual})
+
+    for line, item in enumerate(invoice.get("items") or []):
+        try:
+            quantity, unit_price, before, rate, vat, after = map(float, _get_columns(item))
+        except (KeyError, TypeError, ValueError):
+            quantity, unit_price, before, rate, vat, after = (_to_float(item.get(column)) for column in ITEM_COLUMNS)
+        has_vat = vat != 0
+        has_after = after != 0
+        expected_vat = before * rate / 100.0
+        if not has_vat:
+            vat = expected_vat
+        if not has_after:
+            after = before + vat
+
+        # Chỉ so khi có đủ dữ liệu, như line_checked của reconcile_arrays
+        expected = quantity * unit_price
+        if quantity != 0 and unit_price != 0 and \
+                not abs(before - expected) <= tolerance + relative_tolerance * abs(expected):
+            mismatch(line, "amount_before_vat", expected, before)
+        if has_vat and not abs(vat - expected_vat) <= tolerance + relative_tolerance * abs(expected_vat):
+            mismatch(line, "vat_amount", expected_vat, vat)
+        expected = before + vat
+        if has_after and not abs(after - expected) <= tolerance + relative_tolerance * abs(expected):
+            mismatch(line, "amount_after_vat", expected, after)
+
+        sums[0] += before
+        sums[1] += vat
+        sums[2] += after
+        present[0] = present[0] or before != 0
+        present[1] = present[1] or has_vat
+        present[2] = present[2] or has_after
+        rate_vat[rate] = rate_vat.get(rate, 0.0) + vat
+
+    invoice["vat_rate_summary"] = {_rate_label(rate): _round2(rate_vat[rate]) for rate in sorted(rate_vat)}
+
+    total_checks = {}
+    for column, (_, total_field) in enumerate(TOTAL_FIELDS):
+        total = _to_float(invoice.get(total_field))
+        total_checks[total_field] = {
+            "items": _round2(sums[column]),
+            "invoice": total,
+            "difference": _round2(total - sums[column]),
+            "matches": not (total != 0 and present[column]
+                            and not _matches(total, sums[column], tolerance, relative_tolerance)),
+        }
+
+    invoice["reconciliation"] = {
+        "status": "ok" if not line_mismatches and all(check["matches"] for check in total_checks.values()) else "mismatch",
+        "totals": total_checks,
+        "line_mismatch_count": line_mismatches,
+        "line_mismatches": lines,
+    }
+    return invoice
+
+
+def reconcile_invoice(invoice: dict, tolerance: float = DEFAULT_TOLERANCE,
+                      relative_tolerance: float = DEFAULT_RELATIVE_TOLERANCE) -> dict:
+    """Single-invoice form of `reconcile_invoices`."""
+    if len(invoice.get("items") or []) < SMALL_INVOICE_LINES:
+        return _reconcile_small(invoice, tolerance, relative_tolerance)
+    reconcile_invoices([invoice], tolerance, relative_tolerance)
+    return invoice
+
+
+def reconcile_segment(headers: np.ndarray, items: np.ndarray, tolerance: float = DEFAULT_TOLERANCE,
+                      relative_tolerance: float = DEFAULT_RELATIVE_TOLERANCE) -> dict:
+    """Reconcile one extracted-store segment directly from its structured arrays."""
+    values = np.column_stack([np.asarray(items[column], dtype=np.float64) for column in ITEM_COLUMNS])
+    totals = np.column_stack([np.asarray(headers[field], dtype=np.float64) for _, field in TOTAL_FIELDS])
+    return reconcile_arrays(values.reshape(len(items), len(ITEM_COLUMNS)), np.asarray(items["invoice_row"]),
+                            totals.reshape(len(headers), len(TOTAL_FIELDS)), tolerance, relative_tolerance)
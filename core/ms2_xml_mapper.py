@@ -0,0 +1,498 @@
+import copy
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SchemaError(ValueError):
+    """Raised when a schema spec is malformed."""
+
+
+class UnknownLayoutError(ValueError):
+    """Raised when no schema matches a document, so the invoice can be rejected or routed elsewhere."""
+    def __init__(self, root: str, namespace=None):
+        super().__init__(f"No XML schema matches root '{root}' (ns={namespace})")
+        self.root = root
+        self.namespace = namespace
+
+
+# ---------------- Normalized invoice ----------------
+# Key và kiểu của invoice chuẩn hóa; mọi schema phải sinh đủ các field này
+
+HEADER_FIELDS = {
+    "invoice_type": "str",
+    "vendor_tax_code": "str",
+    "vendor_name": "str",
+    "vendor_address": "str",
+    "buyer_tax_code": "str",
+    "buyer_name": "str",
+    "buyer_address": "str",
+    "invoice_number": "str",
+    "template_code": "str",
+    "invoice_series": "str",
+    "issued_date": "str",
+    "currency_code": "str",
+    "total_amount_before_vat": "float",
+    "total_vat_amount": "float",
+    "total_amount_after_vat": "float",
+}
+
+ITEM_FIELDS = {
+    "product_code": "str",
+    "product_name": "str",
+    "unit_name": "str",
+    "quantity": "float",
+    "unit_price": "float",
+    "amount_before_vat": "float",
+    "vat_rate": "percent",
+    "vat_amount": "float",
+    "amount_after_vat": "float",
+    "promotion_flag": "flag",
+}
+
+
+# ---------------- Converters ----------------
+
+def _to_str(value):
+    return value
+
+
+def _to_percent(value):
+    try:
+        return float(value.replace("%", ""))
+    except (AttributeError, ValueError):
+        text = str(value).replace("%", "").strip()
+        try:
+            return float(text)
+        except ValueError:
+            # KCT / KKKNT (không chịu thuế, không kê khai) không có thuế suất dạng số
+            return 0.0
+
+
+def _to_flag(value):
+    return str(value).strip() in ("1", "True", "true")
+
+
+# type -> (converter, default)
+CONVERTERS = {
+    "str": (_to_str, ""),
+    "float": (float, 0.0),
+    "percent": (_to_percent, 0.0),
+    "flag": (_to_flag, False),
+}
+
+
+# ---------------- Path compilation ----------------
+
+_EMPTY = {}
+
+
+def _split_path(path: str) -> tuple:
+    return tuple(part for part in (path or "").split("/") if part)
+
+
+def _local_name(key: str) -> str:
+    if ":" not in key or key.startswith("@xmlns"):
+        return key
+    local = key.rpartition(":")[2]
+    return "@" + local if key.startswith("@") else local
+
+
+def _local_names(node):
+    """Copy of an xmltodict node with namespace prefixes stripped from element and attribute names."""
+    if isinstance(node, dict):
+        return {_local_name(key): _local_names(value) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_local_names(value) for value in node]
+    return node
+
+
+def _has_prefixed_children(node: dict) -> bool:
+    return any(":" in key and not key.startswith("@") for key in node)
+
+
+# ---------------- Code generation ----------------
+
+# Biểu thức inline của converter trong code sinh ra (str giữ nguyên giá trị xmltodict)
+_INLINE = {
+    "float": "float({})",
+    "percent": "_to_percent({})",
+    "flag": "(str({}).strip() in ('1', 'True', 'true'))",
+}
+
+
+_LOCALS = ", ".join(
+    f"{name}={name}" for name in ("_EMPTY", "_to_percent", "isinstance", "type", "list", "dict", "float", "str", "int")
+)
+
+
+class _SourceBuilder:
+    """Accumulates generated source lines and the constants they reference."""
+    def __init__(self, schema_name: str):
+        self.schema_name = schema_name
+        self.lines = []
+        self.namespace = {"_to_percent": _to_percent, "_EMPTY": _EMPTY}
+        self._bound = {}
+        self._counter = 0
+
+    def name(self, prefix: str) -> str:
+        self._counter += 1
+        return f"{prefix}{self._counter}"
+
+    def emit(self, indent: int, line: str):
+        self.lines.append("    " * indent + line)
+
+    def const(self, value) -> str:
+        """Render a default value; non-literals are bound into the function namespace."""
+        if value is None or isinstance(value, (str, int, float, bool)):
+            return repr(value)
+        if id(value) not in self._bound:
+            var = self.name("_k")
+            self.namespace[var] = value
+            self._bound[id(value)] = var
+        return self._bound[id(value)]
+
+    def converter(self, field_type: str, owner: str):
+        """Return (inline expression template or None for str, type default)."""
+        if field_type not in CONVERTERS:
+            raise SchemaError(f"[{self.schema_name}] '{owner}' has unknown type '{field_type}'")
+        return _INLINE.get(field_type), CONVERTERS[field_type][1]
+
+    def walk(self, indent: int, source: str, keys: tuple, cache: dict) -> str:
+        """
+        Emit the dict walk for `keys` from variable `source`, reusing prefixes
+        already walked (cached in `cache`). Returns the variable holding a dict
+        (an empty one when the path is missing).
+        """
+        if not keys:
+            return source
+        if keys in cache:
+            return cache[keys]
+        parent = self.walk(indent, source, keys[:-1], cache)
+        var = self.name("_n")
+        self.emit(indent, f"{var} = {parent}.get({keys[-1]!r})")
+        self.emit(indent, f"if not isinstance({var}, dict): {var} = _EMPTY")
+        cache[keys] = var
+        return var
+
+    def fields(self, indent: int, source: str, fields: dict, target: str, cache: dict, extra: list = (), base: tuple = ()):
+        """
+        Emit `target = {...}` reading the leaf fields at `base` + path below
+        `source`; `extra` holds (key, variable) pairs appended to the literal.
+        """
+        entries = []
+        for out_key, spec in fields.items():
+            if isinstance(spec, str):
+                spec = {"path": spec}
+            field_type = spec.get("type", "str")
+            converter, type_default = self.converter(field_type, out_key)
+            default = spec.get("default", type_default)
+            if converter is not None and default is not None:
+                default = CONVERTERS[field_type][0](default)
+            keys = _split_path(spec.get("path"))
+            if keys:
+                keys = base + keys
+            if not keys:
+                # Field nhà cung cấp không có: luôn trả về default
+                if "default" not in spec:
+                    raise SchemaError(f"[{self.schema_name}] Field '{out_key}' has no path")
+                value = self.const(default)
+            elif converter is None:
+                # Chuỗi giữ nguyên giá trị xmltodict như mapper cũ
+                value = f"{self.walk(indent, source, keys[:-1], cache)}.get({keys[-1]!r}, {self.const(default)})"
+            else:
+                parent = self.walk(indent, source, keys[:-1], cache)
+                value = (
+                    f"{converter.format('_v')} if (_v := {parent}.get({keys[-1]!r})) is not None "
+                    f"else {self.const(default)}"
+                )
+            entries.append(f"{out_key!r}: {value}")
+        entries.extend(f"{out_key!r}: {var}" for out_key, var in extra)
+        self.emit(indent, f"{target} = {{" + ", ".join(entries) + "}")
+
+    def as_list(self, indent: int, expr: str) -> str:
+        """Emit the xmltodict single-element/list normalization of `expr`."""
+        var = self.name("_l")
+        self.emit(indent, f"{var} = {expr}")
+        self.emit(indent, f"if type({var}) is not list: {var} = () if {var} is None else ({var},)")
+        return var
+
+    def _accumulate(self, indent: int, acc: str, value: str, converter, aggregate: str):
+        if converter:
+            value = converter.format(value)
+        if aggregate == "sum":
+            self.emit(indent, f"{acc} += {value}")
+        elif aggregate == "any":
+            self.emit(indent, f"{acc} = {acc} or {value}")
+        else:
+            self.emit(indent, f"{acc} = {value}")
+
+    def properties(self, indent: int, source: str, spec: dict, cache: dict) -> list:
+        """
+        Emit the scan of a key/value property list (e.g. TTKhac/TTin with
+        TTruong/DLieu) and return the (key, accumulator variable) pairs. With
+        `field` set the value must be a dict and that sub-field is read,
+        otherwise the value must be a scalar. `aggregate` is "sum", "any" or "last".
+        """
+        keys = _split_path(spec.get("path"))
+        key_name = spec.get("key")
+        value_name = spec.get("value")
+        if not keys or not key_name or not value_name:
+            raise SchemaError(f"[{self.schema_name}] properties need 'path', 'key' and 'value'")
+
+        by_key = {}
+        accumulators = []
+        for out_key, field in (spec.get("fields") or {}).items():
+            converter, type_default = self.converter(field.get("type", "str"), out_key)
+            aggregate = field.get("aggregate", "last")
+            if aggregate not in ("sum", "any", "last"):
+                raise SchemaError(f"[{self.schema_name}] Property '{out_key}' has unknown aggregate '{aggregate}'")
+            acc = self.name("_a")
+            self.emit(indent, f"{acc} = {self.const(field.get('default', type_default))}")
+            accumulators.append((out_key, acc))
+            by_key.setdefault(field.get("key"), []).append((acc, field.get("field"), converter, aggregate))
+
+        parent = self.walk(indent, source, keys[:-1], cache)
+        entries = self.as_list(indent, f"{parent}.get({keys[-1]!r})")
+        self.emit(indent, f"for _t in {entries}:")
+        self.emit(indent + 1, "if not isinstance(_t, dict): continue")
+        self.emit(indent + 1, f"_key = _t.get({key_name!r})")
+        self.emit(indent + 1, f"_raw = _t.get({value_name!r})")
+        keyword = "if"
+        for key, targets in by_key.items():
+            self.emit(indent + 1, f"{keyword} _key == {key!r}:")
+            keyword = "elif"
+            scalar_targets = [t for t in targets if not t[1]]
+            dict_targets = [t for t in targets if t[1]]
+            if scalar_targets:
+                self.emit(indent + 2, "if isinstance(_raw, (str, int, float)):")
+                for acc, _, converter, aggregate in scalar_targets:
+                    self._accumulate(indent + 3, acc, "_raw", converter, aggregate)
+            if dict_targets:
+                self.emit(indent + 2, "if isinstance(_raw, dict):")
+                for acc, sub_field, converter, aggregate in dict_targets:
+                    self.emit(indent + 3, f"if (_v := _raw.get({sub_field!r})) is not None:")
+                    self._accumulate(indent + 4, acc, "_v", converter, aggregate)
+        return accumulators
+
+
+def _check_fields(schema_name: str, section: str, declared: dict, expected: dict):
+    """Every schema must produce exactly the normalized fields, with their types."""
+    missing = [name for name in expected if name not in declared]
+    unknown = [name for name in declared if name not in expected]
+    if missing or unknown:
+        raise SchemaError(f"[{schema_name}] {section} fields missing {missing}, unknown {unknown}")
+    for name, spec in declared.items():
+        field_type = spec.get("type", "str") if isinstance(spec, dict) else "str"
+        if field_type != expected[name]:
+            raise SchemaError(f"[{schema_name}] {section} field '{name}' must be '{expected[name]}', got '{field_type}'")
+
+
+def _compile_mapper(spec: dict, schema_name: str):
+    """
+    Validate one schema spec and generate a flat mapping function for it.
+
+    The generated code walks each shared path prefix once and reads the leaves
+    directly, like the hand-written mapper it replaced, so adding a provider
+    costs nothing per request (benchmarks/bench_xml_mapping.py checks this).
+    Returns (function root node -> normalized invoice dict, source).
+    """
+    header = spec.get("header") or {}
+    items = spec.get("items") or {}
+    item_fields = items.get("fields") or {}
+    properties = items.get("properties")
+    property_fields = (properties or {}).get("fields") or {}
+
+    _check_fields(schema_name, "header", header, HEADER_FIELDS)
+    if set(item_fields) & set(property_fields):
+        raise SchemaError(f"[{schema_name}] item fields {sorted(set(item_fields) & set(property_fields))} defined twice")
+    _check_fields(schema_name, "item", {**item_fields, **property_fields}, ITEM_FIELDS)
+    item_keys = _split_path(items.get("path"))
+    if not item_keys:
+        raise SchemaError(f"[{schema_name}] items.path is required")
+
+    builder = _SourceBuilder(schema_name)
+    # Builtin và helper được bind làm tham số mặc định để đọc như biến local
+    builder.emit(0, f"def _map(root, {_LOCALS}):")
+    _emit_mapping(builder, spec, 1, {})
+    source = "\n".join(builder.lines)
+    exec(compile(source, f"<xml-schema:{schema_name}>", "exec"), builder.namespace)
+    return builder.namespace["_map"], source
+
+
+def _emit_mapping(builder: _SourceBuilder, spec: dict, indent: int, cache: dict):
+    """Emit the statements mapping `root` (already validated spec) and returning the invoice."""
+    header = spec.get("header") or {}
+    items = spec.get("items") or {}
+    properties = items.get("properties")
+    base = _split_path(spec.get("base", ""))
+    item_keys = base + _split_path(items.get("path"))
+
+    builder.fields(indent, "root", header, "invoice", cache, base=base)
+    builder.emit(indent, "items = []")
+    builder.emit(indent, "append = items.append")
+    parent = builder.walk(indent, "root", item_keys[:-1], cache)
+    item_list = builder.as_list(indent, f"{parent}.get({item_keys[-1]!r})")
+    builder.emit(indent, f"for hh in {item_list}:")
+    builder.emit(indent + 1, "if not isinstance(hh, dict): continue")
+    item_cache = {}
+    accumulators = builder.properties(indent + 1, "hh", properties, item_cache) if properties else []
+    builder.fields(indent + 1, "hh", items.get("fields") or {}, "item", item_cache, extra=accumulators)
+    builder.emit(indent + 1, "append(item)")
+    builder.emit(indent, "invoice['items'] = items")
+    builder.emit(indent, "return invoice")
+
+
+def _compile_dispatch(root: str, schemas: list, mapping: bool):
+    """
+    Generate a function (root node, namespace) for the `schemas` declaring
+    `root`: the first one whose namespace and fingerprint match is returned
+    (mapping=False) or its mapping is inlined and the invoice returned
+    (mapping=True); None when no schema matches. Paths walked for the
+    fingerprints are reused by the mapping code.
+    """
+    builder = _SourceBuilder(root)
+    builder.emit(0, f"def _dispatch(root, namespace, {_LOCALS}):")
+    cache = {}
+    for schema in schemas:
+        builder.schema_name = schema.name
+        checks = []
+        if schema.namespace is not None:
+            checks.append(f"namespace == {schema.namespace!r}")
+        for path in schema.fingerprint:
+            keys = _split_path(path)
+            if keys:
+                parent = builder.walk(1, "root", keys[:-1], cache)
+                checks.append(f"{parent}.get({keys[-1]!r}) is not None")
+        builder.emit(1, f"if {' and '.join(checks) or 'True'}:")
+        if mapping:
+            # Biến walk bên trong nhánh chỉ dùng được trong nhánh đó
+            _emit_mapping(builder, schema.spec, 2, dict(cache))
+        else:
+            builder.emit(2, f"return {builder.const(schema)}")
+    builder.emit(1, "return None")
+    source = "\n".join(builder.lines)
+    exec(compile(source, f"<xml-{'map' if mapping else 'detect'}:{root}>", "exec"), builder.namespace)
+    return builder.namespace["_dispatch"]
+
+
+# ---------------- Compiled schema ----------------
+
+class CompiledSchema:
+    """One provider layout compiled into a generated mapping function (`source` keeps its code)."""
+    def __init__(self, spec: dict):
+        self.name = spec.get("name")
+        if not self.name:
+            raise SchemaError("Schema is missing 'name'")
+
+        detect = spec.get("detect") or {}
+        self.root = detect.get("root")
+        if not self.root:
+            raise SchemaError(f"[{self.name}] detect.root is required")
+        self.namespace = detect.get("namespace")
+        self.fingerprint = tuple(detect.get("fingerprint", []))
+
+        # Hàm sinh ra được gán thẳng làm `map` để không tốn thêm một lần gọi mỗi request
+        self.map, self.source = _compile_mapper(spec, self.name)
+        self.spec = spec
+
+
+def _resolve_extends(specs: list) -> list:
+    """Merge `extends` parents into child specs (child keys win)."""
+    by_name = {spec.get("name"): spec for spec in specs}
+    resolved = {}
+
+    def resolve(spec, seen=()):
+        name = spec.get("name")
+        if name in resolved:
+            return resolved[name]
+        parent_name = spec.get("extends")
+        if not parent_name:
+            resolved[name] = spec
+            return spec
+        if parent_name in seen or parent_name not in by_name:
+            raise SchemaError(f"[{name}] cannot extend '{parent_name}'")
+        parent = resolve(by_name[parent_name], seen + (name,))
+        merged = copy.deepcopy(parent)
+        merged.update({k: v for k, v in spec.items() if k != "extends"})
+        resolved[name] = merged
+        return merged
+
+    return [resolve(spec) for spec in specs]
+
+
+def compile_schemas(specs: list) -> list:
+    """Compile a list of schema specs (see utils/schemas/xml_invoice_schemas.yaml)."""
+    if not specs:
+        raise SchemaError("At least one XML schema is required")
+    return [CompiledSchema(spec) for spec in _resolve_extends(specs)]
+
+
+# ---------------- Mapper ----------------
+
+class XmlInvoiceMapper:
+    """
+    Detects the provider schema of a parsed XML document and maps it.
+
+    Each local root element name gets a generated function that checks the
+    namespace and fingerprint paths of the schemas declaring that root, in
+    order, and runs the matching schema's mapping inline. Namespace prefixes
+    (`inv:HDon/inv:DLHDon`) are stripped before detection and mapping.
+    """
+    def __init__(self, specs: list):
+        self.schemas = compile_schemas(specs)
+        by_root = {}
+        for schema in self.schemas:
+            by_root.setdefault(schema.root, []).append(schema)
+        self._detectors = {root: _compile_dispatch(root, schemas, False) for root, schemas in by_root.items()}
+        self._mappers = {root: _compile_dispatch(root, schemas, True) for root, schemas in by_root.items()}
+
+    def _resolve(self, data: dict):
+        """Return (schema or None, local root name, namespace, root node to map)."""
+        if not isinstance(data, dict):
+            return None, None, None, None
+        for root_key, root_node in data.items():
+            break
+        else:
+            return None, None, None, None
+        if not isinstance(root_node, dict):
+            return None, root_key, None, None
+
+        if ":" in root_key:
+            namespace = root_node.get("@xmlns:" + root_key.partition(":")[0])
+            root_node = _local_names(root_node)
+            root_key = _local_name(root_key)
+        else:
+            namespace = root_node.get("@xmlns")
+        detect = self._detectors.get(root_key)
+        if detect is None:
+            return None, root_key, namespace, root_node
+        schema = detect(root_node, namespace)
+        if schema is None and _has_prefixed_children(root_node):
+            # Root không prefix nhưng element con có prefix: bỏ prefix rồi nhận diện lại
+            root_node = _local_names(root_node)
+            schema = detect(root_node, namespace)
+        return schema, root_key, namespace, root_node
+
+    def detect(self, data: dict):
+        """Return the schema for a parsed document, or None when no schema matches."""
+        return self._resolve(data)[0]
+
+    def map(self, data: dict) -> dict:
+        """
+        Map a document parsed by xmltodict into the normalized invoice dict.
+
+        Raises:
+            UnknownLayoutError: If no schema matches the document
+        """
+        if type(data) is dict and len(data) == 1:
+            # Đường nhanh: root không prefix, nhận diện và map trong một hàm sinh ra
+            (root_key, root_node), = data.items()
+            map_root = self._mappers.get(root_key)
+            if map_root is not None and type(root_node) is dict:
+                invoice = map_root(root_node, root_node.get("@xmlns"))
+                if invoice is not None:
+                    return invoice
+        schema, local, namespace, root_node = self._resolve(data)
+        if schema is None:
+            raise UnknownLayoutError(local, namespace)
+        return schema.map(root_node)
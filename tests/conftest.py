@@ -0,0 +1,15 @@
+import pytest
+from unittest.mock import patch
+from ms2_extractor.core import ms2_invoice_extractor as extractor
+from ms2_extractor.utils.circuit_breaker import CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def isolated_circuits(tmp_path):
+    """Fresh circuit breakers and a per-test publish spool, so failures in one test do not leak into the next."""
+    spool = extractor.PUBLISH_SPOOL
+    path = str(tmp_path / "spool" / "publish.jsonl")
+    with patch.dict(extractor.BREAKERS, {name: CircuitBreaker(name) for name in extractor.BREAKERS}), \
+         patch.object(spool, 'path', path), \
+         patch.object(spool, '_draining_path', path + ".draining"):
+        yield extractor.BREAKERS
@@ -0,0 +1,145 @@
+import time
+import asyncio
+import threading
+import pytest
+from utils.admission import AdmissionController, AsyncAdmissionController, AdmissionRejected
+
+
+def test_admit_within_limit():
+    """Requests under the in-flight limit are admitted without waiting."""
+    controller = AdmissionController("xml", max_inflight=2)
+
+    with controller.admit() as wait:
+        assert wait >= 0
+        assert controller.snapshot()["inflight"] == 1
+
+    snapshot = controller.snapshot()
+    assert snapshot["inflight"] == 0
+    assert snapshot["admitted"] == 1
+    assert snapshot["queue_wait"]["count"] == 1
+
+
+def test_reject_when_queue_full():
+    """With no wait queue, a request over the limit is rejected with 429."""
+    controller = AdmissionController("pdf", max_inflight=1, max_queue=0)
+
+    with controller.admit():
+        with pytest.raises(AdmissionRejected) as exc_info:
+            with controller.admit():
+                pass
+
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.retry_after >= 1
+    assert controller.snapshot()["rejected"]["queue_full"] == 1
+
+
+def test_reject_on_queue_timeout():
+    """A queued request that cannot get a slot in time is rejected with 503."""
+    controller = AdmissionController("pdf", max_inflight=1, max_queue=1, queue_timeout=0.05)
+
+    with controller.admit():
+        with pytest.raises(AdmissionRejected) as exc_info:
+            with controller.admit():
+                pass
+
+    assert exc_info.value.status_code == 503
+    assert controller.snapshot()["rejected"]["timeout"] == 1
+
+
+def test_waiting_request_gets_released_slot():
+    """A waiting request is admitted as soon as the running one finishes."""
+    controller = AdmissionController("xml", max_inflight=1, max_queue=1, queue_timeout=5)
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold_slot():
+        with controller.admit():
+            holding.set()
+            release.wait()
+
+    worker = threading.Thread(target=hold_slot)
+    worker.start()
+    holding.wait()
+
+    threading.Timer(0.05, release.set).start()
+    with controller.admit() as wait:
+        assert wait > 0
+
+    worker.join()
+    assert controller.snapshot()["admitted"] == 2
+
+
+def test_retry_after_uses_service_time():
+    """Retry-After scales with the observed service time."""
+    controller = AdmissionController("pdf", max_inflight=1)
+    with controller.admit():
+        pass
+    controller._service_time = 7.2
+
+    assert controller.retry_after() == 8
+
+
+def test_blocking_admit_ignores_queue_limit():
+    """Queue consumers wait for a slot instead of being rejected."""
+    controller = AdmissionController("pdf", max_inflight=1, max_queue=0)
+    holding = threading.Event()
+
+    def hold_slot():
+        with controller.admit():
+            holding.set()
+            threading.Event().wait(0.05)
+
+    worker = threading.Thread(target=hold_slot)
+    worker.start()
+    holding.wait()
+
+    with controller.admit(block=True) as wait:
+        assert wait > 0
+
+    worker.join()
+    snapshot = controller.snapshot()
+    assert snapshot["admitted"] == 2
+    assert snapshot["rejected"] == {"queue_full": 0, "timeout": 0}
+
+
+def test_queue_wait_counts_from_arrival():
+    """Time spent before admit() (e.g. in an executor backlog) is part of the queue wait."""
+    controller = AdmissionController("xml", max_inflight=1)
+
+    with controller.admit(arrived=time.monotonic() - 0.2) as wait:
+        assert wait >= 0.2
+
+    assert controller.snapshot()["queue_wait"]["buckets"]["le_0.25"] == 1
+
+
+def test_async_controller_limits_and_rejects():
+    """The asyncio controller has the same limits and rejection codes as the threaded one."""
+    controller = AsyncAdmissionController("pdf", max_inflight=1, max_queue=1, queue_timeout=0.05)
+
+    async def queued():
+        async with controller.admit() as wait:
+            return wait
+
+    async def run():
+        async with controller.admit():
+            with pytest.raises(AdmissionRejected) as exc_info:
+                async with controller.admit():
+                    pass
+            assert exc_info.value.status_code == 503
+
+            waiter = asyncio.ensure_future(queued())
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionRejected) as exc_info:
+                async with controller.admit():
+                    pass
+            assert exc_info.value.status_code == 429
+
+        assert await waiter > 0
+        async with controller.admit(block=True):
+            pass
+
+    asyncio.run(run())
+    snapshot = controller.snapshot()
+    assert snapshot["inflight"] == 0
+    assert snapshot["admitted"] == 3
+    assert snapshot["rejected"] == {"queue_full": 1, "timeout": 1}
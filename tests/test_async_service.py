@@ -0,0 +1,272 @@
+import time
+import json
+import base64
+import asyncio
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock, AsyncMock
+from aiohttp.test_utils import TestClient, TestServer
+from ms2_extractor.core import ms2_invoice_extractor as extractor
+from ms2_extractor.core import ms2_async_service as service_module
+from ms2_extractor.core.ms2_async_service import AsyncExtractionService, create_app, create_lanes
+from ms2_extractor.core.ms2_pdf_chunking import ChunkPlan
+
+XML_BYTES = b"<HDon><DLHDon><TTChung><SHDon>42</SHDon></TTChung><NDHDon><TToan/></NDHDon></DLHDon></HDon>"
+
+
+@pytest.fixture
+def mock_broker():
+    """Stand-in for aio_pika.connect_robust; yields the exchange used for publishing."""
+    exchange = MagicMock()
+    exchange.publish = AsyncMock()
+    queue = MagicMock()
+    queue.consume = AsyncMock()
+    channel = MagicMock()
+    channel.set_qos = AsyncMock()
+    channel.get_exchange = AsyncMock(return_value=exchange)
+    channel.get_queue = AsyncMock(return_value=queue)
+    connection = MagicMock()
+    connection.channel = AsyncMock(return_value=channel)
+    connection.close = AsyncMock()
+    with patch.object(service_module.aio_pika, 'connect_robust', AsyncMock(return_value=connection)), \
+         patch.object(extractor, 'EXTRACTED_SINK', None):
+        yield exchange
+
+
+@pytest.fixture
+def service(mock_broker):
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield AsyncExtractionService(executor=executor, pdf_queue=None)
+    executor.shutdown()
+
+
+def _model(latency: float = 0.0):
+    async def generate_content_async(prompt, generation_config=None):
+        await asyncio.sleep(latency)
+        return MagicMock(text='```json\n{"invoice_number": "7"}\n```')
+    model = MagicMock()
+    model.generate_content_async = generate_content_async
+    return model
+
+
+def _post_extract(service, body):
+    async def run():
+        async with TestClient(TestServer(create_app(service))) as client:
+            response = await client.post("/extract", json=body)
+            return response.status, await response.json()
+    return asyncio.run(run())
+
+
+def test_extract_inline_xml(service, mock_broker):
+    """Inline XML is mapped in the executor, published and persisted via MS4."""
+    body = {"email_id": "email-1", "isInvoice": True,
+            "attachment": {"filename": "a.xml", "content_b64": base64.b64encode(XML_BYTES).decode()}}
+    ms4 = AsyncMock(return_value={"status": "success", "message": "ok"})
+
+    with patch.object(service, 'call_ms4_persistence', ms4):
+        status, payload = _post_extract(service, body)
+
+    assert status == 201
+    assert payload["details"]["ms4"] == "ok"
+    assert ms4.call_args[0][0]["invoice_number"] == "42"
+    message = mock_broker.publish.call_args[0][0]
+    assert json.loads(message.body)["invoice_number"] == "42"
+    assert mock_broker.publish.call_args[1]["routing_key"] == "queue.for_persistence"
+
+
+def test_extract_missing_email_id(service):
+    status, payload = _post_extract(service, {"isInvoice": True})
+
+    assert status == 400
+    assert payload["status"] == "error"
+
+
+def test_extract_rejects_when_lane_is_full(mock_broker):
+    """Requests beyond the lane's in-flight limit are rejected with 429 instead of queueing."""
+    service = AsyncExtractionService(executor=MagicMock(), lanes=create_lanes({"xml": 1, "pdf": 1}))
+
+    async def run():
+        async with service.lanes["xml"].admit():
+            async with TestClient(TestServer(create_app(service))) as client:
+                response = await client.post("/extract", json={"email_id": "email-2", "isInvoice": True})
+                return response.status, response.headers, await response.json()
+
+    status, headers, payload = asyncio.run(run())
+
+    assert status == 429
+    assert payload["lane"] == "xml"
+    assert int(headers["Retry-After"]) >= 1
+    assert service.stats["rejected"] == 1
+
+
+def test_pdf_burst_does_not_delay_xml(mock_broker):
+    """XML requests keep their own slots and executor while the PDF lane is saturated."""
+    pdf_executor, xml_executor = ThreadPoolExecutor(max_workers=1), ThreadPoolExecutor(max_workers=1)
+    service = AsyncExtractionService(lanes=create_lanes({"xml": 4, "pdf": 4}), pdf_queue=None)
+    service.executors = {"xml": xml_executor, "pdf": pdf_executor}
+    ms4 = AsyncMock(return_value={"status": "success", "message": "ok"})
+
+    def prepare(email_id, content, filename, content_type, persist):
+        if filename.endswith(".pdf"):
+            time.sleep(0.3)  # pypdf trên PDF scan
+            return "pdf", ChunkPlan(prompt="prompt")
+        return "xml", extractor.map_invoice(XML_BYTES.decode())
+
+    def body(email_id, filename, content):
+        return {"email_id": email_id, "isInvoice": True,
+                "attachment": {"filename": filename, "content_b64": base64.b64encode(content).decode()}}
+
+    async def run():
+        async with TestClient(TestServer(create_app(service))) as client:
+            pdfs = [asyncio.ensure_future(client.post("/extract", json=body(f"pdf-{i}", "a.pdf", b"%PDF-1.4")))
+                    for i in range(8)]
+            await asyncio.sleep(0.05)
+            started = time.perf_counter()
+            xml = await client.post("/extract", json=body("xml-1", "a.xml", XML_BYTES))
+            xml_latency = time.perf_counter() - started
+            statuses = sorted([response.status for response in await asyncio.gather(*pdfs)])
+            return xml.status, xml_latency, statuses
+
+    with patch.object(extractor, 'prepare_invoice_from_bytes', side_effect=prepare), \
+         patch.object(extractor, 'get_model', return_value=_model(latency=0.5)), \
+         patch.object(service, 'call_ms4_persistence', ms4):
+        xml_status, xml_latency, pdf_statuses = asyncio.run(run())
+    pdf_executor.shutdown()
+    xml_executor.shutdown()
+
+    assert xml_status == 201
+    assert xml_latency < 0.2
+    # 4 PDF chạy, 4 PDF bị từ chối ngay thay vì chiếm slot của XML
+    assert pdf_statuses == [201] * 4 + [429] * 4
+    lanes = service.lanes
+    assert lanes["xml"].snapshot()["admitted"] == 1
+    assert lanes["pdf"].snapshot()["rejected"]["queue_full"] == 4
+
+
+def test_default_process_pool_executor(mock_broker):
+    """With the default ASYNC_EXECUTOR ("process"), XML mapping, model-output parsing and chunk merging run in worker processes."""
+    assert service_module.ASYNC_EXECUTOR == "process"
+    service = AsyncExtractionService(pdf_queue=None, consume_queue=False)
+    plan = ChunkPlan(header_prompt="h", chunks=[(1, 1, "a"), (2, 2, "b")], row_count=2)
+
+    async def generate_content_async(prompt, generation_config=None):
+        if prompt == "h":
+            return MagicMock(text='{"invoice_number": "9", "items": []}')
+        line = 1 if prompt == "a" else 2
+        return MagicMock(text=json.dumps({"items": [{"line_number": line, "product_name": f"P{line}"}]}))
+
+    model = MagicMock(generate_content_async=generate_content_async)
+
+    async def run():
+        await service.start()
+        try:
+            xml = await service.extract("email-1", XML_BYTES, "a.xml", "application/xml")
+            pdf = await service.generate(plan)
+        finally:
+            await service.stop()
+        return xml, pdf
+
+    with patch.object(extractor, 'get_model', return_value=model):
+        xml, pdf = asyncio.run(run())
+
+    assert type(service.executors["xml"]).__name__ == "ProcessPoolExecutor"
+    assert xml["invoice_number"] == "42"
+    assert pdf["invoice_number"] == "9"
+    assert [item["product_name"] for item in pdf["items"]] == ["P1", "P2"]
+    assert "reconciliation" in pdf
+
+
+def test_pdf_extractions_overlap_on_model_calls(service):
+    """Invoices waiting on the model share one event loop instead of one thread each."""
+    async def run():
+        return await asyncio.gather(*(service.extract(f"email-{i}") for i in range(50)))
+
+    with patch.object(extractor, 'prepare_invoice', return_value=("pdf", ChunkPlan(prompt="prompt"))), \
+         patch.object(extractor, 'get_model', return_value=_model(latency=0.2)):
+        started = time.perf_counter()
+        results = asyncio.run(run())
+        elapsed = time.perf_counter() - started
+
+    assert [result["invoice_number"] for result in results] == ["7"] * 50
+    # 50 sequential model calls would take 10s
+    assert elapsed < 2.0
+
+
+def _incoming(body: bytes):
+    message = MagicMock(body=body, delivery_tag=1)
+    message.ack = AsyncMock()
+    message.reject = AsyncMock()
+    message.nack = AsyncMock()
+    return message
+
+
+def test_on_message_ack_and_reject(service):
+    """Queue messages follow the same ack/reject rules as the blocking consumer."""
+    good = _incoming(json.dumps({
+        "email_id": "email-3",
+        "attachment": {"filename": "a.xml", "content_b64": base64.b64encode(XML_BYTES).decode()},
+    }).encode())
+    malformed = _incoming(b"not json")
+    failed = _incoming(json.dumps({"email_id": "email-4"}).encode())
+
+    async def run():
+        for message in (good, malformed, failed):
+            await service.on_message(message)
+
+    with patch.object(extractor, 'prepare_invoice', return_value=(None, None)):
+        asyncio.run(run())
+
+    good.ack.assert_awaited_once()
+    malformed.reject.assert_awaited_once_with(requeue=False)
+    failed.reject.assert_awaited_once_with(requeue=False)
+
+
+def test_on_message_requeues_unexpected_errors(service):
+    message = _incoming(json.dumps({"email_id": "email-5"}).encode())
+
+    with patch.object(extractor, 'prepare_invoice', side_effect=OSError("disk gone")):
+        asyncio.run(service.on_message(message))
+
+    message.nack.assert_awaited_once_with(requeue=True)
+
+
+def test_queue_messages_wait_for_a_lane_slot(service):
+    """Queue messages are never rejected for capacity; their wait shows up in the lane metrics."""
+    service.lanes = create_lanes({"xml": 1, "pdf": 1})
+    messages = [_incoming(json.dumps({"email_id": f"email-{i}"}).encode()) for i in range(3)]
+
+    def prepare(email_id):
+        time.sleep(0.05)
+        return None, None
+
+    async def run():
+        await asyncio.gather(*(service.on_message(message) for message in messages))
+
+    with patch.object(extractor, 'prepare_invoice', side_effect=prepare), \
+         patch.object(extractor, 'detect_attachment_type', return_value="xml"):
+        asyncio.run(run())
+
+    for message in messages:
+        message.reject.assert_awaited_once_with(requeue=False)
+    queue_wait = service.lanes["xml"].snapshot()["queue_wait"]
+    assert queue_wait["count"] == 3
+    assert queue_wait["max"] >= 0.09
+
+
+def test_pdf_messages_are_forwarded_to_the_pdf_queue(service):
+    """With a PDF queue configured, PDFs on the main queue move there instead of holding its prefetch."""
+    service.pdf_queue = "queue.for_extraction.pdf"
+    service.channel = MagicMock()
+    service.channel.default_exchange.publish = AsyncMock()
+    body = json.dumps({"email_id": "email-6", "attachment": {"filename": "a.pdf", "content_b64": ""}}).encode()
+    message = _incoming(body)
+    message.content_type = "application/json"
+
+    with patch.object(extractor, 'prepare_invoice_from_bytes') as prepare:
+        asyncio.run(service.on_message(message))
+
+    prepare.assert_not_called()
+    message.ack.assert_awaited_once()
+    forwarded, = service.channel.default_exchange.publish.call_args[0]
+    assert forwarded.body == body
+    assert service.channel.default_exchange.publish.call_args[1]["routing_key"] == "queue.for_extraction.pdf"
@@ -0,0 +1,309 @@
+import json
+import time
+import asyncio
+import pytest
+from unittest.mock import patch, MagicMock, AsyncMock
+from ms2_extractor.core import ms2_invoice_extractor as extractor
+from ms2_extractor.core import ms2_apiHandler as api
+from ms2_extractor.core import ms2_consumer as consumer
+from ms2_extractor.core import ms2_async_service as service_module
+from ms2_extractor.core.ms2_async_service import AsyncExtractionService
+from ms2_extractor.core.ms2_pdf_chunking import ChunkPlan
+from ms2_extractor.utils.circuit_breaker import CircuitBreaker, CircuitOpenError, health_report, CLOSED, OPEN, HALF_OPEN
+from ms2_extractor.utils.spool import LocalSpool
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_breaker_opens_after_consecutive_failures_and_fails_fast():
+    """Failures below the threshold keep the circuit closed; a success resets the count."""
+    clock = FakeClock()
+    breaker = CircuitBreaker("ms4", failure_threshold=3, open_seconds=10, clock=clock)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    clock.now = 4.2
+    with pytest.raises(CircuitOpenError) as exc_info:
+        with breaker.call():
+            pytest.fail("dependency must not be called while the circuit is open")
+    assert exc_info.value.name == "ms4"
+    assert exc_info.value.retry_after == 6
+    assert breaker.snapshot()["rejected"] == 1
+
+
+def test_half_open_allows_limited_probes():
+    """After the open interval one probe goes through; its outcome closes or re-opens the circuit."""
+    clock = FakeClock()
+    breaker = CircuitBreaker("gemini", failure_threshold=1, open_seconds=5, clock=clock)
+    _trip(breaker)
+
+    clock.now = 5
+    assert breaker.state == HALF_OPEN
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.snapshot()["times_opened"] == 2
+
+    clock.now = 10
+    with breaker.call():
+        pass
+    assert breaker.state == CLOSED
+
+
+def test_health_report_status_codes():
+    """Only critical dependencies make the instance unavailable; other open circuits degrade it."""
+    clock = FakeClock()
+    breakers = {name: CircuitBreaker(name, failure_threshold=1, open_seconds=5, clock=clock) for name in ("ms4", "rabbitmq")}
+    assert health_report(breakers, critical=("ms4",))[1] == 200
+
+    _trip(breakers["rabbitmq"])
+    report, status = health_report(breakers, critical=("ms4",))
+    assert (report["status"], status) == ("degraded", 200)
+
+    _trip(breakers["ms4"])
+    report, status = health_report(breakers, critical=("ms4",))
+    assert status == 503
+    assert report["status"] == "unavailable"
+    assert report["breakers"]["ms4"]["retry_after"] == 5
+
+    clock.now = 5
+    report, status = health_report(breakers, critical=("ms4",))
+    assert (report["status"], status) == ("degraded", 200)
+
+
+def test_spool_take_done_and_crash_recovery(tmp_path):
+    """Undelivered records go back to the spool; a draining file left by a crash is taken again."""
+    spool = LocalSpool(str(tmp_path / "spool" / "publish.jsonl"))
+    assert spool.take() == []
+
+    for n in range(3):
+        spool.append({"n": n})
+    records = spool.take()
+    assert [record["n"] for record in records] == [0, 1, 2]
+    # Đang drain thì caller khác không lấy được
+    assert spool.take() == []
+    spool.append({"n": 3})
+    spool.done(records[1:])
+    assert spool.pending() == 3
+
+    records = spool.take()
+    assert sorted(record["n"] for record in records) == [1, 2, 3]
+    # Process khác dùng chung file không drain cùng lúc
+    other = LocalSpool(spool.path)
+    assert other.take() == []
+    # Process chết giữa chừng: OS thả flock, process khác lấy lại file đang drain
+    spool._release_drain_locked()
+    assert sorted(record["n"] for record in other.take()) == [1, 2, 3]
+    other.done()
+    assert other.pending() == 0
+
+
+def test_publish_spools_while_broker_is_down_and_replays_after_recovery(isolated_circuits):
+    """Connect failures open the RabbitMQ circuit; later publishes skip the broker and are replayed once it is back."""
+    breaker = isolated_circuits["rabbitmq"]
+    with patch.object(extractor, 'RabbitMQConnection') as connection:
+        connection.return_value.connect.side_effect = ConnectionError("broker down")
+        for n in range(breaker.failure_threshold + 2):
+            extractor.publish_invoice_data({"invoice_number": str(n)})
+
+        assert breaker.state == OPEN
+        assert connection.return_value.connect.call_count == breaker.failure_threshold
+        assert extractor.PUBLISH_SPOOL.pending() == breaker.failure_threshold + 2
+
+        breaker._opened_at -= breaker.open_seconds
+        connection.return_value.connect.side_effect = None
+        extractor.publish_invoice_data({"invoice_number": "last"})
+
+    assert breaker.state == CLOSED
+    published = [json.loads(call[1]["body"])["invoice_number"] for call in connection.return_value.publish.call_args_list]
+    assert published == ["last"] + [str(n) for n in range(breaker.failure_threshold + 2)]
+    assert extractor.PUBLISH_SPOOL.pending() == 0
+
+
+def test_spool_is_drained_in_bounded_batches(isolated_circuits):
+    """A publish re-sends at most SPOOL_DRAIN_BATCH spooled messages; the rest stays for the next drain."""
+    for n in range(5):
+        extractor.PUBLISH_SPOOL.append({"exchange": "x", "routing_key": "r", "body": str(n)})
+    with patch.object(extractor, 'RabbitMQConnection') as connection, \
+         patch.object(extractor, 'SPOOL_DRAIN_BATCH', 2), \
+         patch.object(extractor, '_start_spool_retry') as start_retry:
+        extractor.publish_invoice_data({"invoice_number": "new"})
+
+    assert connection.return_value.publish.call_count == 1 + 2
+    assert extractor.PUBLISH_SPOOL.pending() == 3
+    start_retry.assert_called_once()
+
+
+def test_async_publish_drains_spool_in_bounded_batches(isolated_circuits):
+    for n in range(5):
+        extractor.PUBLISH_SPOOL.append({"exchange": "x", "routing_key": "r", "body": str(n)})
+    service = AsyncExtractionService(executor=MagicMock(), pdf_queue=None)
+    service.exchange = MagicMock(publish=AsyncMock())
+    with patch.object(extractor, 'SPOOL_DRAIN_BATCH', 2), \
+         patch.object(extractor, '_start_spool_retry') as start_retry:
+        asyncio.run(service.publish({"invoice_number": "new"}))
+
+    assert service.exchange.publish.await_count == 1 + 2
+    assert extractor.PUBLISH_SPOOL.pending() == 3
+    start_retry.assert_called_once()
+
+
+def test_spool_retry_runs_without_new_publishes(isolated_circuits):
+    """The background retry re-publishes spooled messages once the broker is back, and skips it while the circuit is open."""
+    breaker = isolated_circuits["rabbitmq"]
+    extractor.PUBLISH_SPOOL.append({"exchange": "x", "routing_key": "r", "body": "spooled"})
+    with patch.object(extractor, 'RabbitMQConnection') as connection:
+        _trip(breaker)
+        assert extractor.retry_publish_spool() == 0
+        connection.return_value.connect.assert_not_called()
+
+        breaker._opened_at -= breaker.open_seconds
+        assert extractor.retry_publish_spool() == 1
+
+    assert breaker.state == CLOSED
+    assert connection.return_value.publish.call_args[1]["body"] == "spooled"
+    assert extractor.PUBLISH_SPOOL.pending() == 0
+
+
+def test_spool_retry_thread_starts_on_first_spooled_message(isolated_circuits):
+    with patch.object(extractor, '_spool_retry_thread', None), \
+         patch.object(extractor, 'SPOOL_RETRY_SECONDS', 0.05), \
+         patch.object(extractor, 'RabbitMQConnection') as connection:
+        extractor._spool_message("body")
+        thread = extractor._spool_retry_thread
+        extractor._spool_message("body")
+
+        assert thread is not None and extractor._spool_retry_thread is thread
+        deadline = time.monotonic() + 5
+        while extractor.PUBLISH_SPOOL.pending() and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+    assert extractor.PUBLISH_SPOOL.pending() == 0
+    assert connection.return_value.publish.call_count == 2
+
+
+def test_extract_fails_fast_with_503_while_ms4_is_down(isolated_circuits):
+    """With the MS4 circuit open, /extract answers 503 + Retry-After without extracting or calling MS4."""
+    _trip(isolated_circuits["ms4"])
+    client = api.app.test_client()
+
+    with patch.object(api, 'extract_invoice_data') as extract, patch.object(api.requests, 'post') as post:
+        response = client.post("/extract", json={"email_id": "email-1", "isInvoice": True})
+
+    assert response.status_code == 503
+    assert response.get_json()["dependency"] == "ms4"
+    assert int(response.headers["Retry-After"]) >= 1
+    extract.assert_not_called()
+    post.assert_not_called()
+
+    health = client.get("/health")
+    assert health.status_code == 503
+    assert health.get_json()["breakers"]["ms4"]["state"] == OPEN
+
+
+def test_ms4_server_errors_trip_the_breaker(isolated_circuits):
+    """5xx responses count as failures, 4xx do not."""
+    with patch.object(api.requests, 'post', return_value=MagicMock(status_code=400, text="bad")):
+        for _ in range(10):
+            api.call_ms4_persistence({})
+    assert isolated_circuits["ms4"].state == CLOSED
+
+    with patch.object(api.requests, 'post', return_value=MagicMock(status_code=502, text="bad gateway")) as post:
+        results = [api.call_ms4_persistence({}) for _ in range(isolated_circuits["ms4"].failure_threshold + 1)]
+    assert post.call_count == isolated_circuits["ms4"].failure_threshold
+    assert results[-1]["retry_after"] >= 1
+
+
+def test_open_gemini_circuit_propagates_from_pdf_extraction(isolated_circuits):
+    """PDF extraction raises CircuitOpenError instead of returning None, so callers can retry later."""
+    _trip(isolated_circuits["gemini"])
+    model = MagicMock()
+
+    with patch.object(extractor, '_plan_pdf_extraction', return_value=ChunkPlan(prompt="p")), \
+         patch.object(extractor, 'get_model', return_value=model):
+        with pytest.raises(CircuitOpenError):
+            extractor._pdf_extraction_logic("a.pdf")
+    model.generate_content.assert_not_called()
+
+
+def test_consumer_pauses_and_requeues_while_a_circuit_is_open():
+    ch = MagicMock()
+    body = json.dumps({"email_id": "email-1", "attachment": {"filename": "a.pdf", "content_b64": ""}}).encode()
+
+    with patch.object(consumer, 'process_message', side_effect=CircuitOpenError("gemini", 7)):
+        consumer.on_message(ch, MagicMock(delivery_tag=1), None, body)
+
+    ch.connection.sleep.assert_called_once_with(7)
+    ch.basic_nack.assert_called_once_with(1, requeue=True)
+
+
+def test_async_queue_requeues_while_a_circuit_is_open():
+    service = AsyncExtractionService(executor=MagicMock(), pdf_queue=None)
+    message = MagicMock(body=json.dumps({"email_id": "email-1"}).encode(), nack=AsyncMock())
+
+    with patch.object(service, 'extract', AsyncMock(side_effect=CircuitOpenError("gemini", 3))), \
+         patch.object(service_module.asyncio, 'sleep', AsyncMock()) as sleep:
+        asyncio.run(service.on_message(message))
+
+    sleep.assert_awaited_once_with(3)
+    message.nack.assert_awaited_once_with(requeue=True)
+
+
+def test_cancelled_half_open_probe_releases_its_slot():
+    """A cancelled async probe is neither a success nor a failure; the next call probes again."""
+    clock = FakeClock()
+    breaker = CircuitBreaker("gemini", failure_threshold=1, open_seconds=5, clock=clock)
+    _trip(breaker)
+    clock.now = 5
+
+    async def probe():
+        with breaker.call():
+            await asyncio.sleep(10)
+
+    async def run():
+        task = asyncio.ensure_future(probe())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert breaker.state == HALF_OPEN
+    assert breaker.snapshot()["failures"] == 1
+
+    with breaker.call():
+        pass
+    assert breaker.state == CLOSED
+
+
+def test_health_stays_up_while_only_the_broker_is_down(isolated_circuits):
+    """Publishes are spooled while RabbitMQ is down, so the instance keeps taking traffic."""
+    _trip(isolated_circuits["rabbitmq"])
+
+    response = api.app.test_client().get("/health")
+
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "degraded"
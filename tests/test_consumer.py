@@ -0,0 +1,135 @@
+import json
+import time
+import base64
+import pytest
+from unittest.mock import patch, MagicMock
+from ms2_extractor.core import ms2_consumer as consumer
+
+
+def _body(email_id: str, filename: str) -> bytes:
+    return json.dumps({
+        "email_id": email_id,
+        "attachment": {"filename": filename, "content_b64": ""},
+    }).encode()
+
+
+@pytest.fixture
+def channel():
+    """Channel whose thread-safe callbacks run immediately; records when each tag was settled."""
+    ch = MagicMock(is_open=True)
+    ch.settled = {}
+    ch.connection.add_callback_threadsafe = lambda callback: callback()
+    ch.basic_ack.side_effect = lambda tag: ch.settled.setdefault(tag, ("ack", time.perf_counter()))
+    ch.basic_nack.side_effect = lambda tag, requeue: ch.settled.setdefault(
+        tag, ("requeue" if requeue else "reject", time.perf_counter())
+    )
+    return ch
+
+
+@pytest.fixture
+def lane_consumer():
+    lanes = consumer.LaneConsumer(workers={"xml": 1, "pdf": 1}, pdf_queue=None)
+    yield lanes
+    lanes.shutdown()
+
+
+def _deliver(lane_consumer, ch, tag, body, callback=None):
+    (callback or lane_consumer.on_message)(ch, MagicMock(delivery_tag=tag), None, body)
+
+
+@pytest.mark.parametrize("content, lane", [(b"%PDF-1.7\n...", "pdf"), (b"\xef\xbb\xbf<HDon/>", "xml")])
+def test_inline_attachment_without_hints_is_sniffed(content, lane):
+    """Without filename/content type the first base64 characters decide the lane, not the disk check."""
+    message = {"email_id": "email-1", "attachment": {"content_b64": base64.b64encode(content * 50).decode()}}
+
+    with patch.object(consumer, 'detect_attachment_type') as disk:
+        assert consumer.message_lane(message) == lane
+    disk.assert_not_called()
+
+
+def test_pdf_burst_does_not_delay_xml(lane_consumer, channel):
+    """XML messages run on their own worker while PDFs wait on the model."""
+    def process(message):
+        if message["attachment"]["filename"].endswith(".pdf"):
+            time.sleep(0.2)
+        return {"invoice_number": message["email_id"]}
+
+    with patch.object(consumer, 'process_message', side_effect=process):
+        started = time.perf_counter()
+        for tag in range(1, 4):
+            _deliver(lane_consumer, channel, tag, _body(f"pdf-{tag}", "a.pdf"))
+        _deliver(lane_consumer, channel, 4, _body("xml-4", "a.xml"))
+        lane_consumer.shutdown()
+
+    assert {tag: outcome for tag, (outcome, _) in channel.settled.items()} == {1: "ack", 2: "ack", 3: "ack", 4: "ack"}
+    assert channel.settled[4][1] - started < 0.1
+    assert channel.settled[3][1] - started >= 0.6
+
+    snapshot = lane_consumer.snapshot()
+    assert snapshot["xml"]["admitted"] == 1
+    assert snapshot["pdf"]["admitted"] == 3
+    # PDF thứ 3 chờ hai PDF trước trong executor của lane
+    assert snapshot["pdf"]["queue_wait"]["max"] >= 0.35
+
+
+def test_ack_rules_match_on_message(lane_consumer, channel):
+    """Malformed and failed messages are rejected, unexpected errors requeued, non-invoices acked."""
+    def process(message):
+        if message["email_id"] == "boom":
+            raise OSError("disk gone")
+        return None
+
+    with patch.object(consumer, 'process_message', side_effect=process):
+        _deliver(lane_consumer, channel, 1, b"not json")
+        _deliver(lane_consumer, channel, 2, _body("failed", "a.xml"))
+        _deliver(lane_consumer, channel, 3, _body("boom", "a.xml"))
+        _deliver(lane_consumer, channel, 4, json.dumps({"email_id": "x", "isInvoice": False}).encode())
+        lane_consumer.shutdown()
+
+    assert {tag: outcome for tag, (outcome, _) in channel.settled.items()} == {
+        1: "reject", 2: "reject", 3: "requeue", 4: "ack",
+    }
+
+
+def test_pdf_messages_are_forwarded_to_the_pdf_queue(channel):
+    """With a PDF queue configured, PDFs on the main queue move there; its own callback processes them."""
+    lanes = consumer.LaneConsumer(workers={"xml": 1, "pdf": 1}, pdf_queue="queue.for_extraction.pdf")
+    body = _body("pdf-1", "a.pdf")
+
+    with patch.object(consumer, 'process_message', return_value={"invoice_number": "1"}) as process:
+        _deliver(lanes, channel, 1, body)
+        assert channel.basic_publish.call_args[1]["routing_key"] == "queue.for_extraction.pdf"
+        assert channel.basic_publish.call_args[1]["body"] == body
+        assert channel.settled[1][0] == "ack"
+        process.assert_not_called()
+
+        _deliver(lanes, channel, 2, body, callback=lanes.on_pdf_message)
+        lanes.shutdown()
+
+    assert channel.settled[2][0] == "ack"
+    assert channel.basic_publish.call_count == 1
+    assert lanes.snapshot()["pdf"]["admitted"] == 1
+
+
+def test_unconfirmed_forward_is_requeued(channel):
+    """A forward the broker does not confirm is requeued instead of acked (and lost)."""
+    lanes = consumer.LaneConsumer(workers={"xml": 1, "pdf": 1}, pdf_queue="queue.for_extraction.pdf")
+    channel.basic_publish.side_effect = consumer.pika.exceptions.NackError([])
+
+    _deliver(lanes, channel, 1, _body("pdf-1", "a.pdf"))
+    lanes.shutdown()
+
+    assert channel.settled[1][0] == "requeue"
+
+
+def test_main_bounds_prefetch_and_confirms_forwards():
+    """The consumer channel gets a prefetch of 2 x workers and publisher confirms for PDF forwarding."""
+    lanes = consumer.LaneConsumer(workers={"xml": 2, "pdf": 3}, pdf_queue="queue.for_extraction.pdf")
+    with patch.object(consumer, 'RabbitMQConnection') as connection, \
+         patch.object(consumer, 'LaneConsumer', return_value=lanes):
+        consumer.main()
+
+    rmq = connection.return_value
+    rmq.set_prefetch.assert_called_once_with(10)
+    rmq.enable_confirms.assert_called_once()
+    rmq.consume.assert_called_once()
@@ -0,0 +1,152 @@
+import os
+import numpy as np
+import pytest
+from unittest.mock import patch
+from ms2_extractor.core.ms2_extracted_sink import ExtractedSink, list_segments, load_segment, iter_invoices
+
+
+def _invoice(number, n_items):
+    return {
+        "invoice_number": str(number),
+        "vendor_name": "CONG TY A",
+        "total_amount_after_vat": 110.0 * n_items,
+        "items": [
+            {"product_name": f"P{i}", "quantity": 1.0, "amount_after_vat": 110.0, "promotion_flag": i == 0}
+            for i in range(n_items)
+        ],
+    }
+
+
+def test_flush_writes_memory_mappable_segment(tmp_path):
+    """A flush writes one headers/items segment that loads with mmap."""
+    sink = ExtractedSink(str(tmp_path), batch_size=100, flush_interval=60)
+    sink.append("email-1", _invoice(1, 2), source="xml")
+    sink.append("email-2", _invoice(2, 0), source="pdf")
+
+    assert sink.flush() == 2
+    assert list_segments(str(tmp_path)) == [0]
+
+    headers, items = load_segment(str(tmp_path), 0)
+    assert isinstance(headers, np.memmap)
+    assert list(headers["email_id"]) == ["email-1", "email-2"]
+    assert list(headers["item_count"]) == [2, 0]
+    assert list(items["invoice_row"]) == [0, 0]
+    assert items["amount_after_vat"].sum() == 220.0
+    sink.close()
+
+
+def test_segments_are_append_only(tmp_path):
+    """Each flush creates a new segment and a new sink continues the sequence."""
+    sink = ExtractedSink(str(tmp_path), flush_interval=60)
+    sink.append("email-1", _invoice(1, 1))
+    sink.flush()
+    sink.close()
+
+    sink = ExtractedSink(str(tmp_path), flush_interval=60)
+    sink.append("email-2", _invoice(2, 1))
+    sink.flush()
+    sink.close()
+
+    assert list_segments(str(tmp_path)) == [0, 1]
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+
+def test_writers_sharing_a_directory_never_overwrite_each_other(tmp_path):
+    """Two sinks (e.g. the Flask app and the consumer) interleaving flushes keep every segment."""
+    a = ExtractedSink(str(tmp_path), flush_interval=60)
+    b = ExtractedSink(str(tmp_path), flush_interval=60)
+    for sink, email_id in ((a, "a1"), (b, "b1"), (a, "a2")):
+        sink.append(email_id, _invoice(1, 1))
+        sink.flush()
+
+    assert sorted(email_id for email_id, _ in iter_invoices(str(tmp_path))) == ["a1", "a2", "b1"]
+    assert len(list_segments(str(tmp_path))) == 3
+
+
+def test_long_strings_are_not_truncated(tmp_path):
+    """String fields wider than the default width are widened for that segment."""
+    sink = ExtractedSink(str(tmp_path), flush_interval=60)
+    invoice = _invoice(1, 1)
+    invoice["vendor_name"] = "V" * 300
+    invoice["items"][0]["product_name"] = "P" * 500
+    sink.append("email-1", invoice)
+    sink.append("email-2", _invoice(2, 1))
+    sink.flush()
+
+    invoices = dict(iter_invoices(str(tmp_path)))
+    assert invoices["email-1"]["vendor_name"] == "V" * 300
+    assert invoices["email-1"]["items"][0]["product_name"] == "P" * 500
+    assert invoices["email-2"]["vendor_name"] == "CONG TY A"
+
+
+def test_failed_write_keeps_the_batch(tmp_path):
+    """A write error puts the batch back so the next flush retries it."""
+    sink = ExtractedSink(str(tmp_path), flush_interval=60)
+    sink.append("email-1", _invoice(1, 1))
+
+    with patch("ms2_extractor.core.ms2_extracted_sink.np.save", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            sink.flush()
+    assert list_segments(str(tmp_path)) == []
+    assert not os.listdir(tmp_path)
+
+    sink.append("email-2", _invoice(2, 1))
+    assert sink.flush() == 2
+    assert [email_id for email_id, _ in iter_invoices(str(tmp_path))] == ["email-1", "email-2"]
+    sink.close()
+
+
+def test_pending_is_capped_while_writes_keep_failing(tmp_path):
+    """A persistent write error drops the oldest invoices instead of growing the backlog without bound."""
+    sink = ExtractedSink(str(tmp_path), batch_size=2, flush_interval=60, max_pending=3)
+    # Flush only from the test, not from the background thread
+    with patch.object(sink, '_start_locked'), \
+         patch.object(sink, '_write_segment', side_effect=OSError("disk full")):
+        for n in range(5):
+            sink.append(f"email-{n}", _invoice(n, 1))
+            with pytest.raises(OSError):
+                sink.flush()
+
+    assert [email_id for email_id, *_ in sink._pending] == ["email-2", "email-3", "email-4"]
+    assert sink.dropped == 2
+
+    assert sink.flush() == 3
+    assert [email_id for email_id, _ in iter_invoices(str(tmp_path))] == ["email-2", "email-3", "email-4"]
+    sink.close()
+
+
+def test_iter_invoices_round_trip(tmp_path):
+    """Invoices read back from segments match what was appended."""
+    sink = ExtractedSink(str(tmp_path), flush_interval=60)
+    sink.append("email-1", _invoice(1, 3))
+    sink.append("email-2", _invoice(2, 1))
+    sink.close()
+
+    invoices = dict(iter_invoices(str(tmp_path)))
+    assert invoices["email-1"]["invoice_number"] == "1"
+    assert [item["product_name"] for item in invoices["email-1"]["items"]] == ["P0", "P1", "P2"]
+    assert invoices["email-1"]["items"][0]["promotion_flag"] is True
+    assert len(invoices["email-2"]["items"]) == 1
+
+
+def test_batch_size_triggers_background_flush(tmp_path):
+    """Reaching batch_size wakes the flusher without waiting for the interval."""
+    sink = ExtractedSink(str(tmp_path), batch_size=2, flush_interval=60)
+    sink.append("email-1", _invoice(1, 1))
+    sink.append("email-2", _invoice(2, 1))
+
+    for _ in range(100):
+        if list_segments(str(tmp_path)):
+            break
+        sink._thread.join(0.02)
+    assert list_segments(str(tmp_path)) == [0]
+    sink.close()
+
+
+def test_non_dict_results_are_ignored(tmp_path):
+    """Raw strings (e.g. unparsed model output) are not written."""
+    sink = ExtractedSink(str(tmp_path), flush_interval=60)
+    sink.append("email-1", '{"not": "parsed"}')
+
+    assert sink.flush() == 0
+    sink.close()
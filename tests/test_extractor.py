@@ -11,6 +11,12 @@ def mock_rabbitmq_connection():
         mock_conn.return_value = mock_instance
         yield mock_instance
 
+@pytest.fixture(autouse=True)
+def mock_extracted_sink():
+    """Fixture to keep the columnar sink from writing into EXTRACTED_DIR."""
+    with patch('ms2_extractor.core.ms2_invoice_extractor.EXTRACTED_SINK') as mock_sink:
+        yield mock_sink
+
 @patch('ms2_extractor.core.ms2_invoice_extractor._load_xml_content')
 @patch('ms2_extractor.core.ms2_invoice_extractor.map_invoice')
 def test_extract_invoice_data_publishes_on_success(
@@ -80,4 +86,24 @@ def test_extract_invoice_data_does_not_publish_on_failure(
     mock_rabbitmq_connection.connect.assert_not_called()
     
     # 4. Check that publish was NOT called
-    mock_rabbitmq_connection.publish.assert_not_called()
\ No newline at end of file
+    mock_rabbitmq_connection.publish.assert_not_called()
+
+@patch('ms2_extractor.core.ms2_invoice_extractor._load_xml_content')
+@patch('ms2_extractor.core.ms2_invoice_extractor.map_invoice')
+def test_extract_invoice_data_appends_to_sink(
+    mock_map_invoice,
+    mock_load_xml,
+    mock_rabbitmq_connection,
+    mock_extracted_sink
+):
+    """
+    Tests that a successful extraction is handed to the columnar sink.
+    """
+    mock_load_xml.return_value = "<xml>some data</xml>"
+    mock_map_invoice.return_value = {"invoice_number": "1", "items": []}
+
+    extract_invoice_data("test_email_789")
+
+    mock_extracted_sink.append.assert_called_once_with(
+        "test_email_789", {"invoice_number": "1", "items": []}, source="xml"
+    )
@@ -0,0 +1,197 @@
+import io
+import json
+import base64
+import pytest
+from unittest.mock import patch, MagicMock
+from ms2_extractor.core import ms2_invoice_extractor as extractor
+from ms2_extractor.core import ms2_apiHandler as api
+from ms2_extractor.core import ms2_consumer as consumer
+from ms2_extractor.utils.traffic import TrafficRecorder, load_records, KIND_HTTP
+
+XML_BYTES = "﻿<HDon><DLHDon><TTChung><SHDon>42</SHDon></TTChung><NDHDon><TToan/></NDHDon></DLHDon></HDon>".encode("utf-8")
+PDF_BYTES = b"%PDF-1.4\n..."
+
+
+@pytest.fixture(autouse=True)
+def no_side_effects():
+    """Keep publishing and the columnar sink out of these tests."""
+    with patch.object(extractor, 'publish_invoice_data') as mock_publish, \
+         patch.object(extractor, 'EXTRACTED_SINK', None):
+        yield mock_publish
+
+
+def test_detect_content_type():
+    """Magic bytes win over filename and MIME hints."""
+    assert extractor.detect_content_type(PDF_BYTES, "x.xml") == "pdf"
+    assert extractor.detect_content_type(XML_BYTES) == "xml"
+    assert extractor.detect_content_type(b"PK\x03\x04", "x.zip", "application/zip") is None
+    assert extractor.detect_content_type(b"", "invoice.PDF") == "pdf"
+
+
+def test_decode_inline_attachment_limits():
+    """Inline attachments are size-checked before decoding."""
+    encoded = base64.b64encode(XML_BYTES).decode()
+    content, filename, _ = extractor.decode_inline_attachment({"filename": "a.xml", "content_b64": encoded})
+    assert content == XML_BYTES
+    assert filename == "a.xml"
+
+    with patch.object(extractor, 'MAX_ATTACHMENT_BYTES', 4):
+        with pytest.raises(ValueError):
+            extractor.decode_inline_attachment({"content_b64": encoded})
+    with pytest.raises(ValueError):
+        extractor.decode_inline_attachment({"content_b64": "not base64!"})
+
+
+def test_extract_from_xml_bytes_skips_disk(no_side_effects):
+    """XML bytes are mapped in memory without touching ATTACH_DIR."""
+    with patch.object(extractor, '_load_xml_content') as mock_load:
+        result = extractor.extract_invoice_from_bytes("email-1", XML_BYTES, "a.xml")
+
+    mock_load.assert_not_called()
+    assert result["invoice_number"] == "42"
+    no_side_effects.assert_called_once_with(result)
+
+
+def test_extract_from_pdf_bytes_uses_stream():
+    """PDF bytes are handed to the PDF pipeline as an in-memory stream."""
+    with patch.object(extractor, '_pdf_extraction_logic', return_value={"items": []}) as mock_pdf:
+        extractor.extract_invoice_from_bytes("email-2", PDF_BYTES, "a.pdf")
+
+    stream = mock_pdf.call_args[0][0]
+    assert isinstance(stream, io.BytesIO)
+    assert stream.getvalue() == PDF_BYTES
+
+
+def test_extract_from_bytes_persist(tmp_path):
+    """persist=True keeps a copy in ATTACH_DIR."""
+    with patch.object(extractor, 'ATTACH_DIR', str(tmp_path)):
+        extractor.extract_invoice_from_bytes("email-3", XML_BYTES, persist=True)
+
+    assert (tmp_path / "email-3.xml").read_bytes() == XML_BYTES
+
+
+@pytest.mark.parametrize("email_id", ["../escaped", "a/b", "..", "a\\b", "id with space"])
+def test_persist_rejects_path_traversal(tmp_path, email_id):
+    """An email_id cannot make persist write outside ATTACH_DIR."""
+    attach_dir = tmp_path / "attachments"
+    attach_dir.mkdir()
+    with patch.object(extractor, 'ATTACH_DIR', str(attach_dir)), \
+         patch.object(extractor, 'publish_invoice_data') as mock_publish:
+        with pytest.raises(ValueError, match="Invalid email_id"):
+            extractor.extract_invoice_from_bytes(email_id, XML_BYTES, persist=True)
+
+    assert list(tmp_path.rglob("*.xml")) == []
+    mock_publish.assert_not_called()
+    with pytest.raises(ValueError):
+        consumer.parse_message(json.dumps({"email_id": email_id}))
+
+    response = api.app.test_client().post("/extract", json={"email_id": email_id, "isInvoice": True})
+    assert response.status_code == 400
+
+
+def test_persist_skips_unmappable_attachment(tmp_path):
+    """Only attachments that were extracted are kept in ATTACH_DIR."""
+    with patch.object(extractor, 'ATTACH_DIR', str(tmp_path)):
+        with pytest.raises(ValueError):
+            extractor.extract_invoice_from_bytes("email-9", b"<Other><X>1</X></Other>", persist=True)
+
+    assert list(tmp_path.iterdir()) == []
+
+
+@patch.object(api, 'call_ms4_persistence', return_value={"status": "success", "message": "ok"})
+def test_upload_endpoint(mock_ms4):
+    """Multipart uploads go straight to the in-memory pipeline."""
+    client = api.app.test_client()
+    with patch.object(api, 'extract_invoice_from_bytes', return_value={"items": []}) as mock_extract:
+        response = client.post("/extract/upload", data={
+            "email_id": "email-4",
+            "attachment": (io.BytesIO(XML_BYTES), "invoice.xml", "application/xml"),
+        }, content_type="multipart/form-data")
+
+    assert response.status_code == 201
+    args = mock_extract.call_args
+    assert args[0][:2] == ("email-4", XML_BYTES)
+    assert args[1] == {"persist": False}
+
+
+@patch.object(api, 'call_ms4_persistence', return_value={"status": "success", "message": "ok"})
+def test_upload_is_recorded_as_replayable_extract(mock_ms4, tmp_path):
+    """Uploads are recorded like /extract requests with the attachment inline, so loadgen can replay them."""
+    recorder = TrafficRecorder(str(tmp_path / "traffic.jsonl"))
+    client = api.app.test_client()
+    with patch.object(api, 'RECORDER', recorder), \
+         patch.object(api, 'extract_invoice_from_bytes', return_value={"items": []}):
+        client.post("/extract/upload", data={
+            "email_id": "email-4",
+            "persist": "true",
+            "attachment": (io.BytesIO(XML_BYTES), "invoice.xml", "application/xml"),
+        }, content_type="multipart/form-data")
+
+    [record] = load_records(recorder.path)
+    assert (record["kind"], record["path"], record["lane"]) == (KIND_HTTP, "/extract", "xml")
+    assert record["body"]["persist"] is True
+    content, filename, _ = extractor.decode_inline_attachment(record["body"]["attachment"])
+    assert (content, filename) == (XML_BYTES, "invoice.xml")
+
+
+def test_upload_endpoint_rejects_oversized_attachment():
+    """The per-attachment byte limit applies even when the body fits MAX_CONTENT_LENGTH."""
+    client = api.app.test_client()
+    with patch.object(api, 'MAX_ATTACHMENT_BYTES', 16), \
+         patch.object(api, 'extract_invoice_from_bytes') as mock_extract:
+        response = client.post("/extract/upload", data={
+            "email_id": "email-4",
+            "attachment": (io.BytesIO(XML_BYTES), "invoice.xml", "application/xml"),
+        }, content_type="multipart/form-data")
+
+    assert response.status_code == 413
+    mock_extract.assert_not_called()
+
+
+def test_upload_endpoint_rejects_unknown_type():
+    """Non XML/PDF uploads are rejected with 415."""
+    client = api.app.test_client()
+    response = client.post("/extract/upload", data={
+        "email_id": "email-5",
+        "attachment": (io.BytesIO(b"PK\x03\x04"), "invoice.zip", "application/zip"),
+    }, content_type="multipart/form-data")
+
+    assert response.status_code == 415
+
+
+@patch.object(api, 'call_ms4_persistence', return_value={"status": "success", "message": "ok"})
+def test_extract_endpoint_inline_attachment(mock_ms4):
+    """/extract accepts a base64 attachment in the JSON body."""
+    client = api.app.test_client()
+    body = {
+        "email_id": "email-6",
+        "isInvoice": True,
+        "attachment": {"filename": "a.xml", "content_b64": base64.b64encode(XML_BYTES).decode()},
+    }
+    with patch.object(api, 'extract_invoice_data') as mock_disk:
+        response = client.post("/extract", json=body)
+
+    assert response.status_code == 201
+    mock_disk.assert_not_called()
+
+
+def test_consumer_inline_message_acked():
+    """A queue message carrying the attachment is extracted and acked."""
+    ch, method = MagicMock(), MagicMock(delivery_tag=7)
+    body = json.dumps({
+        "email_id": "email-7",
+        "attachment": {"filename": "a.xml", "content_b64": base64.b64encode(XML_BYTES).decode()},
+    })
+
+    consumer.on_message(ch, method, None, body.encode())
+
+    ch.basic_ack.assert_called_once_with(7)
+
+
+def test_consumer_malformed_message_rejected():
+    """Malformed messages are dead-lettered instead of requeued."""
+    ch, method = MagicMock(), MagicMock(delivery_tag=8)
+
+    consumer.on_message(ch, method, None, b"not json")
+
+    ch.basic_nack.assert_called_once_with(8, requeue=False)
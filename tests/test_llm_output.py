@@ -0,0 +1,144 @@
+import json
+import pytest
+from unittest.mock import patch, MagicMock
+from ms2_extractor.core import ms2_invoice_extractor as extractor
+from ms2_extractor.core.ms2_pdf_chunking import ChunkPlan
+from ms2_extractor.core.ms2_llm_output import (
+    InvalidModelOutput,
+    RESPONSE_SCHEMA,
+    parse_invoice_output,
+    parse_items_output,
+    repair_json,
+)
+
+XML = """<HDon><DLHDon><TTChung><SHDon>1</SHDon></TTChung><NDHDon><DSHHDVu><HHDVu>
+<THHDVu>A</THHDVu><SLuong>2</SLuong><TSuat>10%</TSuat></HHDVu></DSHHDVu></NDHDon></DLHDon></HDon>"""
+
+ITEM = '{"product_name": "Milk", "quantity": 2, "unit_price": 1000, "vat_rate": 8, "promotion_flag": false}'
+
+
+def test_output_has_map_invoice_shape():
+    """PDF results carry exactly the keys and types map_invoice produces."""
+    xml_invoice = extractor.map_invoice(XML)
+    pdf_invoice = extractor._parse_model_response('{"invoice_number": "1", "items": [%s]}' % ITEM)
+
+    assert pdf_invoice.keys() == xml_invoice.keys()
+    assert pdf_invoice["items"][0].keys() == xml_invoice["items"][0].keys()
+    for key, value in xml_invoice.items():
+        assert type(pdf_invoice[key]) is type(value), key
+    assert pdf_invoice["currency_code"] == "VND"
+
+
+def test_schema_lists_every_field():
+    """The response schema covers every extracted field (derived fields are computed locally)."""
+    invoice = parse_invoice_output('{"invoice_number": "1"}')
+
+    assert set(RESPONSE_SCHEMA["properties"]) == set(invoice)
+
+
+@pytest.mark.parametrize("text", [
+    '```json\n{"invoice_number": "1", "items": [%s]}\n```' % ITEM,
+    'Here is the invoice:\n{"invoice_number": "1", "items": [%s]}\nLet me know if you need more.' % ITEM,
+    '{"invoice_number": "1", "items": [%s,],}' % ITEM,
+    '{"invoice_number": "1", "items": [%s], "vendor_name": None}' % ITEM.replace("false", "False"),
+])
+def test_repairs_common_defects(text):
+    invoice = parse_invoice_output(text)
+
+    assert invoice["invoice_number"] == "1"
+    assert invoice["items"][0]["product_name"] == "Milk"
+    assert invoice["items"][0]["promotion_flag"] is False
+
+
+def test_truncated_output_keeps_complete_items():
+    """A response cut off mid-item keeps the items that were complete."""
+    text = '{"invoice_number": "1", "products": [%s, {"product_name": "Tea", "quantity": 1' % ITEM
+
+    invoice = parse_invoice_output(text)
+
+    assert [item["product_name"] for item in invoice["items"]] == ["Milk", "Tea"]
+    # the partially written quantity is dropped rather than guessed
+    assert invoice["items"][1]["quantity"] == 0.0
+
+
+def test_truncated_string_is_dropped():
+    assert json.loads(repair_json('{"a": 1, "b": "unfinis')) == {"a": 1}
+
+
+def test_coerces_numbers_and_rates():
+    invoice = parse_invoice_output(json.dumps({
+        "total_amount_after_vat": "4.118.792",
+        "total_vat_amount": "305,096 VND",
+        "total_amount_before_vat": "1.234,5",
+        "items": [{"vat_rate": "10%", "quantity": "x", "promotion_flag": "1"}],
+    }))
+
+    assert invoice["total_amount_after_vat"] == 4118792.0
+    assert invoice["total_vat_amount"] == 305096.0
+    assert invoice["total_amount_before_vat"] == 1234.5
+    item = invoice["items"][0]
+    assert item["vat_rate"] == 10.0
+    assert item["quantity"] == 0.0
+    assert item["promotion_flag"] is True
+
+
+def test_single_thousands_group_in_vnd_amounts():
+    """In VND amounts one 3-digit group after "." is a thousands group, like after ","."""
+    invoice = parse_invoice_output(json.dumps({
+        "total_amount_after_vat": "1.234",
+        "total_vat_amount": "305.096",
+        "total_amount_before_vat": "1,234",
+        "items": [{"unit_price": "8.373", "amount_after_vat": "1.302.168", "quantity": "1.250"}],
+    }))
+
+    assert invoice["total_amount_after_vat"] == 1234.0
+    assert invoice["total_vat_amount"] == 305096.0
+    assert invoice["total_amount_before_vat"] == 1234.0
+    item = invoice["items"][0]
+    assert item["unit_price"] == 8373.0
+    assert item["amount_after_vat"] == 1302168.0
+    # quantities may be fractional, "." stays a decimal point
+    assert item["quantity"] == 1.25
+
+    items = parse_items_output(json.dumps({"items": [{"line_number": 1, "vat_amount": "96.456"}]}))
+    assert items[0][1]["vat_amount"] == 96456.0
+
+
+def test_dot_is_decimal_for_other_currencies():
+    invoice = parse_invoice_output(json.dumps({
+        "currency_code": "USD",
+        "total_amount_after_vat": "1.234",
+        "total_vat_amount": "1,234",
+    }))
+
+    assert invoice["total_amount_after_vat"] == 1.234
+    assert invoice["total_vat_amount"] == 1234.0
+
+
+@pytest.mark.parametrize("text", ["", "Sorry, I cannot read this invoice.", "[1, 2]", '{"notes": "nothing"}'])
+def test_rejects_unusable_output(text):
+    with pytest.raises(InvalidModelOutput):
+        parse_invoice_output(text)
+
+
+@patch.object(extractor, '_plan_pdf_extraction', return_value=ChunkPlan(prompt="prompt"))
+@patch.object(extractor, 'get_model')
+def test_pdf_extraction_returns_dict(mock_get_model, mock_prompt):
+    """The PDF path requests schema output and returns a parsed dict."""
+    model = MagicMock()
+    model.generate_content.return_value = MagicMock(text='{"invoice_number": "9", "items": [%s]}' % ITEM)
+    mock_get_model.return_value = model
+
+    invoice = extractor._pdf_extraction_logic("invoice.pdf")
+
+    assert invoice["invoice_number"] == "9"
+    config = model.generate_content.call_args[1]["generation_config"]
+    assert config["response_mime_type"] == "application/json"
+
+
+@patch.object(extractor, '_plan_pdf_extraction', return_value=ChunkPlan(prompt="prompt"))
+@patch.object(extractor, 'get_model')
+def test_pdf_extraction_unusable_output(mock_get_model, mock_prompt):
+    mock_get_model.return_value.generate_content.return_value = MagicMock(text="no invoice here")
+
+    assert extractor._pdf_extraction_logic("invoice.pdf") is None
@@ -0,0 +1,242 @@
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from unittest.mock import patch, MagicMock
+from ms2_extractor.core import ms2_invoice_extractor as extractor
+from ms2_extractor.core.ms2_async_service import AsyncExtractionService
+from ms2_extractor.core.ms2_llm_output import ITEMS_GENERATION_CONFIG, InvalidModelOutput, parse_items_output
+from ms2_extractor.core.ms2_pdf_chunking import ChunkPlan, split_item_rows, plan_extraction, merge_chunks
+
+PROMPTS = {
+    "header_only": "HEADER ONLY",
+    "items_only": "ROWS {first}-{last}",
+}
+
+
+def _invoice_text(rows: int) -> str:
+    lines = [
+        "HÓA ĐƠN GIÁ TRỊ GIA TĂNG",
+        "Số: 0000123",
+        "1 Nguyễn Trãi, Hà Nội",
+        "STT Tên hàng hóa ĐVT Số lượng Đơn giá Thành tiền",
+    ]
+    for number in range(1, rows + 1):
+        lines.append(f"{number} Sản phẩm {number} HOP 1 1.000 1.000")
+        if number % 10 == 0:
+            lines.append("  (tên hàng xuống dòng)")
+    lines += ["Cộng tiền hàng: 1.000", "Tổng cộng tiền thanh toán: 1.080"]
+    return "\n".join(lines)
+
+
+def test_split_item_rows_finds_the_item_table():
+    """The address line "1 Nguyễn Trãi" is not mistaken for the first row; wrapped names stay with their row."""
+    header, rows, footer = split_item_rows(_invoice_text(25))
+
+    assert len(rows) == 25
+    assert rows[0].startswith("1 Sản phẩm 1 ")
+    assert rows[9].endswith("(tên hàng xuống dòng)")
+    assert header[-1].startswith("STT")
+    assert footer[0].startswith("Cộng tiền hàng")
+
+
+def test_short_tables_use_a_single_prompt():
+    plan = plan_extraction(_invoice_text(5), "INSTRUCTION", PROMPTS, rows_per_chunk=2, min_rows=5)
+
+    assert not plan.chunked
+    assert plan.prompt.startswith("INSTRUCTION")
+    assert "5 Sản phẩm 5" in plan.prompt
+
+
+def test_long_tables_are_split_on_row_boundaries():
+    plan = plan_extraction(_invoice_text(25), "INSTRUCTION", PROMPTS, rows_per_chunk=10, min_rows=20)
+
+    assert plan.chunked
+    assert plan.row_count == 25
+    assert [(first, last) for first, last, _ in plan.chunks] == [(1, 10), (11, 20), (21, 25)]
+    # Header chỉ chứa phần đầu + phần tổng tiền, không chứa dòng hàng
+    assert "HEADER ONLY" in plan.header_prompt
+    assert "Sản phẩm" not in plan.header_prompt
+    assert "Tổng cộng tiền thanh toán" in plan.header_prompt
+    second = plan.chunks[1][2]
+    assert "ROWS 11-20" in second
+    assert "STT Tên hàng hóa" in second
+    assert "11 Sản phẩm 11 " in second and "20 Sản phẩm 20 " in second
+    assert "21 Sản phẩm 21 " not in second
+
+
+def test_merge_drops_duplicate_and_out_of_range_rows():
+    plan = ChunkPlan(header_prompt="h", chunks=[(1, 2, "a"), (3, 4, "b")], row_count=4)
+    chunk_items = [
+        [(2, {"product_name": "B"}), (1, {"product_name": "A"}), (3, {"product_name": "C-leak"})],
+        [(3, {"product_name": "C"}), (None, {"product_name": "D"}), (3, {"product_name": "C-dup"})],
+    ]
+
+    invoice = merge_chunks(plan, {"invoice_number": "1", "items": []}, chunk_items)
+
+    assert invoice["invoice_number"] == "1"
+    assert [item["product_name"] for item in invoice["items"]] == ["A", "B", "C", "D"]
+
+
+def test_parse_items_output_keeps_line_numbers():
+    items = parse_items_output('{"items": [{"line_number": "12", "product_name": "Milk", "quantity": "2"}, '
+                               '{"product_name": "Tea"}]}')
+
+    assert items[0][0] == 12
+    assert items[0][1]["quantity"] == 2.0
+    assert items[1][0] is None
+    with pytest.raises(InvalidModelOutput):
+        parse_items_output('{"items": []}')
+
+
+class ChunkModel:
+    """Fake model answering header and chunk prompts; tracks how many calls overlap."""
+
+    def __init__(self, latency: float = 0.0, fail: str = None, failures: int = 1, currency: str = None):
+        self.latency = latency
+        self.fail = fail
+        self.failures = failures
+        self.currency = currency
+        self.active = self.peak = self.calls = 0
+        self.lock = threading.Lock()
+
+    def _answer(self, prompt, generation_config):
+        with self.lock:
+            self.calls += 1
+            if self.fail and self.fail in prompt and self.failures:
+                self.failures -= 1
+                return "not json"
+        if generation_config is not ITEMS_GENERATION_CONFIG:
+            header = {"invoice_number": "123", "total_amount_after_vat": 1080}
+            if self.currency:
+                header["currency_code"] = self.currency
+            return json.dumps(header)
+        first, last = (int(n) for n in prompt.split("ROWS ")[1].split()[0].split("-"))
+        return json.dumps({"items": [
+            {"line_number": n, "product_name": f"Sản phẩm {n}", "quantity": 1, "unit_price": "1.250"}
+            for n in range(first, last + 1)
+        ]})
+
+    def generate_content(self, prompt, generation_config=None):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.latency)
+        with self.lock:
+            self.active -= 1
+        return MagicMock(text=self._answer(prompt, generation_config))
+
+    async def generate_content_async(self, prompt, generation_config=None):
+        await asyncio.sleep(self.latency)
+        return MagicMock(text=self._answer(prompt, generation_config))
+
+
+@pytest.fixture
+def long_plan():
+    return plan_extraction(_invoice_text(100), "INSTRUCTION", PROMPTS, rows_per_chunk=20, min_rows=40)
+
+
+def test_chunks_are_extracted_concurrently(long_plan):
+    """Latency follows the chunk size, not the number of item rows."""
+    model = ChunkModel(latency=0.2)
+    with patch.object(extractor, '_plan_pdf_extraction', return_value=long_plan), \
+         patch.object(extractor, 'get_model', return_value=model):
+        started = time.perf_counter()
+        invoice = extractor._pdf_extraction_logic(b"%PDF")
+        elapsed = time.perf_counter() - started
+
+    assert invoice["invoice_number"] == "123"
+    assert [item["product_name"] for item in invoice["items"]] == [f"Sản phẩm {n}" for n in range(1, 101)]
+    assert "reconciliation" in invoice
+    assert model.peak == 6  # header + 5 chunks
+    # 6 sequential calls would take 1.2s
+    assert elapsed < 0.8
+
+
+def test_failed_chunk_is_retried(long_plan):
+    model = ChunkModel(fail="ROWS 41-60")
+    with patch.object(extractor, '_plan_pdf_extraction', return_value=long_plan), \
+         patch.object(extractor, 'get_model', return_value=model):
+        invoice = extractor._pdf_extraction_logic(b"%PDF")
+
+    assert len(invoice["items"]) == 100
+    assert model.calls == 7
+
+
+def test_chunk_failing_every_attempt_fails_the_invoice(long_plan):
+    model = ChunkModel(fail="ROWS 41-60", failures=extractor.CHUNK_ATTEMPTS)
+    with patch.object(extractor, '_plan_pdf_extraction', return_value=long_plan), \
+         patch.object(extractor, 'get_model', return_value=model):
+        assert extractor._pdf_extraction_logic(b"%PDF") is None
+
+
+def test_failed_header_is_retried(long_plan):
+    """The header request gets the same retries as a chunk."""
+    model = ChunkModel(fail="HEADER ONLY")
+    with patch.object(extractor, '_plan_pdf_extraction', return_value=long_plan), \
+         patch.object(extractor, 'get_model', return_value=model):
+        invoice = extractor._pdf_extraction_logic(b"%PDF")
+
+    assert invoice["invoice_number"] == "123"
+    assert model.calls == 7
+
+
+@pytest.mark.parametrize("currency, unit_price", [(None, 1250.0), ("USD", 1.25)])
+def test_chunk_amounts_follow_header_currency(long_plan, currency, unit_price):
+    """Chunks run before the header is known, so their amounts are coerced with its currency at merge time."""
+    model = ChunkModel(currency=currency)
+    with patch.object(extractor, '_plan_pdf_extraction', return_value=long_plan), \
+         patch.object(extractor, 'get_model', return_value=model):
+        invoice = extractor._pdf_extraction_logic(b"%PDF")
+
+    assert {item["unit_price"] for item in invoice["items"]} == {unit_price}
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    with patch.object(extractor, 'get_model', return_value=model):
+        invoice = asyncio.run(AsyncExtractionService(executor=executor).generate(long_plan))
+    executor.shutdown()
+
+    assert {item["unit_price"] for item in invoice["items"]} == {unit_price}
+
+
+def test_chunk_pool_is_shared_across_invoices(long_plan):
+    """Concurrent long PDFs share one bounded pool instead of each starting PDF_CHUNK_CONCURRENCY threads."""
+    model = ChunkModel(latency=0.05)
+    pool = ThreadPoolExecutor(max_workers=3)
+    with patch.object(extractor, '_plan_pdf_extraction', return_value=long_plan), \
+         patch.object(extractor, 'get_model', return_value=model), \
+         patch.object(extractor, 'CHUNK_POOL', pool):
+        with ThreadPoolExecutor(max_workers=4) as callers:
+            invoices = list(callers.map(extractor._pdf_extraction_logic, [b"%PDF"] * 4))
+    pool.shutdown()
+
+    assert all(len(invoice["items"]) == 100 for invoice in invoices)
+    assert model.peak == 3
+
+
+def test_async_service_retries_failed_header(long_plan):
+    executor = ThreadPoolExecutor(max_workers=2)
+    service = AsyncExtractionService(executor=executor)
+    model = ChunkModel(fail="HEADER ONLY")
+    with patch.object(extractor, 'get_model', return_value=model):
+        invoice = asyncio.run(service.generate(long_plan))
+    executor.shutdown()
+
+    assert invoice["invoice_number"] == "123"
+    assert model.calls == 7
+
+
+def test_async_service_runs_chunks_concurrently(long_plan):
+    executor = ThreadPoolExecutor(max_workers=2)
+    service = AsyncExtractionService(executor=executor)
+    model = ChunkModel(latency=0.2)
+    with patch.object(extractor, 'get_model', return_value=model):
+        started = time.perf_counter()
+        invoice = asyncio.run(service.generate(long_plan))
+        elapsed = time.perf_counter() - started
+    executor.shutdown()
+
+    assert [item["product_name"] for item in invoice["items"]] == [f"Sản phẩm {n}" for n in range(1, 101)]
+    assert elapsed < 0.8
@@ -0,0 +1,98 @@
+import os
+import time
+import pytest
+from unittest.mock import patch
+from utils.profiling import SamplingProfiler
+
+
+def _busy_work(n):
+    return sum(i * i for i in range(n))
+
+
+def test_disabled_profiler_writes_nothing(tmp_path):
+    """With sample rate 0 the wrapped function runs without profiling."""
+    profiler = SamplingProfiler(str(tmp_path), sample_rate=0.0)
+    wrapped = profiler.profiled("busy")(_busy_work)
+
+    assert wrapped(100) == _busy_work(100)
+    assert os.listdir(tmp_path) == []
+
+
+def test_sampled_call_writes_profile(tmp_path):
+    """A sampled call is dumped as a .prof file."""
+    profiler = SamplingProfiler(str(tmp_path), sample_rate=1.0)
+    wrapped = profiler.profiled("busy")(_busy_work)
+
+    wrapped(1000)
+
+    files = os.listdir(tmp_path)
+    assert len(files) == 1
+    assert files[0].endswith("-busy.prof")
+
+
+def test_rotation_keeps_newest_files(tmp_path):
+    """Only max_files profiles are kept on disk."""
+    profiler = SamplingProfiler(str(tmp_path), sample_rate=1.0, max_files=2)
+
+    for _ in range(4):
+        with profiler.profile("busy"):
+            _busy_work(100)
+
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_top_functions_reports_hot_function(tmp_path):
+    """top_functions aggregates recent profiles."""
+    profiler = SamplingProfiler(str(tmp_path), sample_rate=1.0)
+    for _ in range(2):
+        with profiler.profile("busy"):
+            _busy_work(20000)
+
+    report = profiler.top_functions(minutes=5, limit=50, sort="cumtime")
+
+    assert report["profiles"] == 2
+    assert any("_busy_work" in row["function"] for row in report["functions"])
+
+
+def test_top_functions_skips_unreadable_oldest_profile(tmp_path):
+    """A corrupt first file (or one removed by rotation) is skipped instead of failing the report."""
+    profiler = SamplingProfiler(str(tmp_path), sample_rate=1.0)
+    corrupt = tmp_path / "0-corrupt.prof"
+    corrupt.write_bytes(b"not a profile")
+    os.utime(corrupt, (time.time() - 10, time.time() - 10))
+    with profiler.profile("busy"):
+        _busy_work(20000)
+
+    report = profiler.top_functions(minutes=5, limit=50)
+    assert report["profiles"] == 1
+
+    real_getmtime = os.path.getmtime
+
+    def vanished(path):
+        if path.endswith("-busy.prof"):
+            raise FileNotFoundError(path)
+        return real_getmtime(path)
+
+    with patch("utils.profiling.os.path.getmtime", side_effect=vanished):
+        assert profiler.top_functions(minutes=5) == {"profiles": 0, "functions": []}
+
+
+def test_admin_endpoints_denied_without_token():
+    """Admin endpoints are closed unless ADMIN_TOKEN is configured and sent."""
+    from ms2_extractor.core import ms2_apiHandler as api
+    client = api.app.test_client()
+
+    with patch.object(api, 'ADMIN_TOKEN', None):
+        assert client.post("/admin/profiling", json={"sample_rate": 1.0}).status_code == 401
+    with patch.object(api, 'ADMIN_TOKEN', "secret"):
+        assert client.get("/admin/profiling").status_code == 401
+        assert client.get("/admin/profiling", headers={"X-Admin-Token": "wrong"}).status_code == 401
+        assert client.get("/admin/profiling", headers={"X-Admin-Token": "secret"}).status_code == 200
+    assert api.PROFILER.sample_rate != 1.0
+
+
+def test_invalid_sample_rate():
+    """Sample rates outside [0, 1] are rejected."""
+    profiler = SamplingProfiler("unused")
+    with pytest.raises(ValueError):
+        profiler.set_sample_rate(1.5)
@@ -0,0 +1,171 @@
+import copy
+import numpy as np
+from ms2_extractor.core import ms2_invoice_extractor as extractor
+from ms2_extractor.core.ms2_extracted_sink import ExtractedSink, load_segment, list_segments
+from ms2_extractor.core.ms2_reconciliation import (
+    MAX_REPORTED_LINES,
+    SMALL_INVOICE_LINES,
+    reconcile_invoice,
+    reconcile_invoices,
+    reconcile_segment,
+)
+
+
+def _item(quantity, unit_price, rate, before=None, vat=None, after=None):
+    before = quantity * unit_price if before is None else before
+    vat = before * rate / 100 if vat is None else vat
+    return {
+        "product_code": "", "product_name": "", "unit_name": "",
+        "quantity": float(quantity), "unit_price": float(unit_price), "amount_before_vat": float(before),
+        "vat_rate": float(rate), "vat_amount": float(vat),
+        "amount_after_vat": float(before + vat if after is None else after), "promotion_flag": False,
+    }
+
+
+def _invoice(items, **totals):
+    invoice = {
+        "invoice_number": "1",
+        "total_amount_before_vat": sum(item["amount_before_vat"] for item in items),
+        "total_vat_amount": sum(item["vat_amount"] for item in items),
+        "total_amount_after_vat": sum(item["amount_after_vat"] for item in items),
+        "items": items,
+    }
+    invoice.update(totals)
+    return invoice
+
+
+def test_consistent_invoice_reconciles():
+    """Per-rate VAT summary is computed and a consistent invoice is ok."""
+    invoice = reconcile_invoice(_invoice([_item(2, 1000, 10), _item(1, 500, 8), _item(3, 100, 10)]))
+
+    assert invoice["vat_rate_summary"] == {"8%": 40.0, "10%": 230.0}
+    assert invoice["reconciliation"]["status"] == "ok"
+    assert invoice["reconciliation"]["line_mismatch_count"] == 0
+    assert all(check["matches"] for check in invoice["reconciliation"]["totals"].values())
+
+
+def test_detects_line_and_total_mismatches():
+    items = [_item(2, 1000, 10), _item(2, 1000, 10, before=2500), _item(1, 100, 10, vat=50)]
+    invoice = reconcile_invoice(_invoice(items, total_amount_after_vat=99999.0))
+
+    report = invoice["reconciliation"]
+    assert report["status"] == "mismatch"
+    assert {(line["line"], line["field"]) for line in report["line_mismatches"]} == {
+        (1, "amount_before_vat"), (2, "vat_amount"),
+    }
+    totals = report["totals"]
+    assert not totals["total_amount_after_vat"]["matches"]
+    assert totals["total_amount_after_vat"]["difference"] == round(99999.0 - totals["total_amount_after_vat"]["items"], 2)
+    assert totals["total_amount_before_vat"]["matches"]
+
+
+def test_tolerates_rounding_and_missing_values():
+    """Rounded VAT, missing totals and services without quantity are not flagged."""
+    items = [_item(3, 333, 10, vat=100.0), _item(0, 0, 0, before=5000, vat=0)]
+    invoice = reconcile_invoice(_invoice(items, total_amount_after_vat=0.0))
+
+    assert invoice["reconciliation"]["status"] == "ok"
+
+
+def test_batch_matches_single_invoice_results():
+    """Line indexes are relative to each invoice when reconciled as a batch."""
+    invoices = [
+        _invoice([_item(1, 100, 10), _item(1, 100, 5, before=150)]),
+        _invoice([]),
+        _invoice([_item(4, 250, 8), _item(1, 1, 0)], total_vat_amount=1.0),
+    ]
+    singles = [reconcile_invoice(copy.deepcopy(invoice)) for invoice in invoices]
+
+    assert reconcile_invoices(invoices) == singles
+    assert invoices[0]["reconciliation"]["line_mismatches"][0]["line"] == 1
+    assert invoices[1]["vat_rate_summary"] == {}
+    assert invoices[2]["reconciliation"]["totals"]["total_vat_amount"]["matches"] is False
+
+
+def test_small_invoice_loop_matches_vectorized_path():
+    """Invoices below SMALL_INVOICE_LINES take the Python loop and must agree with the NumPy batch path."""
+    rng = np.random.default_rng(7)
+    invoices = []
+    for n_items in (0, 1, 3, 25, SMALL_INVOICE_LINES - 1, SMALL_INVOICE_LINES + 5):
+        items = []
+        for _ in range(n_items):
+            quantity, unit_price = float(rng.integers(0, 20)), float(rng.integers(0, 5000))
+            rate = float(rng.choice([0, 5, 8, 10]))
+            before = quantity * unit_price + float(rng.choice([0, 0, 0, 3000]))
+            vat = float(rng.choice([0.0, round(before * rate / 100), before * rate / 100 + 700]))
+            after = float(rng.choice([0.0, before + vat]))
+            items.append(_item(quantity, unit_price, rate, before=before, vat=vat, after=after))
+        invoices.append(_invoice(items, total_vat_amount=float(rng.choice([0.0, 1.0, 123.0]))))
+
+    singles = [reconcile_invoice(copy.deepcopy(invoice)) for invoice in invoices]
+
+    assert reconcile_invoices(invoices) == singles
+    assert any(invoice["reconciliation"]["line_mismatch_count"] for invoice in singles)
+
+
+def test_reported_lines_are_capped():
+    items = [_item(1, 100, 10, before=200) for _ in range(MAX_REPORTED_LINES + 5)]
+    report = reconcile_invoice(_invoice(items))["reconciliation"]
+
+    assert report["line_mismatch_count"] > MAX_REPORTED_LINES
+    assert len(report["line_mismatches"]) == MAX_REPORTED_LINES
+
+
+def test_items_with_missing_fields():
+    invoice = reconcile_invoice({"total_amount_before_vat": "100", "items": [{"amount_before_vat": 100.0, "vat_amount": "x"}]})
+
+    assert invoice["vat_rate_summary"] == {"0%": 0.0}
+    assert invoice["reconciliation"]["status"] == "ok"
+
+
+def test_map_invoice_attaches_reconciliation():
+    xml = """<HDon><DLHDon><TTChung><SHDon>1</SHDon></TTChung><NDHDon><DSHHDVu><HHDVu>
+    <SLuong>2</SLuong><DGia>1000</DGia><ThTien>2000</ThTien><TSuat>10%</TSuat>
+    <TTKhac><TTin><TTruong>Tiền thuế</TTruong><DLieu>200</DLieu></TTin></TTKhac></HHDVu></DSHHDVu>
+    <TToan><TgTCThue>2000</TgTCThue><TgTThue>200</TgTThue></TToan></NDHDon></DLHDon></HDon>"""
+
+    invoice = extractor.map_invoice(xml)
+
+    assert invoice["vat_rate_summary"] == {"10%": 200.0}
+    assert invoice["reconciliation"]["totals"]["total_vat_amount"]["matches"]
+
+
+def test_lines_without_vat_amounts_are_derived_from_the_rate():
+    """A TT78 invoice without TTKhac has no per-line VAT; it is derived, not treated as 0."""
+    xml = """<HDon><DLHDon><TTChung><SHDon>1</SHDon></TTChung><NDHDon><DSHHDVu><HHDVu>
+    <SLuong>2</SLuong><DGia>1000</DGia><ThTien>2000</ThTien><TSuat>10%</TSuat></HHDVu></DSHHDVu>
+    <TToan><TgTCThue>2000</TgTCThue><TgTThue>200</TgTThue><TgTTTBSo>2200</TgTTTBSo></TToan></NDHDon></DLHDon></HDon>"""
+
+    invoice = extractor.map_invoice(xml)
+
+    assert invoice["vat_rate_summary"] == {"10%": 200.0}
+    report = invoice["reconciliation"]
+    assert report["status"] == "ok"
+    assert report["line_mismatch_count"] == 0
+    assert report["totals"]["total_amount_after_vat"]["items"] == 2200.0
+
+
+def test_total_check_skipped_when_column_missing_on_every_line():
+    items = [_item(2, 1000, 0, vat=0, after=0)]
+    invoice = reconcile_invoice(_invoice(items, total_vat_amount=180.0, total_amount_after_vat=2180.0))
+
+    totals = invoice["reconciliation"]["totals"]
+    assert totals["total_vat_amount"]["matches"]
+    # Không dòng nào có tiền thuế/thành tiền sau thuế nên tổng không được so
+    assert totals["total_amount_after_vat"]["matches"]
+    assert totals["total_amount_before_vat"]["matches"]
+
+
+def test_reconcile_segment_arrays(tmp_path):
+    """Stored segments are reconciled straight from the (memory-mapped) arrays."""
+    sink = ExtractedSink(str(tmp_path), batch_size=100, flush_interval=60)
+    sink.append("a", _invoice([_item(1, 100, 10)]), source="xml")
+    sink.append("b", _invoice([_item(1, 100, 10), _item(1, 100, 10, before=300)]), source="xml")
+    sink.flush()
+
+    headers, items = load_segment(str(tmp_path), list_segments(str(tmp_path))[0])
+    result = reconcile_segment(headers, items)
+
+    assert result["line_mismatch"].any(axis=1).tolist() == [False, False, True]
+    assert np.allclose(result["rate_vat_amount"], [10.0, 40.0])
+    sink.close()
@@ -0,0 +1,55 @@
+import json
+from utils.traffic import TrafficRecorder, load_records, KIND_HTTP, KIND_QUEUE
+from ms2_extractor.benchmarks.loadgen import percentile, summarize, Results
+
+
+def test_recorder_round_trip(tmp_path):
+    """Recorded requests and messages load back in order."""
+    path = str(tmp_path / "traffic.jsonl")
+    recorder = TrafficRecorder(path)
+    recorder.record(KIND_HTTP, {"email_id": "a", "isInvoice": True}, path="/extract", lane="xml")
+    recorder.record(KIND_QUEUE, {"email_id": "b"}, queue="queue.for_extraction", lane="pdf")
+
+    records = load_records(path)
+    assert [r["kind"] for r in records] == [KIND_HTTP, KIND_QUEUE]
+    assert records[0]["body"]["email_id"] == "a"
+    assert records[1]["lane"] == "pdf"
+
+
+def test_load_records_skips_bad_lines(tmp_path):
+    """Blank, malformed and unknown-kind lines are ignored."""
+    path = tmp_path / "traffic.jsonl"
+    path.write_text(
+        "\n".join([
+            json.dumps({"kind": "http", "body": {"email_id": "a"}}),
+            "",
+            "{not json",
+            json.dumps({"kind": "other"}),
+        ]),
+        encoding="utf-8",
+    )
+
+    assert len(load_records(str(path))) == 1
+
+
+def test_percentile_nearest_rank():
+    """Nearest-rank percentiles over a sorted sample."""
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 95) == 95.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([], 99) == 0.0
+
+
+def test_summarize_per_lane():
+    """Summary reports each lane plus the combined view."""
+    results = Results()
+    results.add("xml", 0.010, "201")
+    results.add("xml", 0.020, "201")
+    results.add("pdf", 2.0, "429")
+
+    summary = summarize(results, elapsed=1.0)
+    assert summary["xml"]["requests"] == 2
+    assert summary["pdf"]["outcomes"] == {"429": 1}
+    assert summary["all"]["requests"] == 3
+    assert summary["all"]["throughput_rps"] == 3.0
@@ -0,0 +1,213 @@
+import os
+import pytest
+import xmltodict
+import yaml
+from ms2_extractor.core.ms2_xml_mapper import XmlInvoiceMapper, SchemaError, UnknownLayoutError, HEADER_FIELDS, ITEM_FIELDS
+
+SCHEMA_FILE = os.path.join(
+    os.path.dirname(__file__), "..", "utils", "schemas", "xml_invoice_schemas.yaml"
+)
+
+HDON_BODY = """
+<DLHDon>
+  <TTChung>
+    <THDon>Hóa đơn giá trị gia tăng</THDon>
+    <KHMSHDon>1</KHMSHDon>
+    <KHHDon>C25TAA</KHHDon>
+    <SHDon>9991</SHDon>
+    <NLap>2025-03-31</NLap>
+  </TTChung>
+  <NDHDon>
+    <NBan><Ten>CONG TY A</Ten><MST>2901270911</MST><DChi>Nghe An</DChi></NBan>
+    <NMua><Ten>CONG TY B</Ten><MST>0104918404</MST><DChi>Quang Binh</DChi></NMua>
+    <DSHHDVu>
+      <HHDVu>
+        <MHHDVu>452000209</MHHDVu>
+        <THHDVu>SUA TUOI</THHDVu>
+        <DVTinh>HOP</DVTinh>
+        <SLuong>144</SLuong>
+        <DGia>8373</DGia>
+        <ThTien>1205712</ThTien>
+        <TSuat>8%</TSuat>
+        <TTKhac>
+          <TTin><TTruong>Tiền thuế</TTruong><DLieu>96456</DLieu></TTin>
+          <TTin><TTruong>TTMR</TTruong><DLieu><TTST>1302168</TTST><KM>1</KM></DLieu></TTin>
+        </TTKhac>
+      </HHDVu>
+    </DSHHDVu>
+    <TToan><TgTCThue>1205712</TgTCThue><TgTThue>96456</TgTThue><TgTTTBSo>1302168</TgTTTBSo></TToan>
+  </NDHDon>
+</DLHDon>
+"""
+
+
+@pytest.fixture(scope="module")
+def mapper():
+    with open(SCHEMA_FILE, encoding="utf-8") as f:
+        return XmlInvoiceMapper(yaml.safe_load(f)["schemas"])
+
+
+def _assert_sample_invoice(invoice):
+    assert invoice["invoice_number"] == "9991"
+    assert invoice["vendor_tax_code"] == "2901270911"
+    assert invoice["buyer_name"] == "CONG TY B"
+    assert invoice["currency_code"] == "VND"
+    assert invoice["total_amount_after_vat"] == 1302168.0
+    assert invoice["items"] == [{
+        "product_code": "452000209",
+        "product_name": "SUA TUOI",
+        "unit_name": "HOP",
+        "quantity": 144.0,
+        "unit_price": 8373.0,
+        "amount_before_vat": 1205712.0,
+        "vat_rate": 8.0,
+        "vat_amount": 96456.0,
+        "amount_after_vat": 1302168.0,
+        "promotion_flag": True,
+    }]
+
+
+def test_maps_default_hdon_layout(mapper):
+    """The TT78 HDon layout maps to the normalized invoice dict."""
+    data = xmltodict.parse(f"<HDon>{HDON_BODY}</HDon>")
+
+    assert mapper.detect(data).name == "hdon_tt78"
+    _assert_sample_invoice(mapper.map(data))
+
+
+def test_maps_tdiep_envelope(mapper):
+    """An invoice wrapped in a TDiep envelope stays on the XML path."""
+    data = xmltodict.parse(
+        f"<TDiep><TTChung><MLTDiep>200</MLTDiep></TTChung><DLieu><HDon>{HDON_BODY}</HDon></DLieu></TDiep>"
+    )
+
+    assert mapper.detect(data).name == "tdiep_hdon_tt78"
+    _assert_sample_invoice(mapper.map(data))
+
+
+def test_detection_checks_namespace_and_order():
+    """Schemas sharing a root are tried in order; a namespace mismatch falls through to the next."""
+    spec = _provider_x_spec()
+    fallback = {**_provider_x_spec(), "name": "provider_x_any"}
+    del fallback["detect"]["namespace"]
+    mapper = XmlInvoiceMapper([spec, fallback])
+
+    assert mapper.detect(xmltodict.parse('<Invoice xmlns="urn:provider-x"><Head/></Invoice>')).name == "provider_x"
+    assert mapper.detect(xmltodict.parse('<Invoice xmlns="urn:other"><Head/></Invoice>')).name == "provider_x_any"
+    assert mapper.detect(xmltodict.parse("<Invoice/>")) is None
+
+
+def test_detection_keys_on_nested_fingerprint(mapper):
+    """Documents with the same top-level elements but a different nested layout are not conflated."""
+    invoice = xmltodict.parse(f"<TDiep><TTChung/><DLieu><HDon>{HDON_BODY}</HDon></DLieu></TDiep>")
+    notice = xmltodict.parse("<TDiep><TTChung/><DLieu><TBao><MTDiep>1</MTDiep></TBao></DLieu></TDiep>")
+
+    assert mapper.detect(invoice).name == "tdiep_hdon_tt78"
+    assert mapper.detect(notice) is None
+    with pytest.raises(UnknownLayoutError):
+        mapper.map(notice)
+
+
+def test_maps_prefixed_namespace(mapper):
+    """Namespace prefixes on the root and nested elements are ignored by detection and paths."""
+    body = HDON_BODY.replace("<", "<inv:").replace("<inv:/", "</inv:")
+    data = xmltodict.parse(f'<inv:HDon xmlns:inv="urn:einvoice">{body}</inv:HDon>')
+
+    assert mapper.detect(data).name == "hdon_tt78"
+    _assert_sample_invoice(mapper.map(data))
+
+
+def test_unknown_layout_is_rejected(mapper):
+    """An unrecognized root raises instead of producing an invoice with empty fields."""
+    data = xmltodict.parse("<Other><X>1</X></Other>")
+
+    assert mapper.detect(data) is None
+    with pytest.raises(UnknownLayoutError) as exc_info:
+        mapper.map(data)
+    assert exc_info.value.root == "Other"
+
+
+def _provider_x_spec(**header_overrides):
+    header = {name: {"default": ""} for name, kind in HEADER_FIELDS.items() if kind == "str"}
+    header.update({
+        "invoice_number": {"path": "Head/No"},
+        "currency_code": {"default": "VND"},
+        "total_amount_before_vat": {"path": "Head/Net", "type": "float"},
+        "total_vat_amount": {"path": "Head/Tax", "type": "float"},
+        "total_amount_after_vat": {"path": "Head/Total", "type": "float"},
+    })
+    header.update(header_overrides)
+    return {
+        "name": "provider_x",
+        "detect": {"root": "Invoice", "namespace": "urn:provider-x"},
+        "header": header,
+        "items": {
+            "path": "Lines/Line",
+            "fields": {
+                "product_code": {"default": ""},
+                "product_name": {"path": "Name"},
+                "unit_name": {"default": ""},
+                "quantity": {"path": "Qty", "type": "float"},
+                "unit_price": {"path": "Price", "type": "float"},
+                "amount_before_vat": {"path": "Net", "type": "float"},
+                "vat_rate": {"path": "Vat", "type": "percent"},
+                "vat_amount": {"path": "Tax", "type": "float"},
+                "amount_after_vat": {"path": "Total", "type": "float"},
+                "promotion_flag": {"default": False, "type": "flag"},
+            },
+        },
+    }
+
+
+def test_custom_provider_schema():
+    """A provider layout is added purely through a spec and yields the full normalized invoice."""
+    mapper = XmlInvoiceMapper([_provider_x_spec()])
+    data = xmltodict.parse(
+        '<x:Invoice xmlns:x="urn:provider-x"><x:Head><x:No>7</x:No><x:Net>10</x:Net><x:Tax>0.5</x:Tax>'
+        '<x:Total>10.5</x:Total></x:Head><x:Lines><x:Line><x:Name>A</x:Name><x:Qty>2</x:Qty><x:Price>5</x:Price>'
+        '<x:Net>10</x:Net><x:Vat>KCT</x:Vat><x:Tax>0.5</x:Tax><x:Total>10.5</x:Total></x:Line></x:Lines></x:Invoice>'
+    )
+
+    invoice = mapper.map(data)
+    assert set(invoice) == set(HEADER_FIELDS) | {"items"}
+    assert invoice["invoice_number"] == "7"
+    assert invoice["currency_code"] == "VND"
+    assert invoice["vendor_name"] == ""
+    assert invoice["total_amount_after_vat"] == 10.5
+    assert invoice["items"] == [{
+        "product_code": "",
+        "product_name": "A",
+        "unit_name": "",
+        "quantity": 2.0,
+        "unit_price": 5.0,
+        "amount_before_vat": 10.0,
+        "vat_rate": 0.0,
+        "vat_amount": 0.5,
+        "amount_after_vat": 10.5,
+        "promotion_flag": False,
+    }]
+    assert set(invoice["items"][0]) == set(ITEM_FIELDS)
+
+
+def test_partial_provider_schema_rejected():
+    """Specs must cover the normalized field set with the normalized types."""
+    spec = _provider_x_spec()
+    del spec["header"]["invoice_type"]
+    with pytest.raises(SchemaError, match="invoice_type"):
+        XmlInvoiceMapper([spec])
+
+    with pytest.raises(SchemaError, match="seller"):
+        XmlInvoiceMapper([_provider_x_spec(seller={"path": "Head/Seller"})])
+
+    with pytest.raises(SchemaError, match="total_vat_amount"):
+        XmlInvoiceMapper([_provider_x_spec(total_vat_amount={"path": "Head/Tax"})])
+
+
+def test_invalid_field_type_rejected():
+    """Malformed specs fail at compile time, not per request."""
+    with pytest.raises(SchemaError):
+        XmlInvoiceMapper([{
+            "name": "broken",
+            "detect": {"root": "HDon"},
+            "header": {**{name: {"default": ""} for name in HEADER_FIELDS}, "invoice_number": {"path": "A/B", "type": "decimal"}},
+        }])
@@ -0,0 +1,249 @@
+import math
+import asyncio
+import threading
+import time
+import logging
+from contextlib import contextmanager, asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Queue-wait histogram bucket upper bounds (seconds)
+WAIT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request cannot be admitted to a lane.
+
+    Attributes:
+        lane: Name of the lane that rejected the request
+        status_code: 429 when the wait queue is full, 503 when the wait timed out
+        retry_after: Suggested client back-off in whole seconds
+    """
+    def __init__(self, lane: str, status_code: int, retry_after: int, reason: str):
+        super().__init__(f"[{lane}] {reason}")
+        self.lane = lane
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Bounds the number of in-flight requests for one extraction lane.
+
+    Up to `max_inflight` requests run concurrently and up to `max_queue` more
+    may wait for a slot, each for at most `queue_timeout` seconds. Anything
+    beyond that is rejected immediately so the caller can back off instead of
+    timing out. Retry-After is derived from the observed service time.
+
+    Queue consumers admit with `block=True`: the broker prefetch already bounds
+    their backlog, so they wait for a slot without the queue limit or timeout.
+    """
+    def __init__(self, name: str, max_inflight: int, max_queue: int = 0,
+                 queue_timeout: float = 0.0, ewma_alpha: float = 0.2):
+        if max_inflight < 1:
+            raise ValueError(f"max_inflight must be >= 1, got {max_inflight}")
+        self.name = name
+        self.max_inflight = max_inflight
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = max(0.0, queue_timeout)
+        self.ewma_alpha = ewma_alpha
+
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._waiting = 0
+        self._blocked = 0
+        self._service_time = None  # EWMA of service time (seconds)
+
+        # Metrics
+        self._admitted = 0
+        self._rejected_queue_full = 0
+        self._rejected_timeout = 0
+        self._wait_count = 0
+        self._wait_sum = 0.0
+        self._wait_max = 0.0
+        self._wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+
+    # ---------------- Admission ----------------
+
+    @contextmanager
+    def admit(self, block: bool = False, arrived: float = None):
+        """
+        Context manager that holds a lane slot for the duration of the block.
+
+        Args:
+            block: Wait for a slot without the queue limit or timeout
+            arrived: time.monotonic() when the job was received, if it already
+                waited elsewhere (e.g. in an executor backlog); defaults to now
+
+        Yields:
+            Seconds spent waiting for the slot
+
+        Raises:
+            AdmissionRejected: If the queue is full or the wait timed out
+        """
+        queue_wait = self._acquire(block, time.monotonic() if arrived is None else arrived)
+        started = time.monotonic()
+        try:
+            yield queue_wait
+        finally:
+            self._release(time.monotonic() - started)
+
+    def _acquire(self, block: bool, arrived: float) -> float:
+        with self._cond:
+            if self._inflight >= self.max_inflight:
+                if block:
+                    self._blocked += 1
+                    try:
+                        while self._inflight >= self.max_inflight:
+                            self._cond.wait()
+                    finally:
+                        self._blocked -= 1
+                else:
+                    self._wait_for_slot_locked(arrived)
+            return self._admit_locked(arrived)
+
+    def _wait_for_slot_locked(self, arrived: float):
+        if self._waiting >= self.max_queue:
+            self._rejected_queue_full += 1
+            raise AdmissionRejected(
+                self.name, 429, self._retry_after_locked(), "Too many requests in flight"
+            )
+
+        self._waiting += 1
+        deadline = arrived + self.queue_timeout
+        try:
+            while self._inflight >= self.max_inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._timed_out_locked(arrived)
+                self._cond.wait(remaining)
+        finally:
+            self._waiting -= 1
+
+    def _timed_out_locked(self, arrived: float) -> AdmissionRejected:
+        self._rejected_timeout += 1
+        self._record_wait_locked(time.monotonic() - arrived)
+        return AdmissionRejected(self.name, 503, self._retry_after_locked(), "Timed out waiting for a slot")
+
+    def _admit_locked(self, arrived: float) -> float:
+        self._inflight += 1
+        self._admitted += 1
+        queue_wait = time.monotonic() - arrived
+        self._record_wait_locked(queue_wait)
+        return queue_wait
+
+    def _release(self, service_time: float):
+        with self._cond:
+            self._inflight -= 1
+            if self._service_time is None:
+                self._service_time = service_time
+            else:
+                self._service_time += self.ewma_alpha * (service_time - self._service_time)
+            self._cond.notify()
+
+    # ---------------- Metrics ----------------
+
+    def _record_wait_locked(self, seconds: float):
+        self._wait_count += 1
+        self._wait_sum += seconds
+        self._wait_max = max(self._wait_max, seconds)
+        for i, bound in enumerate(WAIT_BUCKETS):
+            if seconds <= bound:
+                self._wait_buckets[i] += 1
+                break
+        else:
+            self._wait_buckets[-1] += 1
+
+    def _retry_after_locked(self) -> int:
+        """Estimate seconds until a new arrival would get a slot."""
+        service_time = self._service_time or 1.0
+        ahead = self._waiting + 1
+        return max(1, math.ceil(service_time * ahead / self.max_inflight))
+
+    def retry_after(self) -> int:
+        with self._cond:
+            return self._retry_after_locked()
+
+    def snapshot(self) -> dict:
+        """Return a point-in-time view of the lane's counters."""
+        with self._cond:
+            buckets = {f"le_{bound}": count for bound, count in zip(WAIT_BUCKETS, self._wait_buckets)}
+            buckets["le_inf"] = self._wait_buckets[-1]
+            return {
+                "lane": self.name,
+                "max_inflight": self.max_inflight,
+                "max_queue": self.max_queue,
+                "inflight": self._inflight,
+                "waiting": self._waiting,
+                "blocked": self._blocked,
+                "admitted": self._admitted,
+                "rejected": {
+                    "queue_full": self._rejected_queue_full,
+                    "timeout": self._rejected_timeout,
+                },
+                "service_time_avg": self._service_time,
+                "queue_wait": {
+                    "count": self._wait_count,
+                    "sum": self._wait_sum,
+                    "max": self._wait_max,
+                    "buckets": buckets,
+                },
+            }
+
+
+class AsyncAdmissionController(AdmissionController):
+    """
+    asyncio counterpart of AdmissionController for code running on one event loop.
+
+    Waiters are coroutines parked on an asyncio.Semaphore instead of threads;
+    limits, Retry-After and the snapshot() shape are the same. All calls must
+    come from the loop's thread.
+    """
+    def __init__(self, name: str, max_inflight: int, max_queue: int = 0,
+                 queue_timeout: float = 0.0, ewma_alpha: float = 0.2):
+        super().__init__(name, max_inflight, max_queue, queue_timeout, ewma_alpha)
+        self._slots = asyncio.Semaphore(max_inflight)
+
+    @asynccontextmanager
+    async def admit(self, block: bool = False, arrived: float = None):
+        """Async form of AdmissionController.admit (`async with lane.admit():`)."""
+        queue_wait = await self._acquire_async(block, time.monotonic() if arrived is None else arrived)
+        started = time.monotonic()
+        try:
+            yield queue_wait
+        finally:
+            self._release(time.monotonic() - started)
+            self._slots.release()
+
+    async def _acquire_async(self, block: bool, arrived: float) -> float:
+        if not self._slots.locked():
+            await self._slots.acquire()
+        elif block:
+            self._blocked += 1
+            try:
+                await self._slots.acquire()
+            finally:
+                self._blocked -= 1
+        else:
+            with self._cond:
+                if self._waiting >= self.max_queue:
+                    self._rejected_queue_full += 1
+                    raise AdmissionRejected(
+                        self.name, 429, self._retry_after_locked(), "Too many requests in flight"
+                    )
+            remaining = arrived + self.queue_timeout - time.monotonic()
+            self._waiting += 1
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(self._slots.acquire(), remaining)
+            except asyncio.TimeoutError:
+                with self._cond:
+                    raise self._timed_out_locked(arrived)
+            finally:
+                self._waiting -= 1
+
+        with self._cond:
+            return self._admit_locked(arrived)
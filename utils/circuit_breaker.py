@@ -0,0 +1,206 @@
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a dependency whose circuit is open.
+
+    Attributes:
+        name: Name of the dependency ("gemini", "ms4", "rabbitmq")
+        retry_after: Whole seconds until the breaker lets a probe through
+    """
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} is unavailable (circuit open, retry in {retry_after}s)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Fails fast while a dependency is down instead of waiting on its timeout.
+
+    closed:    calls go through; `failure_threshold` consecutive failures open the circuit
+    open:      calls raise CircuitOpenError without touching the dependency for `open_seconds`
+    half_open: up to `half_open_probes` concurrent calls probe the dependency; a success
+               closes the circuit, a failure opens it for another `open_seconds`
+
+    Wrap a call in `with breaker.call():` (any exception counts as a failure), or use
+    before_call() / record_success() / record_failure() / release() when the outcome
+    is decided from a response, e.g. an HTTP 5xx. Thread-safe; also usable from an event loop
+    since the lock is never held across an await.
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, open_seconds: float = 30.0,
+                 half_open_probes: int = 1, clock=time.monotonic):
+        if failure_threshold < 1:
+            raise ValueError(f"failure_threshold must be >= 1, got {failure_threshold}")
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._consecutive_failures = 0
+        self._probes = 0
+
+        # Metrics
+        self._successes = 0
+        self._failures = 0
+        self._rejected = 0
+        self._times_opened = 0
+
+    # ---------------- State ----------------
+
+    def _state_locked(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+            logger.info(f"Circuit '{self.name}' half-open, probing")
+        return self._state
+
+    def _retry_after_locked(self) -> int:
+        remaining = self._opened_at + self.open_seconds - self._clock()
+        return max(1, math.ceil(remaining))
+
+    def _open_locked(self):
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._probes = 0
+        self._times_opened += 1
+        logger.warning(
+            f"Circuit '{self.name}' opened after {self._consecutive_failures} consecutive failures, "
+            f"failing fast for {self.open_seconds}s"
+        )
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state_locked()
+
+    def is_open(self) -> bool:
+        return self.state == OPEN
+
+    def check(self):
+        """Raise CircuitOpenError while the circuit is open, without taking a probe slot."""
+        with self._lock:
+            if self._state_locked() == OPEN:
+                self._rejected += 1
+                raise CircuitOpenError(self.name, self._retry_after_locked())
+
+    # ---------------- Calls ----------------
+
+    def before_call(self):
+        """
+        Reserve a call; must be followed by record_success() or record_failure().
+
+        Raises:
+            CircuitOpenError: If the circuit is open or all half-open probes are in flight
+        """
+        with self._lock:
+            state = self._state_locked()
+            if state == OPEN:
+                self._rejected += 1
+                raise CircuitOpenError(self.name, self._retry_after_locked())
+            if state == HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self._rejected += 1
+                    raise CircuitOpenError(self.name, 1)
+                self._probes += 1
+
+    def record_success(self):
+        with self._lock:
+            self._successes += 1
+            self._consecutive_failures = 0
+            if self._state_locked() == HALF_OPEN:
+                self._state = CLOSED
+                self._probes = 0
+                logger.info(f"Circuit '{self.name}' closed")
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._consecutive_failures += 1
+            state = self._state_locked()
+            if state == HALF_OPEN or (state == CLOSED and self._consecutive_failures >= self.failure_threshold):
+                self._open_locked()
+
+    def release(self):
+        """Give back a reserved call without an outcome (e.g. the caller was cancelled)."""
+        with self._lock:
+            if self._state_locked() == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    @contextmanager
+    def call(self):
+        """
+        Guard one call: fail fast while open, count any exception as a failure.
+
+        A BaseException such as asyncio.CancelledError says nothing about the
+        dependency, so it only releases the reserved probe slot.
+        """
+        self.before_call()
+        try:
+            yield
+        except Exception:
+            self.record_failure()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.record_success()
+
+    # ---------------- Metrics ----------------
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            state = self._state_locked()
+            return {
+                "name": self.name,
+                "state": state,
+                "retry_after": self._retry_after_locked() if state == OPEN else 0,
+                "consecutive_failures": self._consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "open_seconds": self.open_seconds,
+                "times_opened": self._times_opened,
+                "successes": self._successes,
+                "failures": self._failures,
+                "rejected": self._rejected,
+            }
+
+
+def health_report(breakers: dict, critical=()):
+    """
+    Summarize breaker states for a health endpoint.
+
+    Args:
+        breakers: {name: CircuitBreaker}
+        critical: Names of dependencies the instance cannot work around while
+            they are down; other open circuits only degrade it (e.g. publishes
+            are spooled, XML does not need the model)
+
+    Returns:
+        (report, status_code): "ok" (200) when every circuit is closed, "degraded"
+        (200) while a non-critical circuit is open or one is probing, "unavailable"
+        (503) while a critical circuit is open so load balancers route around the
+        instance
+    """
+    snapshots = {name: breaker.snapshot() for name, breaker in breakers.items()}
+    if any(snapshots[name]["state"] == OPEN for name in critical if name in snapshots):
+        status = "unavailable"
+    elif any(snapshot["state"] != CLOSED for snapshot in snapshots.values()):
+        status = "degraded"
+    else:
+        status = "ok"
+    return {"status": status, "breakers": snapshots}, 503 if status == "unavailable" else 200
@@ -26,6 +26,74 @@ LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 # ============= MS4 Settings =============
 MS4_PERSISTENCE_BASE_URL = os.getenv("MS4_PERSISTENCE_BASE_URL", "http://localhost:5004")
 
+# ============= Attachment Ingestion =============
+# Upper bound for attachments sent inline (base64 JSON / queue message) or as multipart upload
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", 10 * 1024 * 1024))
+
+# ============= Admission Control (/extract) =============
+# In-flight and waiting limits are set per extraction path: XML maps in
+# milliseconds, PDF waits on the model for seconds.
+EXTRACT_XML_MAX_INFLIGHT = int(os.getenv("EXTRACT_XML_MAX_INFLIGHT", 32))
+EXTRACT_XML_MAX_QUEUE = int(os.getenv("EXTRACT_XML_MAX_QUEUE", 64))
+EXTRACT_PDF_MAX_INFLIGHT = int(os.getenv("EXTRACT_PDF_MAX_INFLIGHT", 4))
+EXTRACT_PDF_MAX_QUEUE = int(os.getenv("EXTRACT_PDF_MAX_QUEUE", 8))
+EXTRACT_QUEUE_TIMEOUT = float(os.getenv("EXTRACT_QUEUE_TIMEOUT", 2.0))
+
+# ============= Priority Lanes =============
+# Jobs are classified by attachment type and run in their own lane ("xml"/"pdf"),
+# each with its own executor and limits, so a burst of PDFs waiting on the model
+# never delays XML extraction.
+# Worker threads per lane in the queue consumer (core/ms2_consumer.py)
+CONSUMER_XML_WORKERS = int(os.getenv("CONSUMER_XML_WORKERS", 4))
+CONSUMER_PDF_WORKERS = int(os.getenv("CONSUMER_PDF_WORKERS", 8))
+# Unacked messages the broker may push to each consumer; bounds the backlog
+# waiting in the lane executors. 0 = 2 x (CONSUMER_XML_WORKERS + CONSUMER_PDF_WORKERS)
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", 0))
+# Optional queue for the PDF lane. When set, consumers also read it and forward
+# PDF jobs arriving on RABBITMQ_CONSUME_QUEUE to it, so slow PDFs never hold
+# the main queue's prefetch window. Must exist (created by Queue Orchestrator).
+RABBITMQ_PDF_CONSUME_QUEUE = os.getenv("RABBITMQ_PDF_CONSUME_QUEUE")
+
+# ============= Circuit Breakers =============
+# Gemini, MS4 and RabbitMQ each have a breaker: CIRCUIT_FAILURE_THRESHOLD
+# consecutive failures open it for CIRCUIT_OPEN_SECONDS, during which calls fail
+# fast (publishes are spooled to SPOOL_DIR instead), then CIRCUIT_HALF_OPEN_PROBES
+# calls probe the dependency. Breaker state is served on /health.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30.0))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", 1))
+
+# ============= Reconciliation =============
+# Item amounts vs. invoice totals: a value matches when
+# |actual - expected| <= RECONCILE_TOLERANCE + RECONCILE_RELATIVE_TOLERANCE * |expected|
+RECONCILE_TOLERANCE = float(os.getenv("RECONCILE_TOLERANCE", 1.0))
+RECONCILE_RELATIVE_TOLERANCE = float(os.getenv("RECONCILE_RELATIVE_TOLERANCE", 0.001))
+
+# ============= Chunked PDF Extraction =============
+# PDFs whose item table has more than PDF_CHUNK_MIN_ROWS rows are extracted as
+# one header request plus one request per PDF_CHUNK_ROWS rows, run concurrently.
+# PDF_CHUNK_CONCURRENCY bounds the concurrent model requests of a whole process
+# (shared pool) in the sync paths, and of one invoice in the async service.
+PDF_CHUNK_ROWS = int(os.getenv("PDF_CHUNK_ROWS", 40))
+PDF_CHUNK_MIN_ROWS = int(os.getenv("PDF_CHUNK_MIN_ROWS", 60))
+PDF_CHUNK_CONCURRENCY = int(os.getenv("PDF_CHUNK_CONCURRENCY", 8))
+
+# ============= Async Service (core/ms2_async_service.py) =============
+# One event loop serves /extract and consumes RABBITMQ_CONSUME_QUEUE; invoices
+# waiting on the model/MS4/broker only hold a coroutine, so the limit is high.
+ASYNC_SERVICE_HOST = os.getenv("ASYNC_SERVICE_HOST", "0.0.0.0")
+ASYNC_SERVICE_PORT = int(os.getenv("ASYNC_SERVICE_PORT", 5003))
+# In-flight limit per lane; HTTP requests beyond it get 429, queue messages wait.
+ASYNC_XML_MAX_INFLIGHT = int(os.getenv("ASYNC_XML_MAX_INFLIGHT", 256))
+ASYNC_PDF_MAX_INFLIGHT = int(os.getenv("ASYNC_PDF_MAX_INFLIGHT", 256))
+ASYNC_QUEUE_PREFETCH = int(os.getenv("ASYNC_QUEUE_PREFETCH", 128))
+# "process" runs map_invoice/pypdf in worker processes (true parallelism),
+# "thread" keeps them in-process. Each lane has its own executor so PDF parsing
+# never queues ahead of XML mapping; 0 workers = os.cpu_count()
+ASYNC_EXECUTOR = os.getenv("ASYNC_EXECUTOR", "process").lower()
+ASYNC_XML_EXECUTOR_WORKERS = int(os.getenv("ASYNC_XML_EXECUTOR_WORKERS", 0))
+ASYNC_PDF_EXECUTOR_WORKERS = int(os.getenv("ASYNC_PDF_EXECUTOR_WORKERS", 2))
+
 # ============= Validation =============
 def validate_config():
     """Validate configuration"""
@@ -40,6 +108,24 @@ def validate_config():
     if not RABBITMQ_PASSWORD:
         errors.append("RABBITMQ_PASSWORD is required")
 
+    for name, value in (
+        ("EXTRACT_XML_MAX_INFLIGHT", EXTRACT_XML_MAX_INFLIGHT),
+        ("EXTRACT_PDF_MAX_INFLIGHT", EXTRACT_PDF_MAX_INFLIGHT),
+        ("CONSUMER_XML_WORKERS", CONSUMER_XML_WORKERS),
+        ("CONSUMER_PDF_WORKERS", CONSUMER_PDF_WORKERS),
+        ("ASYNC_XML_MAX_INFLIGHT", ASYNC_XML_MAX_INFLIGHT),
+        ("ASYNC_PDF_MAX_INFLIGHT", ASYNC_PDF_MAX_INFLIGHT),
+        ("CIRCUIT_FAILURE_THRESHOLD", CIRCUIT_FAILURE_THRESHOLD),
+        ("CIRCUIT_HALF_OPEN_PROBES", CIRCUIT_HALF_OPEN_PROBES),
+        ("PDF_CHUNK_ROWS", PDF_CHUNK_ROWS),
+        ("PDF_CHUNK_CONCURRENCY", PDF_CHUNK_CONCURRENCY),
+    ):
+        if value < 1:
+            errors.append(f"{name} must be >= 1")
+
+    if ASYNC_EXECUTOR not in ("process", "thread"):
+        errors.append("ASYNC_EXECUTOR must be 'process' or 'thread'")
+
     if errors:
         raise ValueError("Configuration errors:\n" + "\n".join(f"  - {e}" for e in errors))
 
@@ -51,9 +137,37 @@ BASE_DIR = os.path.dirname(__file__)
 ATTACH_DIR = os.path.join(BASE_DIR, "..", "storage", "attachments")
 EXTRACTED_DIR = os.path.join(BASE_DIR, "..", "storage", "extracted")
 
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(BASE_DIR, "..", "storage", "profiles"))
+# Messages that could not be published while RabbitMQ was unavailable
+SPOOL_DIR = os.getenv("SPOOL_DIR", os.path.join(BASE_DIR, "..", "storage", "spool"))
+# Spooled messages re-published per drain (after a successful publish or by the
+# background retry, which runs every SPOOL_RETRY_SECONDS even without traffic; 0 = off)
+SPOOL_DRAIN_BATCH = int(os.getenv("SPOOL_DRAIN_BATCH", 100))
+SPOOL_RETRY_SECONDS = float(os.getenv("SPOOL_RETRY_SECONDS", 30.0))
+
 os.makedirs(ATTACH_DIR, exist_ok=True)
 os.makedirs(EXTRACTED_DIR, exist_ok=True)
 
+# ============= Extracted Store =============
+# Append-only NumPy segments of every extracted invoice, written to EXTRACTED_DIR
+EXTRACTED_SINK_ENABLED = os.getenv("EXTRACTED_SINK_ENABLED", "true").lower() in ("1", "true", "yes")
+EXTRACTED_BATCH_SIZE = int(os.getenv("EXTRACTED_BATCH_SIZE", 256))
+EXTRACTED_FLUSH_INTERVAL = float(os.getenv("EXTRACTED_FLUSH_INTERVAL", 5.0))
+# Invoices held in memory while segment writes keep failing; the oldest are dropped beyond this
+EXTRACTED_MAX_PENDING = int(os.getenv("EXTRACTED_MAX_PENDING", 10000))
+
+# ============= Profiling =============
+# Fraction of extractions profiled with cProfile (0 = off); can be changed at
+# runtime through /admin/profiling
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.0))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 200))
+# Append every /extract request and consumed message to this JSONL file when set
+# (replayable with benchmarks/loadgen.py)
+TRAFFIC_RECORD_PATH = os.getenv("TRAFFIC_RECORD_PATH")
+# Admin endpoints require this token in the X-Admin-Token header; they are
+# disabled (401) when it is not set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
 # Config Google GenAI
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME")
@@ -78,3 +192,27 @@ def load_extraction_prompt():
     with open(extract_prompt_path, "r", encoding="utf-8") as f:
         extractor_prompts = yaml.safe_load(f)
     return extractor_prompts.get("extractor_instruction")
+
+def load_chunk_prompts():
+    """Load the header-only / items-only instructions used for chunked PDF extraction"""
+    extract_prompt_path = os.path.join(os.path.dirname(__file__), 'prompts', 'extract_prompt.yaml')
+    with open(extract_prompt_path, "r", encoding="utf-8") as f:
+        extractor_prompts = yaml.safe_load(f)
+    return {
+        "header_only": extractor_prompts.get("header_only_instruction", ""),
+        "items_only": extractor_prompts.get("items_only_instruction", ""),
+    }
+
+# Load XML schema mappings:
+XML_SCHEMA_PATHS = [p for p in os.getenv("XML_SCHEMA_PATHS", "").split(os.pathsep) if p]
+
+def load_xml_schemas():
+    """Load provider XML schemas: XML_SCHEMA_PATHS first, then the bundled defaults"""
+    default_path = os.path.join(os.path.dirname(__file__), 'schemas', 'xml_invoice_schemas.yaml')
+    schemas = []
+    for schema_path in XML_SCHEMA_PATHS + [default_path]:
+        if not os.path.exists(schema_path):
+            raise FileNotFoundError(f"❌ Can't find XML schema file at {schema_path}")
+        with open(schema_path, "r", encoding="utf-8") as f:
+            schemas.extend((yaml.safe_load(f) or {}).get("schemas", []))
+    return schemas
@@ -0,0 +1,165 @@
+import os
+import time
+import random
+import pstats
+import cProfile
+import logging
+import threading
+import functools
+import itertools
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUFFIX = ".prof"
+
+
+class SamplingProfiler:
+    """
+    Profiles a sampled fraction of calls with cProfile.
+
+    Each sampled call is dumped as a pstats file (`.prof`, readable by
+    `python -m pstats` or snakeviz) into `output_dir`. Only the newest
+    `max_files` profiles are kept. A sample rate of 0 disables profiling and
+    costs one comparison per call.
+    """
+    def __init__(self, output_dir: str, sample_rate: float = 0.0, max_files: int = 200):
+        self.output_dir = output_dir
+        self.max_files = max_files
+        self.sample_rate = 0.0
+        self.set_sample_rate(sample_rate)
+        # cProfile cannot run two profilers at once; concurrent calls are simply not sampled
+        self._active = threading.Lock()
+        self._rotate_lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def set_sample_rate(self, rate: float):
+        """Set the fraction of calls to profile (0.0 - 1.0)."""
+        rate = float(rate)
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError(f"sample_rate must be between 0 and 1, got {rate}")
+        self.sample_rate = rate
+        logger.info(f"Profiling sample rate set to {rate}")
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def _should_sample(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @contextmanager
+    def profile(self, name: str, force: bool = False):
+        """
+        Profile the enclosed block if it is sampled.
+
+        Args:
+            name: Label used in the profile file name
+            force: Profile regardless of the sample rate
+        """
+        if not (force or self._should_sample()) or not self._active.acquire(blocking=False):
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            self._dump(profiler, name)
+        finally:
+            self._active.release()
+
+    def profiled(self, name: str = None):
+        """Decorator form of `profile`."""
+        def decorator(func):
+            label = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.profile(label):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # ---------------- Storage ----------------
+
+    def _dump(self, profiler: cProfile.Profile, name: str):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            file_name = f"{int(time.time() * 1000)}-{os.getpid()}-{next(self._seq)}-{name}{PROFILE_SUFFIX}"
+            profiler.dump_stats(os.path.join(self.output_dir, file_name))
+            self._rotate()
+        except OSError as e:
+            logger.error(f"Failed to write profile for '{name}': {e}")
+
+    def _profile_files(self):
+        try:
+            names = [f for f in os.listdir(self.output_dir) if f.endswith(PROFILE_SUFFIX)]
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            path = os.path.join(self.output_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                # Removed by rotation in another thread/process since listdir
+                continue
+        return [path for _, path in sorted(entries)]
+
+    def _rotate(self):
+        with self._rotate_lock:
+            files = self._profile_files()
+            for path in files[:max(0, len(files) - self.max_files)]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    # ---------------- Reporting ----------------
+
+    def top_functions(self, minutes: float = 5, limit: int = 20, sort: str = "tottime") -> dict:
+        """
+        Aggregate profiles written in the last `minutes` and return the hottest functions.
+
+        Args:
+            minutes: Look-back window
+            limit: Maximum number of functions returned
+            sort: "tottime" (self time) or "cumtime" (including callees)
+        """
+        if sort not in ("tottime", "cumtime"):
+            raise ValueError(f"sort must be 'tottime' or 'cumtime', got {sort}")
+
+        cutoff = time.time() - minutes * 60
+        stats = None
+        loaded = 0
+        for path in self._profile_files():
+            # Files may be rotated away or still being written while we read them
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(path)
+                else:
+                    stats.add(path)
+                loaded += 1
+            except (OSError, TypeError, EOFError, ValueError) as e:
+                logger.warning(f"Skipping unreadable profile {path}: {e}")
+        if stats is None:
+            return {"profiles": 0, "functions": []}
+
+        rows = []
+        for (file_name, line, func_name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                "function": f"{file_name}:{line}({func_name})",
+                "ncalls": ncalls,
+                "tottime": tottime,
+                "cumtime": cumtime,
+            })
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        return {"profiles": loaded, "functions": rows[:limit]}
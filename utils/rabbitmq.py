@@ -46,6 +46,28 @@ class RabbitMQConnection:
             self.connection.close()
             logger.info("RabbitMQ connection closed.")
 
+    def set_prefetch(self, prefetch_count: int):
+        """
+        Limits the number of unacknowledged messages the broker pushes to each consumer.
+        
+        Args:
+            prefetch_count: Maximum unacked messages per consumer on this channel
+        """
+        if not self.channel:
+            self.connect()
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+        logger.info(f"Prefetch set to {prefetch_count} messages per consumer.")
+
+    def enable_confirms(self):
+        """
+        Puts the channel in publisher-confirm mode: basic_publish waits for the
+        broker and raises NackError/UnroutableError instead of failing silently.
+        """
+        if not self.channel:
+            self.connect()
+        self.channel.confirm_delivery()
+        logger.info("Publisher confirms enabled.")
+
     def ensure_queue_exists(self, queue_name: str):
         """
         Verify queue exists using passive declare.
@@ -96,6 +118,19 @@ class RabbitMQConnection:
         Starts consuming messages from a queue.
         Queue must be created by Queue Orchestrator before calling this method.
         
+        Args:
+            queue_name: Name of the queue to consume from
+            callback: Function to handle incoming messages
+        """
+        self.add_consumer(queue_name, callback)
+        logger.info(f"Started consuming from queue '{queue_name}'. Waiting for messages...")
+        self.channel.start_consuming()
+
+    def add_consumer(self, queue_name: str, callback):
+        """
+        Registers a consumer on a queue without starting the consuming loop,
+        so one connection can serve several queues before `consume` is called.
+        
         Args:
             queue_name: Name of the queue to consume from
             callback: Function to handle incoming messages
@@ -118,8 +153,6 @@ class RabbitMQConnection:
             on_message_callback=safe_callback, 
             auto_ack=False
         )
-        logger.info(f"Started consuming from queue '{queue_name}'. Waiting for messages...")
-        self.channel.start_consuming()
 
     def ack_message(self, delivery_tag):
         """Acknowledges a message."""
@@ -0,0 +1,117 @@
+import os
+import json
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class LocalSpool:
+    """
+    JSONL file holding messages that could not be delivered while a dependency is down.
+
+    `append` adds one record. `take` moves every record aside (to `<path>.draining`)
+    and returns them; the caller delivers them and calls `done(unsent)` with the ones
+    it could not deliver, which go back to the spool. A draining file left behind by
+    a crash is returned by the next `take`, so records are delivered at least once.
+
+    The spool may be shared by several processes (Flask app, consumer, async
+    service). A `flock` on `<path>.drain.lock`, held from `take` until `done`, lets
+    only one of them drain at a time; appends hold a shared lock on `<path>.lock`
+    so a record is never written into a file that is being moved aside.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._draining_path = path + ".draining"
+        self._lock = threading.Lock()
+        self._drain_fd = None
+
+    @contextmanager
+    def _file_lock(self, operation: int):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def append(self, record: dict):
+        with self._lock:
+            self._append_locked([record])
+
+    def _append_locked(self, records: list):
+        with self._file_lock(fcntl.LOCK_SH):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+    def _acquire_drain_locked(self) -> bool:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path + ".drain.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._drain_fd = fd
+        return True
+
+    def _release_drain_locked(self):
+        os.close(self._drain_fd)
+        self._drain_fd = None
+
+    def take(self) -> list:
+        """Remove and return the spooled records; [] if empty or another caller is draining."""
+        with self._lock:
+            if self._drain_fd is not None or not self._acquire_drain_locked():
+                return []
+            if not os.path.exists(self._draining_path):
+                with self._file_lock(fcntl.LOCK_EX):
+                    if not os.path.exists(self.path):
+                        self._release_drain_locked()
+                        return []
+                    os.replace(self.path, self._draining_path)
+            return _read_records(self._draining_path)
+
+    def done(self, unsent: list = ()):
+        """Finish a `take`: put back the records that were not delivered."""
+        with self._lock:
+            if self._drain_fd is None:
+                return
+            if unsent:
+                self._append_locked(list(unsent))
+            if os.path.exists(self._draining_path):
+                os.remove(self._draining_path)
+            self._release_drain_locked()
+
+    def pending(self) -> int:
+        """Number of spooled records (including ones being drained)."""
+        with self._lock:
+            return sum(
+                _count_lines(path) for path in (self.path, self._draining_path) if os.path.exists(path)
+            )
+
+
+def _read_records(path: str) -> list:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                logger.warning(f"Dropping malformed spool record at {path}:{line_no}: {e}")
+    return records
+
+
+def _count_lines(path: str) -> int:
+    try:
+        with open(path, "rb") as f:
+            return sum(1 for line in f if line.strip())
+    except FileNotFoundError:
+        # Moved aside or removed by another process's take/done
+        return 0
@@ -0,0 +1,53 @@
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Record kinds understood by the load generator
+KIND_HTTP = "http"
+KIND_QUEUE = "queue"
+
+
+class TrafficRecorder:
+    """
+    Appends incoming /extract requests and queue messages to a JSONL file.
+
+    Each line is one record:
+        {"ts": 1729000000.1, "kind": "http", "path": "/extract", "lane": "xml", "body": {...}}
+        {"ts": 1729000000.2, "kind": "queue", "queue": "queue.for_extraction", "lane": "pdf", "body": {...}}
+
+    The file is the input format of `benchmarks/loadgen.py replay`.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, body, **fields):
+        """Append one record; failures are logged and never affect the request."""
+        entry = {"ts": time.time(), "kind": kind, **fields, "body": body}
+        try:
+            line = json.dumps(entry, ensure_ascii=False)
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Failed to record {kind} traffic to {self.path}: {e}")
+
+
+def load_records(path: str) -> list:
+    """Read a traffic JSONL file, skipping blank and malformed lines."""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Skipping malformed record at {path}:{line_no}: {e}")
+                continue
+            if record.get("kind") in (KIND_HTTP, KIND_QUEUE):
+                records.append(record)
+    return records